@@ -15,6 +15,8 @@ from flask_bootstrap import Bootstrap
 
 bcrypt = Bcrypt()
 from models import db
+from cache import response_cache
+from sqlstats import sql_stats
 
 
 ################
@@ -36,6 +38,8 @@ def create_app():
 	toolbar = DebugToolbarExtension(app)
 	bootstrap = Bootstrap(app)
 	db.init_app(app)
+	response_cache.init_app(app)
+	sql_stats.init_app(app)
 
 
 	###################
@@ -46,26 +50,26 @@ def create_app():
 	from mod_user.views import user_blueprint
 	from mod_inventory.views import inventory_blueprint
 	from mod_api.resources import api_module
+	from mod_pictures.views import pictures_blueprint
 
 	app.register_blueprint(user_blueprint)
 	app.register_blueprint(main_blueprint)
 	app.register_blueprint(inventory_blueprint)
 	app.register_blueprint(api_module)
+	app.register_blueprint(pictures_blueprint)
 
 
 	###################
 	### flask-login ####
 	###################
 
-	from models import User
+	from mod_user.loader import load_user
 
 	login_manager.login_view = "user.login"
 	login_manager.login_message_category = 'danger'
 
 
-	@login_manager.user_loader
-	def load_user(user_id):
-	    return User.query.filter(User.id == int(user_id)).first()
+	login_manager.user_loader(load_user)
 
 
 	########################
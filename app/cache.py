@@ -0,0 +1,163 @@
+# app/cache.py
+
+
+#################
+#### imports ####
+#################
+
+import binascii
+import os
+import threading
+from functools import wraps
+
+from flask import request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from werkzeug.contrib import cache as backends
+
+
+################
+#### config ####
+################
+
+BACKENDS = {
+    'null': backends.NullCache,
+    'simple': backends.SimpleCache,
+    'redis': backends.RedisCache,
+    'memcached': backends.MemcachedCache,
+    'filesystem': backends.FileSystemCache,
+}
+
+
+#################
+#### helpers ####
+#################
+
+def _token():
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+class ResponseCache(object):
+    """Caches rendered API responses per group of endpoints.
+
+    The backend is any werkzeug cache: ``simple`` keeps entries in the
+    process, ``redis`` or ``memcached`` share them between workers. A
+    group is invalidated by replacing its generation token, which is stored
+    in the backend too, without a timeout, so every worker sees it; with
+    the in-process backend other workers only catch up when their entries
+    time out. Groups are bumped after a commit that touched any of the
+    models they watch.
+    """
+
+    def __init__(self, app=None):
+        self.backend = backends.NullCache()
+        self.timeout = 300
+        self.watched = {}
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = BACKENDS[app.config.get('RESPONSE_CACHE_TYPE', 'null')]
+        self.backend = backend(**app.config.get('RESPONSE_CACHE_OPTIONS', {}))
+        self.timeout = app.config.get('RESPONSE_CACHE_TIMEOUT', self.timeout)
+
+    def watch(self, group, *models):
+        """Invalidate group whenever rows of models change."""
+        for model in models:
+            self.watched.setdefault(model, set()).add(group)
+
+    def generation(self, group):
+        key = 'generation:' + group
+        token = self.backend.get(key)
+        if token is None:
+            # lost or never set: start a fresh generation, never one that
+            # responses may still be cached under; add lets the first
+            # worker win so they all agree
+            self.backend.add(key, _token(), timeout=0)
+            token = self.backend.get(key)
+        return token
+
+    def invalidate(self, *groups):
+        # a random token, not a counter: inc is get-and-set with the default
+        # timeout on most backends, and a counter restarting after its key
+        # expired would revive responses cached under an old generation
+        for group in groups:
+            self.backend.set('generation:' + group, _token(), timeout=0)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict((group, {'hits': self.hits.get(group, 0),
+                                 'misses': self.misses.get(group, 0)})
+                        for group in set(self.hits) | set(self.misses))
+
+    def _count(self, counter, group):
+        with self._lock:
+            counter[group] = counter.get(group, 0) + 1
+
+    def cached(self, group):
+        """Caches what the view returns, keyed by group and request path."""
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                key = 'response:%s:%s:%s' % (group, self.generation(group),
+                                             request.full_path)
+                rv = self.backend.get(key)
+                if rv is not None:
+                    self._count(self.hits, group)
+                    return rv
+                self._count(self.misses, group)
+                rv = f(*args, **kwargs)
+                self.backend.set(key, rv, timeout=self.timeout)
+                return rv
+            return wrapper
+        return decorator
+
+    def _changed_groups(self, session):
+        groups = set()
+        for obj in session.new | session.dirty | session.deleted:
+            for model, watching in self.watched.items():
+                if isinstance(obj, model):
+                    groups.update(watching)
+        return groups
+
+    def _touched_groups(self, tables):
+        groups = set()
+        for model, watching in self.watched.items():
+            if model.__table__.name in tables:
+                groups.update(watching)
+        return groups
+
+
+response_cache = ResponseCache()
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _collect_invalidations(session, flush_context):
+    groups = response_cache._changed_groups(session)
+    if groups:
+        session.info.setdefault('response_cache', set()).update(groups)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _invalidate_after_commit(session):
+    # only once the change is visible, or a concurrent request could
+    # cache the old rows again under the new generation
+    groups = session.info.pop('response_cache', set())
+    groups |= response_cache._touched_groups(
+        session.info.pop('touched_tables', ()))
+    response_cache.invalidate(*groups)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _discard_invalidations(session):
+    session.info.pop('response_cache', None)
+    session.info.pop('touched_tables', None)
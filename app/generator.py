@@ -0,0 +1,305 @@
+# app/generator.py
+
+
+#################
+#### imports ####
+#################
+
+import bisect
+import datetime
+import decimal
+import itertools
+import random
+
+from . import bcrypt
+from .models import db, User, Address, Vendor, Component, VendorComponent, \
+    Tag, TagCategory, PurchaseOrder, LineItem, Transaction, StockLevel, \
+    components_tags, tag_categories_tags, touch_tables
+
+
+################
+#### config ####
+################
+
+DEFAULT_SEED = 42
+# a fixed end date keeps the ledger identical from one day to the next
+DEFAULT_END = datetime.datetime(2017, 3, 1)
+DEFAULT_CHUNK_SIZE = 10000
+SKU_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+CATEGORY_WORDS = ('RESISTOR', 'CAPACITOR', 'CONNECTOR', 'FASTENER', 'CABLE',
+                  'SENSOR', 'MOTOR', 'SWITCH', 'FUSE', 'RELAY', 'LED',
+                  'DIODE', 'TRANSISTOR', 'BEARING', 'SPRING', 'GASKET',
+                  'BRACKET', 'HOUSING', 'BATTERY', 'TOOL')
+TAG_WORDS = ('SMD', 'THT', 'M3', 'M4', 'M5', '12V', '24V', '5V', 'STEEL',
+             'BRASS', 'NYLON', 'RED', 'BLUE', 'BLACK', 'SMALL', 'LARGE',
+             'SPARE', 'ROHS', 'OBSOLETE', 'IMPORTED')
+PART_WORDS = ('hex', 'flat', 'round', 'shielded', 'sealed', 'miniature',
+              'heavy duty', 'low profile', 'right angle', 'panel mount')
+CITIES = (('Denver', 'CO'), ('Austin', 'TX'), ('Portland', 'OR'),
+          ('Columbus', 'OH'), ('Raleigh', 'NC'), ('Madison', 'WI'),
+          ('Tucson', 'AZ'), ('Boise', 'ID'))
+NOTES = ('job %d', 'PO %d', 'rework', 'cycle count', 'line %d kit',
+         'returned to stock', 'scrap', 'customer order %d')
+
+
+#################
+#### helpers ####
+#################
+
+def base36(number, width=5):
+    digits = []
+    for _ in range(width):
+        number, digit = divmod(number, 36)
+        digits.append(SKU_ALPHABET[digit])
+    return ''.join(reversed(digits))
+
+
+def word_name(words, number):
+    """The number-th unique name made from words: the words themselves,
+    then the words numbered 2, 3, ..."""
+    word = words[number % len(words)]
+    round = number // len(words)
+    return word if not round else '%s %d' % (word, round + 1)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Popularity(object):
+    """Zipf-like pick among n items: the k-th most popular one is chosen
+    in proportion to 1 / k ** skew, the way a few parts make up most of
+    the traffic. Items are shuffled so popularity does not follow id."""
+
+    def __init__(self, rng, items, skew=1.1):
+        self.items = list(items)
+        rng.shuffle(self.items)
+        total, self.bounds = 0.0, []
+        for rank in range(1, len(self.items) + 1):
+            total += 1.0 / rank ** skew
+            self.bounds.append(total)
+        self.total = total
+
+    def pick(self, rng):
+        return self.items[bisect.bisect(self.bounds,
+                                         rng.random() * self.total)]
+
+
+class DataGenerator(object):
+    """Fills an empty database with a seeded, realistic looking catalog.
+
+    Every row is derived from the seed, so two runs with the same
+    parameters write the same data. Rows go in with multi-row INSERTs of
+    chunk_size; ids are read back once per table instead of per row.
+
+    The ledger spans days ending at end. Its volume grows over time and
+    drops at weekends, entries cluster in working hours, and component
+    popularity follows a Zipf curve. Check-outs never take a component
+    below zero; small, frequent check-outs are balanced by larger
+    restocking check-ins.
+    """
+
+    def __init__(self, seed=DEFAULT_SEED, users=10, vendors=50,
+                 components=5000, vendor_components=2, categories=20,
+                 tags=200, purchase_orders=2000, transactions=100000,
+                 days=730, end=DEFAULT_END, chunk_size=DEFAULT_CHUNK_SIZE,
+                 log=None):
+        self.rng = random.Random(seed)
+        self.counts = dict(users=users, vendors=vendors,
+                           components=components,
+                           vendor_components=vendor_components,
+                           categories=categories, tags=tags,
+                           purchase_orders=purchase_orders,
+                           transactions=transactions)
+        self.days = days
+        self.end = end
+        self.chunk_size = chunk_size
+        self.log = log or (lambda message: None)
+
+    def insert(self, table, rows):
+        inserted = 0
+        for chunk in chunks(rows, self.chunk_size):
+            db.session.execute(table.insert(), chunk)
+            inserted += len(chunk)
+        db.session.commit()
+        self.log('%s: %d rows' % (table.name, inserted))
+        return inserted
+
+    def ids(self, model):
+        return [id for id, in db.session.query(model.id).order_by(model.id)]
+
+    def run(self):
+        if db.session.query(Component.id).first() is not None or \
+                db.session.query(Transaction.id).first() is not None:
+            raise ValueError('create_data needs an empty database')
+        self.users = self.make_users()
+        self.vendors = self.make_vendors()
+        self.components = self.make_components()
+        self.make_tags()
+        self.make_purchase_orders()
+        self.make_ledger()
+        StockLevel.rebuild()
+        PurchaseOrder.rebuild_cached_totals()
+        touch_tables(db.session, 'user', 'address', 'vendor', 'component',
+                     'vendor_component', 'tag', 'tag_category',
+                     'components_tags', 'tag_categories_tags',
+                     'purchase_order', 'line_item', 'transaction')
+        db.session.commit()
+
+    def make_users(self):
+        # hashing is slow on purpose; every generated user shares one
+        password = bcrypt.generate_password_hash('password')
+        now = self.end
+        self.insert(User.__table__, (
+            dict(email='user%03d@example.com' % i, password=password,
+                 registered_on=now, admin=i == 0)
+            for i in range(self.counts['users'])))
+        return self.ids(User)
+
+    def make_vendors(self):
+        rng, count = self.rng, self.counts['vendors']
+        self.insert(Address.__table__, (
+            dict(line1='%d %s St' % (rng.randint(1, 9999),
+                                     rng.choice(PART_WORDS).title()),
+                 city=city, state=state,
+                 zipcode='%05d' % rng.randint(10000, 99999))
+            for city, state in (rng.choice(CITIES) for _ in range(count))))
+        addresses = self.ids(Address)[-count:]
+        self.insert(Vendor.__table__, (
+            dict(name='Vendor %04d' % i, contact='Sales %d' % i,
+                 phone='555-%04d' % rng.randint(0, 9999),
+                 website='http://vendor%04d.example.com' % i,
+                 address_id=address_id)
+            for i, address_id in enumerate(addresses)))
+        return self.ids(Vendor)
+
+    def make_components(self):
+        rng = self.rng
+        self.insert(Component.__table__, (
+            dict(sku=base36(i), description='%s %s %d' % (
+                rng.choice(PART_WORDS), rng.choice(CATEGORY_WORDS).lower(),
+                rng.randint(1, 1000)))
+            for i in range(self.counts['components'])))
+        components = self.ids(Component)
+        # each component is sold by a few vendors, big vendors sell more
+        vendors = Popularity(rng, self.vendors, skew=0.8)
+        self.prices = {}
+        rows = []
+        for index, component_id in enumerate(components):
+            for vendor_id in set(vendors.pick(rng) for _ in range(
+                    rng.randint(1, 2 * self.counts['vendor_components']))):
+                rows.append(dict(sku=base36(index), vendor_id=vendor_id,
+                                 description='vendor part %d' % index))
+        self.insert(VendorComponent.__table__, rows)
+        self.vendor_parts = {}
+        for id, vendor_id in db.session.query(
+                VendorComponent.id, VendorComponent.vendor_id) \
+                .order_by(VendorComponent.id):
+            self.vendor_parts.setdefault(vendor_id, []).append(id)
+            self.prices[id] = decimal.Decimal(
+                '%.2f' % rng.lognormvariate(1.0, 1.2))
+        return components
+
+    def make_tags(self):
+        rng = self.rng
+        self.insert(TagCategory.__table__, (
+            dict(name=word_name(CATEGORY_WORDS, i))
+            for i in range(self.counts['categories'])))
+        categories = self.ids(TagCategory)
+        self.insert(Tag.__table__, (
+            dict(name=word_name(TAG_WORDS, i))
+            for i in range(self.counts['tags'])))
+        tags = self.ids(Tag)
+        self.insert(tag_categories_tags, (
+            dict(tag_category_id=category_id, tag_id=tag_id)
+            for tag_id in tags
+            for category_id in rng.sample(categories,
+                                          min(len(categories),
+                                              rng.randint(1, 2)))))
+        popular = Popularity(rng, tags)
+        self.insert(components_tags, (
+            dict(component_id=component_id, tag_id=tag_id)
+            for component_id in self.components
+            for tag_id in set(popular.pick(rng)
+                              for _ in range(rng.randint(0, 4)))))
+
+    def make_purchase_orders(self):
+        rng, count = self.rng, self.counts['purchase_orders']
+        vendors = Popularity(rng, [v for v in self.vendors
+                                   if v in self.vendor_parts], skew=0.8)
+        start = self.end - datetime.timedelta(days=self.days)
+        orders = [(vendors.pick(rng), start + datetime.timedelta(
+            seconds=rng.randint(0, self.days * 86400))) for _ in range(count)]
+        orders.sort(key=lambda order: order[1])
+        self.insert(PurchaseOrder.__table__, (
+            dict(vendor_id=vendor_id, created_on=created_on,
+                 user_id=rng.choice(self.users),
+                 shipping=decimal.Decimal('%.2f' % rng.uniform(0, 50)),
+                 tax=decimal.Decimal('%.2f' % rng.uniform(0, 20)),
+                 cached_total=0)
+            for vendor_id, created_on in orders))
+        ids = self.ids(PurchaseOrder)[-count:]
+        rows = []
+        for order_id, (vendor_id, created_on) in zip(ids, orders):
+            parts = self.vendor_parts[vendor_id]
+            for part in rng.sample(parts, min(len(parts), rng.randint(1, 10))):
+                quantity = rng.choice((1, 5, 10, 25, 50, 100))
+                rows.append(dict(purchase_order_id=order_id,
+                                 vendor_component_id=part, quantity=quantity,
+                                 total_price=self.prices[part] * quantity))
+        self.insert(LineItem.__table__, rows)
+
+    def day_counts(self):
+        """Splits the ledger over the days: volume doubles over the period
+        and weekends see a fifth of a weekday's traffic."""
+        start = self.end - datetime.timedelta(days=self.days)
+        weights = []
+        for day in range(self.days):
+            weight = 2 ** (float(day) / self.days)
+            if (start + datetime.timedelta(days=day)).weekday() >= 5:
+                weight *= 0.2
+            weights.append(weight)
+        total = self.counts['transactions']
+        scale = total / sum(weights)
+        counts = [int(weight * scale) for weight in weights]
+        # hand the rounding leftovers to the busiest days
+        for day in sorted(range(self.days), key=lambda d: -weights[d])[
+                :total - sum(counts)]:
+            counts[day] += 1
+        return start, counts
+
+    def ledger(self):
+        rng = self.rng
+        components = Popularity(rng, range(len(self.components)))
+        balances = [0] * len(self.components)
+        users = Popularity(rng, self.users, skew=0.7)
+        start, counts = self.day_counts()
+        for day, count in enumerate(counts):
+            midnight = start + datetime.timedelta(days=day)
+            for second in sorted(int(rng.triangular(6 * 3600, 20 * 3600,
+                                                    10 * 3600))
+                                 for _ in range(count)):
+                index = components.pick(rng)
+                if balances[index] > 0 and rng.random() < 0.85:
+                    qty = -min(balances[index], rng.randint(1, 10))
+                else:
+                    qty = rng.choice((10, 20, 25, 50, 100, 200))
+                balances[index] += qty
+                notes = None
+                if rng.random() < 0.3:
+                    notes = rng.choice(NOTES)
+                    if '%d' in notes:
+                        notes %= rng.randint(1, 99999)
+                when = midnight + datetime.timedelta(seconds=second)
+                yield dict(component_id=self.components[index],
+                           user_id=users.pick(rng), qty=qty, notes=notes,
+                           date_create=when, date_modified=when)
+
+    def make_ledger(self):
+        self.insert(Transaction.__table__, self.ledger())
@@ -0,0 +1,299 @@
+# app/importer.py
+
+
+#################
+#### imports ####
+#################
+
+import codecs
+import csv
+import json
+import sys
+
+import six
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, Component, VendorComponent, Vendor, ImportRun, \
+    touch_tables
+
+
+################
+#### config ####
+################
+
+DEFAULT_CHUNK_SIZE = 1000
+# rejected rows reported back; the run counts every one of them
+MAX_REPORTED = 1000
+FORMATS = ('csv', 'jsonl')
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+#################
+#### parsing ####
+#################
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return six.text_type(value).strip()
+
+
+def _lines(stream):
+    lines = iter(stream.readline, b'')
+    if six.PY2:
+        return lines
+    # line by line, so one bad line cannot stop the decoder; its bytes are
+    # kept as lone surrogates for read_csv to reject
+    return (line.decode('utf-8', 'surrogateescape') for line in lines)
+
+
+def _csv_row(header, cells):
+    values = [_text(cell) for cell in cells]
+    if not six.PY2:
+        u''.join(values).encode('utf-8')
+    return dict(zip(header, values))
+
+
+def read_csv(stream):
+    """Yields (line number, row) from a CSV file with a header line; a line
+    that cannot be read yields a ValueError for its row."""
+    reader = csv.reader(_lines(stream))
+    try:
+        header = [_text(name).lstrip(u'\ufeff').lower()
+                  for name in next(reader)]
+    except StopIteration:
+        return
+    except (csv.Error, ValueError) as e:
+        raise ImportFormatError('unreadable header line: %s' % e)
+    while True:
+        try:
+            cells = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, ValueError('not valid CSV: %s' % e)
+            continue
+        if not any(cells):
+            continue
+        try:
+            row = _csv_row(header, cells)
+        except UnicodeError:
+            row = ValueError('not valid UTF-8')
+        yield reader.line_num, row
+
+
+def read_jsonl(stream):
+    """Yields (line number, row) from a file of JSON objects, one a line;
+    a line that is no JSON object yields a ValueError for its row."""
+    for number, line in enumerate(_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            # encoding refuses the surrogates _lines left for bad bytes
+            row = json.loads(line.decode('utf-8')
+                             if isinstance(line, bytes)
+                             else line.encode('utf-8'))
+        except ValueError:
+            row = None
+        if not isinstance(row, dict):
+            yield number, ValueError('not a JSON object')
+            continue
+        yield number, dict((_text(key).lower(), _text(value))
+                           for key, value in row.items())
+
+
+def read_rows(stream, format):
+    if format not in FORMATS:
+        raise ImportFormatError('format must be one of %s' %
+                                ', '.join(FORMATS))
+    return read_csv(stream) if format == 'csv' else read_jsonl(stream)
+
+
+def guess_format(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return 'jsonl' if extension in ('jsonl', 'ndjson', 'json') else 'csv'
+
+
+###################
+#### importers ####
+###################
+
+class Importer(object):
+    """Bulk loads rows into components or vendor components.
+
+    The SKUs already stored are fetched once; every row is checked against
+    them and against the rows before it, then valid rows go in with one
+    multi-row INSERT per chunk. Each chunk commits together with the
+    checkpoint of its ImportRun, so a failed import resumes after the last
+    chunk that made it.
+    """
+
+    model = None
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.sku_length = self.model.sku.type.length
+        self.known = self.existing_keys()
+        self.rejected = []
+
+    def existing_keys(self):
+        raise NotImplementedError
+
+    def key(self, values):
+        raise NotImplementedError
+
+    def values(self, row):
+        """Column values for row, or raises ValueError naming the problem."""
+        sku = row.get('sku', u'')
+        description = row.get('description', u'')
+        if not sku:
+            raise ValueError('sku is required')
+        if len(sku) > self.sku_length:
+            raise ValueError('sku is longer than %d characters' %
+                             self.sku_length)
+        if not description:
+            raise ValueError('description is required')
+        return {'sku': sku, 'description': description}
+
+    def reject(self, line, row, error):
+        if len(self.rejected) < MAX_REPORTED:
+            self.rejected.append({'line': line,
+                                  'sku': row.get('sku')
+                                  if isinstance(row, dict) else None,
+                                  'error': error})
+
+    def run(self, rows, run):
+        """Imports rows for run, skipping those an earlier attempt of the
+        run already dealt with. Returns run."""
+        chunk = []
+        seen = rejected = 0
+        skip = run.position
+        try:
+            for line, row in rows:
+                seen += 1
+                if seen <= skip:
+                    continue
+                try:
+                    if isinstance(row, ValueError):
+                        raise row
+                    values = self.values(row)
+                    if self.key(values) in self.known:
+                        raise ValueError('duplicate sku')
+                except ValueError as e:
+                    self.reject(line, row, str(e))
+                    rejected += 1
+                else:
+                    self.known.add(self.key(values))
+                    chunk.append((line, values))
+                if len(chunk) + rejected >= self.chunk_size:
+                    self.flush(chunk, rejected, run)
+                    chunk, rejected = [], 0
+            self.flush(chunk, rejected, run)
+            run.finish()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            run.fail(e)
+            db.session.commit()
+            raise
+        return run
+
+    def flush(self, chunk, rejected, run):
+        if not chunk and not rejected:
+            return
+        table = self.model.__table__
+        if chunk:
+            try:
+                db.session.execute(table.insert(), [v for _, v in chunk])
+            except IntegrityError:
+                # rows stored since the keys were fetched; drop those.
+                # Without any, some other constraint failed: give up
+                exc_info = sys.exc_info()
+                db.session.rollback()
+                stored = self.stored_keys([v for _, v in chunk])
+                if not any(self.key(v) in stored for _, v in chunk):
+                    six.reraise(*exc_info)
+                for line, values in chunk:
+                    if self.key(values) in stored:
+                        self.reject(line, values, 'duplicate sku')
+                        rejected += 1
+                chunk = [(line, values) for line, values in chunk
+                         if self.key(values) not in stored]
+                if chunk:
+                    db.session.execute(table.insert(),
+                                       [v for _, v in chunk])
+            touch_tables(db.session, table.name)
+        run.checkpoint(len(chunk) + rejected, len(chunk), rejected)
+        db.session.commit()
+
+
+class ComponentImporter(Importer):
+    model = Component
+
+    def existing_keys(self):
+        return set(sku for sku, in db.session.query(Component.sku))
+
+    def stored_keys(self, values):
+        return set(sku for sku, in db.session.query(Component.sku).filter(
+            Component.sku.in_([v['sku'] for v in values])))
+
+    def key(self, values):
+        return values['sku']
+
+
+class VendorComponentImporter(Importer):
+    """Vendor components name their vendor by vendor_id or by vendor name;
+    a SKU is unique per vendor."""
+
+    model = VendorComponent
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        vendors = db.session.query(Vendor.id, Vendor.name).all()
+        self.vendor_ids = set(six.text_type(id) for id, name in vendors)
+        self.vendor_names = dict((name, id) for id, name in vendors)
+        super(VendorComponentImporter, self).__init__(chunk_size)
+
+    def existing_keys(self):
+        return set(db.session.query(VendorComponent.vendor_id,
+                                    VendorComponent.sku))
+
+    def stored_keys(self, values):
+        return set(db.session.query(VendorComponent.vendor_id,
+                                    VendorComponent.sku).filter(
+            VendorComponent.sku.in_([v['sku'] for v in values])))
+
+    def key(self, values):
+        return values['vendor_id'], values['sku']
+
+    def values(self, row):
+        values = super(VendorComponentImporter, self).values(row)
+        vendor_id = row.get('vendor_id')
+        if vendor_id in self.vendor_ids:
+            values['vendor_id'] = int(vendor_id)
+        elif row.get('vendor') in self.vendor_names:
+            values['vendor_id'] = self.vendor_names[row['vendor']]
+        else:
+            raise ValueError('unknown vendor')
+        return values
+
+
+IMPORTERS = {
+    'components': ComponentImporter,
+    'vendor-components': VendorComponentImporter,
+}
+
+
+def import_stream(kind, stream, format, source=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """Imports a CSV or JSONL stream of kind, resuming the unfinished import
+    of source if there is one. Returns (run, rejected rows)."""
+    importer = IMPORTERS[kind](chunk_size)
+    rows = read_rows(stream, format)
+    run = ImportRun.start(kind, source)
+    importer.run(rows, run)
+    return run, importer.rejected
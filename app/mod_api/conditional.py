@@ -0,0 +1,65 @@
+# app/mod_api/conditional.py
+
+import hashlib
+from functools import wraps
+
+from flask import request, Response
+from flask_restful.utils import unpack
+from werkzeug.http import http_date
+
+from ..models import TableVersion
+
+
+def validators(tables, stock=False):
+	"""ETag and Last-Modified for a response built from tables.
+
+	Reads the version counters of the tables (and with stock of
+	stock_level) instead of rendering the response. Counters follow commit
+	order; the newest date_modified of stock_level does not, as it is
+	stamped before its write commits.
+	"""
+	if stock:
+		tables = tuple(tables) + ('stock_level',)
+	versions = TableVersion.current(tables)
+	state = [(name,) + versions.get(name, (0, None)) for name in sorted(tables)]
+	stamps = [modified_at for name, version, modified_at in state]
+	state.append(request.full_path)
+	etag = hashlib.sha1(repr(state).encode('utf-8')).hexdigest()
+	stamps = [stamp for stamp in stamps if stamp is not None]
+	return etag, max(stamps) if stamps else None
+
+def not_modified(etag, last_modified):
+	if request.if_none_match:
+		return request.if_none_match.contains(etag)
+	if request.if_modified_since and last_modified:
+		return last_modified.replace(microsecond=0) <= \
+			request.if_modified_since.replace(tzinfo=None)
+	return False
+
+def conditional(*tables, **kwargs):
+	"""Answers GETs with 304 while none of tables has changed.
+
+	Pass stock=True when the response includes stock quantities.
+	"""
+	stock = kwargs.get('stock', False)
+	def decorator(f):
+		@wraps(f)
+		def wrapper(*args, **kw):
+			etag, last_modified = validators(tables, stock)
+			headers = {'ETag': '"%s"' % etag, 'Cache-Control': 'no-cache'}
+			if last_modified:
+				headers['Last-Modified'] = http_date(last_modified)
+			if not_modified(etag, last_modified):
+				return Response(status=304, headers=headers)
+			rv = f(*args, **kw)
+			if isinstance(rv, Response):
+				if rv.status_code == 200:
+					rv.headers.extend(headers)
+				return rv
+			data, code, extra = unpack(rv)
+			if code == 200:
+				headers.update(extra or {})
+				extra = headers
+			return data, code, extra
+		return wrapper
+	return decorator
@@ -1,4 +1,7 @@
 from flask_restful import fields
+
+from ..mod_pictures.views import display_url, picture_url, thumbnail_url
+
 tag = {
 	'id' : fields.String,
 	'name' : fields.String,
@@ -7,9 +10,38 @@ tag = {
 picture = {
 	'id' : fields.String,
 	'filename' : fields.String,
+	'url' : fields.String(attribute=lambda p: p and display_url(p.filename)),
+	'original_url' : fields.String(
+		attribute=lambda p: p and picture_url(p.filename)),
+	'thumbnail_url' : fields.String(
+		attribute=lambda p: p and thumbnail_url(p.filename)),
+	'status' : fields.String,
 	'__repr__' : fields.String,
 }
 
+import_run = {
+	'id': fields.Integer,
+	'kind': fields.String,
+	'source': fields.String,
+	'status': fields.String,
+	'position': fields.Integer,
+	'inserted': fields.Integer,
+	'rejected': fields.Integer,
+	'error': fields.String,
+	'started_at': fields.DateTime(dt_format='iso8601'),
+	'finished_at': fields.DateTime(dt_format='iso8601'),
+}
+
+picture_job = {
+	'id': fields.Integer,
+	'picture_id': fields.Integer,
+	'status': fields.String,
+	'attempts': fields.Integer,
+	'error': fields.String,
+	'created_at': fields.DateTime(dt_format='iso8601'),
+	'finished_at': fields.DateTime(dt_format='iso8601'),
+}
+
 item = {
 	'id': fields.String,
 	'sku' : fields.String,
@@ -19,9 +51,36 @@ item = {
 	'pictures' : fields.Nested(picture),
 }
 
+facet = {
+	'id': fields.Integer,
+	'name' : fields.String,
+	'count' : fields.Integer,
+}
+
+component_search = {
+	'total': fields.Integer,
+	'components': fields.List(fields.Nested(item)),
+	'facets': fields.List(fields.Nested(facet)),
+}
+
 category = {
 	'id': fields.String,
 	'name' : fields.String,
 	'tags': fields.Nested(tag),
 	'__repr__' : fields.String,
 }
+
+stock = {
+	'component_id': fields.Integer,
+	'as_of': fields.DateTime(dt_format='iso8601'),
+	'qty': fields.Integer,
+}
+
+ledger_entry = {
+	'id': fields.Integer,
+	'component_id': fields.Integer,
+	'qty': fields.Integer,
+	'notes': fields.String,
+	'user_id': fields.Integer,
+	'date_create': fields.DateTime(dt_format='iso8601'),
+}
@@ -1,13 +1,25 @@
 import os
-from PIL import Image
-from flask import Blueprint, current_app
-from flask_restful import Resource, Api, reqparse, marshal_with
-from flask_login import login_required
-from ..models import db, Component, Tag, components_tags, TagCategory, Picture
+import datetime
+import itertools
+import json
+import six
+from collections import OrderedDict
+from flask import Blueprint, current_app, request, Response, \
+	stream_with_context
+from flask_restful import Resource, Api, reqparse, marshal, marshal_with, \
+	inputs, abort
+from flask_login import login_required, current_user
+from ..models import db, Component, Tag, components_tags, TagCategory, Picture, \
+	TagManager, StockSnapshot, StockLevel, Transaction, InsufficientStock, \
+	PictureJob
+from ..search import notes_index
+from ..importer import import_stream, FORMATS
+from ..cache import response_cache
+from ..mod_pictures import uploads
+from .conditional import conditional
 from .marshals import *
 
-from werkzeug.datastructures import FileStorage
-from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
 
 api_module = Blueprint('api', __name__,  url_prefix = '/api')
 api = Api(api_module)
@@ -19,14 +31,44 @@ parser.add_argument('description', type=str, location='json')
 parser.add_argument('tag_text', type=str, location='json')
 parser.add_argument('cat_text', type=str, location='json')
 
+components_parser = reqparse.RequestParser()
+components_parser.add_argument('limit', type=inputs.int_range(1, 500),
+	location='args')
+components_parser.add_argument('cursor', type=inputs.natural, location='args')
+components_parser.add_argument('fields', type=str, location='args')
+components_parser.add_argument('stream', type=inputs.boolean, default=False,
+	location='args')
+
+STREAM_CHUNK = 500
+
 class ComponentsAPI(Resource):
+	"""Components in id order.
+
+	?limit= pages the list and puts the cursor for the next page in the
+	X-Next-Cursor header, ?fields=sku,qty narrows the output (tags and
+	pictures are only loaded when asked for) and ?stream=1 writes the
+	JSON array out as rows are fetched.
+	"""
 	decorators = [login_required]
-	@marshal_with(item)
+	@conditional('component', 'tag', 'tag_category', 'picture', stock=True)
 	def get(self,component_id=None):
 		if component_id:
-			return Component.query.get(component_id)
-		else:
-			return Component.query.all()
+			return marshal(Component.query.get(component_id), item)
+		args = components_parser.parse_args()
+		fields = component_fields(args['fields'])
+		query = component_query(fields)
+		if args['cursor']:
+			query = query.filter(Component.id > args['cursor'])
+		if args['stream']:
+			return stream_components(query, fields, args['limit'])
+		if not args['limit']:
+			return marshal(query.all(), fields)
+		components = query.limit(args['limit'] + 1).all()
+		headers = {}
+		if len(components) > args['limit']:
+			components = components[:args['limit']]
+			headers['X-Next-Cursor'] = str(components[-1].id)
+		return marshal(components, fields), 200, headers
 	@marshal_with(item)
 	def put(self,component_id):
 		component = Component.query.get(component_id)
@@ -45,11 +87,46 @@ class ComponentsAPI(Resource):
 		db.session.commit()
 		return component
 
+component_search_parser = reqparse.RequestParser()
+component_search_parser.add_argument('q', type=six.text_type, location='args')
+component_search_parser.add_argument('tag', type=six.text_type,
+	action='append', default=[], location='args')
+component_search_parser.add_argument('category', type=six.text_type,
+	action='append', default=[], location='args')
+component_search_parser.add_argument('limit', type=inputs.int_range(1, 200),
+	default=50, location='args')
+
+class ComponentSearchAPI(Resource):
+	"""Components filtered by SKU/description prefix, tags and categories.
+
+	Facet counts cover every match, not just the returned page, and come
+	from a single grouped query over components_tags.
+	"""
+	decorators = [login_required]
+	@marshal_with(component_search)
+	def get(self):
+		args = component_search_parser.parse_args()
+		query = Component.search(args['q'], args['tag'], args['category'])
+		# the tag marshal renders repr(tag), which lists its categories
+		components = query.options(
+			db.subqueryload('tags').subqueryload('categories'),
+			db.subqueryload('pictures')) \
+			.order_by(Component.sku).limit(args['limit']).all()
+		return {'total': query.order_by(None).count(),
+			'components': components,
+			'facets': [{'id': id, 'name': name, 'count': count}
+				for id, name, count in TagManager.facet_counts(query)]}
+
+response_cache.watch('tags', Tag, TagCategory)
+
 class SingleTagsAPI(Resource):
 	decorators = [login_required]
+	@conditional('tag', 'tag_category')
+	@response_cache.cached('tags')
 	@marshal_with(tag)
 	def get(self):
-		tags = Tag.query.filter(Tag.categories == None).all()
+		tags = Tag.query.filter(Tag.categories == None) \
+			.options(db.subqueryload('categories')).all()
 		for t in tags:
 			setattr(t,'__repr__',str(t))
 		return tags
@@ -69,13 +146,21 @@ class TagAPI(Resource):
 
 class CategoriesAPI(Resource):
 	decorators = [login_required]
+	@conditional('tag', 'tag_category')
+	@response_cache.cached('tags')
 	@marshal_with(category)
 	def get(self):
-		cats = TagCategory.query.all()
+		cats = TagCategory.query.options(
+			db.subqueryload('tags').subqueryload('categories')).all()
 		for c in cats:
 			setattr(c,'__repr__',c)
 		return cats
 
+class CacheStatsAPI(Resource):
+	decorators = [login_required]
+	def get(self):
+		return response_cache.stats()
+
 class ComponentTagsAPI(Resource):
 	decorators = [login_required]
 	@marshal_with(item)
@@ -97,16 +182,246 @@ class ComponentTagsAPI(Resource):
 			return 404
 		return comp
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+class BulkComponentTagsAPI(Resource):
+	"""Adds or removes tags on many components in one operation.
+
+	Both methods take {"component_ids": [...], "tags": [...]}; each tag is
+	a name or, for POST, {"tag": name, "category": name}.
+	"""
+	decorators = [login_required]
+	def post(self):
+		component_ids, tags, error = parse_bulk_tags(
+			request.get_json(silent=True))
+		if error:
+			return {'message': error}, 400
+		return {'tagged': TagManager.bulk_tag(component_ids, tags)}
+
+	def delete(self):
+		component_ids, tags, error = parse_bulk_tags(
+			request.get_json(silent=True))
+		if error:
+			return {'message': error}, 400
+		return {'untagged': TagManager.bulk_untag(component_ids,
+			[tag for tag, cat in tags])}
+
+stock_parser = reqparse.RequestParser()
+stock_parser.add_argument('as_of', type=inputs.datetime_from_iso8601,
+	location='args')
+
+class StockAPI(Resource):
+	decorators = [login_required]
+	@marshal_with(stock)
+	def get(self, component_id=None):
+		as_of = stock_parser.parse_args().get('as_of') or \
+			datetime.datetime.utcnow()
+		# ledger timestamps are stored as naive UTC
+		if as_of.utcoffset() is not None:
+			as_of = as_of.replace(tzinfo=None) - as_of.utcoffset()
+		if component_id:
+			if not Component.query.get(component_id):
+				abort(404)
+			return {'component_id': component_id, 'as_of': as_of,
+				'qty': StockSnapshot.qty_at(component_id, as_of)}
+		quantities = StockSnapshot.quantities_at(as_of)
+		return [{'component_id': component_id, 'as_of': as_of, 'qty': qty}
+			for component_id, qty in sorted(quantities.items())]
+
+class BulkTransactionsAPI(Resource):
+	"""Checks a batch of {component_id, qty, notes} lines in or out.
+
+	The batch is all-or-nothing: every line is validated against the stock
+	levels fetched in one query, the ledger rows go in with one bulk insert
+	and the whole batch is committed once.
+	"""
+	decorators = [login_required]
+	def post(self, action):
+		lines = request.get_json(silent=True)
+		if not isinstance(lines, list) or not lines:
+			return {'message': 'Expected a JSON array of transactions'}, 400
+		sign = -1 if action == 'check-out' else 1
+		errors = []
+		valid = []
+		for index, line in enumerate(lines):
+			error = validate_transaction_line(line)
+			if error:
+				errors.append({'line': index, 'error': error})
+			else:
+				valid.append((index, line))
+		component_ids = set(line['component_id'] for index, line in valid)
+		available = dict(db.session.query(
+			Component.id, db.func.coalesce(StockLevel.qty, 0))
+			.outerjoin(StockLevel, StockLevel.component_id == Component.id)
+			.filter(Component.id.in_(component_ids))) if component_ids else {}
+		deltas = {}
+		for index, line in valid:
+			component_id = line['component_id']
+			if component_id not in available:
+				errors.append({'line': index, 'component_id': component_id,
+					'error': 'Component not found'})
+				continue
+			qty = line['qty'] * sign
+			balance = available[component_id] + deltas.get(component_id, 0)
+			if balance + qty < 0:
+				errors.append({'line': index, 'component_id': component_id,
+					'error': 'Not enough items, only %s available' % balance})
+				# later lines are checked as if this one was left out
+				continue
+			deltas[component_id] = deltas.get(component_id, 0) + qty
+		if errors:
+			return {'errors': sorted(errors, key=lambda e: e['line'])}, 400
+		now = datetime.datetime.utcnow()
+		db.session.execute(Transaction.__table__.insert(), [
+			{'component_id': line['component_id'], 'qty': line['qty'] * sign,
+			 'notes': line.get('notes'), 'user_id': current_user.get_id(),
+			 'date_create': now, 'date_modified': now}
+			for index, line in valid])
+		connection = db.session.connection()
+		try:
+			for component_id, delta in sorted(deltas.items()):
+				StockLevel.adjust(connection, component_id, delta, guard=True)
+		except InsufficientStock as e:
+			db.session.rollback()
+			return {'errors': [{'component_id': e.component_id,
+				'error': str(e)}]}, 409
+		db.session.commit()
+		return {'created': len(valid)}, 201
 
+search_parser = reqparse.RequestParser()
+search_parser.add_argument('q', type=six.text_type, required=True,
+	location='args')
+search_parser.add_argument('limit', type=inputs.int_range(1, 100), default=20,
+	location='args')
+
+class TransactionSearchAPI(Resource):
+	"""Ledger entries whose notes match q, best match first."""
+	decorators = [login_required]
+	@marshal_with(ledger_entry)
+	def get(self):
+		args = search_parser.parse_args()
+		return notes_index().ranked(Transaction.query, args['q']) \
+			.limit(args['limit']).all()
+
+def component_fields(names):
+	"""The item marshal narrowed to a comma separated list of names."""
+	if not names:
+		return item
+	names = [name.strip() for name in names.split(',') if name.strip()]
+	unknown = [name for name in names if name not in item]
+	if unknown:
+		abort(400, message='Unknown fields: %s' % ', '.join(unknown))
+	return OrderedDict((name, item[name]) for name in names)
+
+def component_query(fields):
+	options = []
+	if 'tags' in fields:
+		# the tag marshal renders repr(tag), which lists its categories
+		options.append(db.subqueryload('tags').subqueryload('categories'))
+	if 'pictures' in fields:
+		options.append(db.subqueryload('pictures'))
+	if 'qty' not in fields:
+		options.append(db.lazyload('stock'))
+	return Component.query.options(*options).order_by(Component.id)
+
+def iter_components(query, fields):
+	if 'tags' not in fields and 'pictures' not in fields:
+		return query.yield_per(STREAM_CHUNK)
+	return iter_component_chunks(query)
+
+def iter_component_chunks(query):
+	# yield_per can't be combined with collection eager loads, so walk
+	# the ids in chunks that each load their collections in one go
+	last_id = 0
+	while True:
+		chunk = query.filter(Component.id > last_id).limit(STREAM_CHUNK).all()
+		for component in chunk:
+			yield component
+		if len(chunk) < STREAM_CHUNK:
+			return
+		last_id = chunk[-1].id
+
+def stream_components(query, fields, limit=None):
+	"""Writes the components as a JSON array without holding them all."""
+	def generate():
+		yield '['
+		components = iter_components(query, fields)
+		for index, component in enumerate(
+				itertools.islice(components, limit)):
+			yield (',' if index else '') + json.dumps(marshal(component, fields))
+		yield ']'
+	return Response(stream_with_context(generate()),
+		mimetype='application/json')
+
+def parse_bulk_tags(body):
+	"""Returns (component_ids, [(tag, category)], error) for a bulk body."""
+	if not isinstance(body, dict):
+		return None, None, 'Expected a JSON object'
+	component_ids = body.get('component_ids')
+	if not isinstance(component_ids, list) or not component_ids or \
+			not all(is_integer(i) for i in component_ids):
+		return None, None, 'component_ids must be a list of integers'
+	tags = body.get('tags')
+	if not isinstance(tags, list) or not tags:
+		return None, None, 'tags must be a non-empty list'
+	pairs = []
+	max_length = Tag.name.type.length
+	for tag in tags:
+		if isinstance(tag, dict):
+			tag, cat = tag.get('tag'), tag.get('category')
+		else:
+			cat = None
+		for name in ([tag] if cat is None else [tag, cat]):
+			if not isinstance(name, six.string_types) or \
+					not name.strip() or len(name.strip()) > max_length:
+				return None, None, \
+					'tag names must be 1 to %s characters' % max_length
+		pairs.append((tag, cat))
+	return set(component_ids), pairs, None
+
+def is_integer(value):
+	return isinstance(value, six.integer_types) and not isinstance(value, bool)
+
+def validate_transaction_line(line):
+	if not isinstance(line, dict):
+		return 'Expected an object'
+	if not is_integer(line.get('component_id')):
+		return 'component_id must be an integer'
+	if not is_integer(line.get('qty')) or line['qty'] <= 0:
+		return 'qty must be a positive integer'
+	notes = line.get('notes')
+	max_length = Transaction.notes.type.length
+	if notes is not None and (not isinstance(notes, six.string_types) or
+			len(notes) > max_length):
+		return 'notes must be a string of at most %s characters' % max_length
+	return None
+
+import_parser = reqparse.RequestParser()
+import_parser.add_argument('format', choices=FORMATS, location='args')
+import_parser.add_argument('source', type=str, location='args')
+import_parser.add_argument('chunk_size', type=inputs.int_range(1, 10000),
+	location='args')
+
+class ImportAPI(Resource):
+	"""Bulk loads components or vendor components from a CSV or JSONL body.
+
+	The body is parsed as it streams in (?format=csv or jsonl, else taken
+	from the Content-Type). Rows are checked and inserted in chunks of
+	?chunk_size; rejected rows are reported and skipped. Sending the same
+	?source again after a failure resumes after the last committed chunk.
+	"""
+	decorators = [login_required]
+	def post(self, kind):
+		args = import_parser.parse_args()
+		format = args['format'] or \
+			('jsonl' if 'json' in (request.mimetype or '') else 'csv')
+		chunk_size = args['chunk_size'] or \
+			current_app.config['IMPORT_CHUNK_SIZE']
+		run, rejected = import_stream(kind, request.stream, format,
+			args['source'], chunk_size)
+		return {'run': marshal(run, import_run), 'rejected': rejected}
 
 class PicturesAPI(Resource):
 	decorators = [login_required]
 	
-	parse = reqparse.RequestParser()
-	parse.add_argument('picture_file', type=FileStorage, location='files')
 	@marshal_with(picture)
 	def get(self, component_id=None):
 		if component_id:
@@ -118,43 +433,51 @@ class PicturesAPI(Resource):
 		# 	setattr(t,'__repr__',str(t))
 		return pictures
 	
-	@marshal_with(picture)
 	def post(self, component_id=None):
-		args = self.parse.parse_args()
-		if component_id:
-			comp = Component.query.get(component_id)
-			print("args")
-			print(args)
-			if comp:
-				picture = args['picture_file']
-				if picture.filename:
-					new_picture = Picture()
-					filename = secure_filename(picture.filename)
-					new_picture.filename = filename
-					comp.pictures.append(new_picture)
-					db.session.flush()
-					new_picture.filename = str(new_picture.id).zfill(5)+new_picture.filename
-					picture.save(os.path.join(current_app.config['PICTURES_FOLDER'], new_picture.filename))
-					im = Image.open(os.path.join(current_app.config['PICTURES_FOLDER'], new_picture.filename))
-					# if image is square and greater than 900
-					if im.size[0] == im.size[1] and im.size[0] > 900:
-						im.reize(900,900)
-						im.save(os.path.join(current_app.config['PICTURES_FOLDER'], new_picture.filename))
-					# if height > 900
-					elif im.size[1] > 900:
-						# get percentage coefficient
-						coeff = float(900) / float(im.size[1])
-						x, y  = int(float(im.size[0]) * float(coeff)), int(float(im.size[1]) * float(coeff))
-						im = im.resize((x,y))
-						im.save(os.path.join(current_app.config['PICTURES_FOLDER'], new_picture.filename))
-					# Make thumbnail 
-					coeff = float(200) / float(im.size[1])
-					x, y  = int(float(im.size[0]) * float(coeff)), int(float(im.size[1]) * float(coeff))
-					im = im.resize((x,y))
-					im.save(os.path.join(current_app.config['PICTURES_FOLDER'], 'thumbnail_'+new_picture.filename))
-					db.session.commit()
-					return Picture.query.all()
-		return []
+		"""Stores the upload and queues its renditions.
+
+		Answers 202 right away; the picture stays "processing" until a
+		worker (manage.py process_pictures) has resized it, which the job
+		resource in the Location header reports. An upload identical to a
+		stored picture just links that picture and answers 200 without a
+		job.
+
+		The body is streamed straight to disk; uploads that are too large
+		or not an allowed image type are refused before all of it arrived.
+		"""
+		comp = Component.query.get(component_id) if component_id else None
+		if not comp:
+			return {'message': 'Component not found'}, 404
+		config = current_app.config
+		try:
+			received = uploads.receive(request.environ, 'picture_file',
+				config['PICTURES_FOLDER'], config['PICTURE_MAX_SIZE'],
+				config['ALLOWED_EXTENSIONS'])
+		except uploads.UploadRejected as e:
+			return {'message': str(e)}, e.status
+		if received is None:
+			return {'message': 'No picture_file uploaded'}, 400
+		digest, filename = received
+		existing = Picture.query.filter_by(content_hash=digest).first()
+		if existing is None:
+			new_picture = Picture(filename=filename, content_hash=digest)
+			comp.pictures.append(new_picture)
+			job = PictureJob.enqueue(new_picture)
+			try:
+				db.session.commit()
+			except IntegrityError:
+				# the same content uploaded concurrently got in first
+				db.session.rollback()
+				existing = Picture.query.filter_by(content_hash=digest).one()
+				comp = Component.query.get(component_id)
+			else:
+				return {'picture': marshal(new_picture, picture),
+					'job': marshal(job, picture_job)}, 202, \
+					{'Location': api.url_for(PictureJobAPI, job_id=job.id)}
+		if existing not in comp.pictures:
+			comp.pictures.append(existing)
+			db.session.commit()
+		return {'picture': marshal(existing, picture), 'job': None}, 200
 
 	def delete(self, component_id, picture_id=None):
 		comp = Component.query.get(component_id)
@@ -176,15 +499,34 @@ class PicturesAPI(Resource):
 		db.session.commit()
 		return ([], 200)
 
+class PictureJobAPI(Resource):
+	decorators = [login_required]
+	@marshal_with(picture_job)
+	def get(self, job_id):
+		job = PictureJob.query.get(job_id)
+		if not job:
+			abort(404)
+		return job
+
 api.add_resource(ComponentsAPI, '/components','/components/<int:component_id>')
+api.add_resource(ComponentSearchAPI, '/components/search')
+api.add_resource(BulkComponentTagsAPI, '/component-tags/bulk')
 api.add_resource(ComponentTagsAPI, '/component-tags/<int:component_id>', '/component-tags/<int:component_id>/<int:tag_id>')
 # api.add_resource(ComponentTagsAPI, '/component-tags/<int:component_id>/<int:tag_id>')
 api.add_resource(SingleTagsAPI, '/single-tags')
 api.add_resource(CategoriesAPI, '/categories')
 api.add_resource(TagAPI, '/tag/<int:tag_id>')
+api.add_resource(CacheStatsAPI, '/cache-stats')
+api.add_resource(StockAPI, '/stock', '/stock/<int:component_id>')
+api.add_resource(BulkTransactionsAPI,
+	'/transactions/<any("check-in", "check-out"):action>')
+api.add_resource(TransactionSearchAPI, '/transactions/search')
 
 # pictures
 api.add_resource(PicturesAPI, '/pictures',
 	'/pictures/<int:component_id>',
 	'/pictures/delete/<int:component_id>/<int:picture_id>',
 	'/pictures/put/<int:component_id>/<int:picture_id>')
+api.add_resource(PictureJobAPI, '/picture-jobs/<int:job_id>')
+api.add_resource(ImportAPI,
+	'/import/<any("components", "vendor-components"):kind>')
@@ -4,7 +4,8 @@
 from flask_wtf import FlaskForm as Form
 
 from wtforms import TextField, SelectField, IntegerField, SubmitField, HiddenField
-from wtforms.validators import DataRequired, URL, Optional, ValidationError
+from wtforms.validators import DataRequired, NumberRange, URL, Optional, \
+    ValidationError
 from ..models import Component
 
 
@@ -54,7 +55,8 @@ class ComponentCreateForm(Form):
 
 class TransactionForm(Form):
     component = SelectField("Item", validators=[DataRequired()], coerce=int)
-    qty = IntegerField('Quantity', validators=[DataRequired()])
+    qty = IntegerField('Quantity', validators=[DataRequired(),
+                                               NumberRange(min=1)])
     notes = TextField('Notes', validators=[DataRequired()])
     user_id = HiddenField('user_id', validators=[DataRequired()])
     checkin = SubmitField("Check In")
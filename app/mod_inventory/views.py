@@ -3,16 +3,23 @@
 #################
 #    imports    #
 #################
+import csv
 import datetime
+from io import BytesIO, StringIO
+
+import six
 from flask import render_template, Blueprint, url_for, \
-    redirect, flash, request
+    redirect, flash, request, abort, Response, stream_with_context
 
 from flask.views import View
 
 from flask_login import login_required
 
 from ..models import db, Vendor, PurchaseOrder, LineItem, Component, Address,\
-    Transaction, TagCategory, Tag, VendorComponent, TagManager
+    Transaction, TagCategory, Tag, VendorComponent, TagManager, \
+    InsufficientStock, User
+from ..search import notes_index
+from ..pagination import KeysetPage, InvalidCursor, cached_count
 
 from forms import VendorCreateForm, PurchaseOrderForm, \
     ComponentCreateForm, TransactionForm, TagForm
@@ -25,6 +32,13 @@ inventory_blueprint = Blueprint('inventory',
                                 __name__,
                                 template_folder='templates')
 
+PER_PAGE = 20
+EXPORT_BATCH = 1000
+EXPORT_COLUMNS = ('id', 'date', 'sku', 'qty', 'notes', 'user')
+PERIODS = ('month', 'ten_days', 'today', 'all')
+# spreadsheets run text starting with these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
 ################
 #    views     #
 ################
@@ -45,34 +59,23 @@ class TransactionMakerView(View):
 
     def dispatch_request(self):
         form = TransactionForm(request.form)
-        form.component.choices = [(x.id, x.description)
-                                  for x in Component.query.all()]
+        form.component.choices = db.session.query(
+            Component.id, Component.description).all()
         if form.validate_on_submit():
-            nt = Transaction()
-            form.component.data = Component.query.get(form.component.data)
-            nt.date_create = datetime.datetime.now()
-            if request.form.get("checkout"):
-                void = form.qty.data * (-1)
-                if form.component.data.qty + void >= 0:
-                    form.populate_obj(nt)
-                    nt.component_id = form.component.data.id
-                    nt.qty = void
-                    db.session.add(nt)
-                    db.session.commit()
+            try:
+                if request.form.get("checkout"):
+                    Transaction.record(form.component.data, form.qty.data * (-1),
+                                       form.user_id.data, form.notes.data)
                     flash('Success: Items Checked Out')
-                else:
-                    flash("Not enough items, only %s available" %
-                          (form.component.data.qty))
-                    form.component.data = form.component.data.id
-                    return render_template("/inventory/transaction/make.html", form=form, the_action=self.action_type)
-            elif request.form.get("checkin"):
-                form.populate_obj(nt)
-                nt.component_id = form.component.data.id
-                nt.qty = form.qty.data
-                db.session.add(nt)
-                db.session.commit()
-                flash('Success: %s Checked In' %
-                      ("Items" if nt.qty > 1 else "Item"))
+                elif request.form.get("checkin"):
+                    Transaction.record(form.component.data, form.qty.data,
+                                       form.user_id.data, form.notes.data)
+                    flash('Success: %s Checked In' %
+                          ("Items" if form.qty.data > 1 else "Item"))
+            except InsufficientStock as e:
+                flash("Not enough items, only %s available" %
+                      (e.available))
+                return render_template("/inventory/transaction/make.html", form=form, the_action=self.action_type)
             return redirect(url_for('main.home'))
         return render_template("/inventory/transaction/make.html",
                                form=form, the_action=self.action_type)
@@ -83,34 +86,108 @@ class TransactionMakerView(View):
 @inventory_blueprint.route('/transactions/', methods=['GET'])
 @login_required
 def transactions():
-    page = request.args.get("page", 1)
-    if page==u"":
-        page=1
-    else:
-        page = int(page)
     period = request.args.get("period", None)
     search = request.args.get("search")
-    query = Transaction.query.order_by(Transaction.date_create.desc())
-    if search and search !="":
-        period="all"
-        query = query.filter(Transaction.notes.contains(search))
+    query, period = filter_transactions(
+        Transaction.query.options(db.joinedload('component'),
+                                  db.joinedload('user')),
+        period, search)
+    try:
+        page = KeysetPage(query, Transaction.date_create, Transaction.id,
+                          per_page=PER_PAGE,
+                          after=request.args.get("after") or None,
+                          before=request.args.get("before") or None)
+    except InvalidCursor:
+        abort(400)
+    total = cached_count(('transactions', period, search),
+                         filter_transactions(
+                             db.session.query(Transaction.id),
+                             period, search)[0])
+    return render_template("/inventory/transaction/transactions.html",
+                           transactions=page, total=total, period=period,
+                           search=search)
+
+
+@inventory_blueprint.route('/transactions/export.csv', methods=['GET'])
+@login_required
+def export_transactions():
+    """The ledger as filtered on /transactions/, as a CSV download.
+
+    Rows come off a server-side cursor a batch at a time and are written
+    out as they arrive, so a worker holds one batch whatever the size of
+    the ledger; SKU and email are joined in rather than loaded per row.
+    """
+    period = request.args.get("period", None)
+    search = request.args.get("search")
+    query, period = filter_transactions(
+        db.session.query(Transaction.id, Transaction.date_create,
+                         Component.sku, Transaction.qty, Transaction.notes,
+                         User.email)
+        .join(Component, Component.id == Transaction.component_id)
+        .join(User, User.id == Transaction.user_id),
+        period, search)
+    query = query.order_by(Transaction.date_create.desc(),
+                           Transaction.id.desc()).yield_per(EXPORT_BATCH)
+    filename = 'transactions-%s.csv' % period
+    return Response(stream_with_context(ledger_csv(query)),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition':
+                             'attachment; filename="%s"' % filename})
+
+
+def ledger_csv(rows):
+    """Yields the CSV text of rows, a batch at a time."""
+    buffer = BytesIO() if six.PY2 else StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([csv_cell(value) for value in row])
+        if count % EXPORT_BATCH == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, six.string_types) and \
+            value.startswith(FORMULA_PREFIXES):
+        value = "'" + value
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def filter_transactions(query, period=None, search=None):
+    """Apply the ledger view's search and period filters to query.
+
+    Returns the filtered query and the period actually applied; a search
+    always spans the whole ledger, as does a period that is not in PERIODS.
+    """
+    if search:
+        period = "all"
+        query = notes_index().match(query, search)
+    elif period not in PERIODS:
+        period = "all"
     if period == 'ten_days':
-        period_date = datetime.datetime.now()
+        period_date = datetime.datetime.utcnow()
         time_delta = datetime.timedelta(days=-10)
         period_date = period_date + time_delta
         query = query.filter(Transaction.date_create > period_date)
     elif period == 'today':
-        period_date = datetime.datetime.now()
+        period_date = datetime.datetime.utcnow()
         period_date = period_date.replace(hour=0, minute=0)
         query = query.filter(Transaction.date_create > period_date)
     elif period == 'month':
-        period_date = datetime.date.today()
+        period_date = datetime.datetime.utcnow().date()
         period_date = period_date.replace(day=1)
         period_date = datetime.datetime.combine(period_date, datetime.datetime.min.time())
         query = query.filter(Transaction.date_create > period_date)
-    transactions = query.paginate(page, per_page=20, error_out=True)
-    return render_template("/inventory/transaction/transactions.html",
-                           transactions=transactions, page=page, period=period, search=search)
+    return query, period
 
 
 inventory_blueprint.add_url_rule(
@@ -130,13 +207,23 @@ inventory_blueprint.add_url_rule(
 @inventory_blueprint.route('/inventory/vendor/', methods=['GET'])
 @login_required
 def view_vendor(vendor_id=None):
+    page = request.args.get('page', 1, type=int)
     if vendor_id:
-        vendor = Vendor.query.get_or_404(vendor_id)
-        orders = PurchaseOrder.query.filter_by(vendor_id=vendor.id)
+        vendor = Vendor.query.options(db.joinedload('address'))\
+            .filter_by(id=vendor_id).first_or_404()
+        # the vendor is already loaded, so skip the joined load per order
+        orders = sort_purchase_orders(
+            PurchaseOrder.query.filter_by(vendor_id=vendor.id)
+            .options(db.lazyload(PurchaseOrder.vendor)))\
+            .paginate(page, per_page=PER_PAGE)
         return render_template('inventory/vendor/view.html', vendor=vendor,
-                               purchase_orders=orders)
-    vendors = Vendor.query.all()
-    return render_template('inventory/vendor/view_all.html', entries=vendors)
+                               purchase_orders=orders.items,
+                               pagination=orders,
+                               sort=request.args.get('sort'))
+    vendors = Vendor.query.options(db.joinedload('address'))\
+        .order_by(Vendor.id).paginate(page, per_page=PER_PAGE)
+    return render_template('inventory/vendor/view_all.html',
+                           entries=vendors.items, pagination=vendors)
 
 
 @inventory_blueprint.route('/inventory/vendor/create', methods=['GET', 'POST'])
@@ -188,6 +275,28 @@ def edit_vendor(vendor_id):
 #    Purchase Orders    #
 #########################
 
+PURCHASE_ORDER_SORTS = {
+    'id': PurchaseOrder.id,
+    'created_on': PurchaseOrder.created_on,
+    'total': PurchaseOrder.cached_total,
+}
+
+
+def sort_purchase_orders(query):
+    """Applies the ?sort= and ?min_total= arguments to an order query.
+
+    ``sort`` is one of PURCHASE_ORDER_SORTS, prefixed with '-' for
+    descending.  Totals come from the denormalized cached_total column,
+    so neither sorting nor filtering loads any line items.
+    """
+    sort = request.args.get('sort', 'id')
+    column = PURCHASE_ORDER_SORTS.get(sort.lstrip('-'), PurchaseOrder.id)
+    query = query.order_by(column.desc() if sort.startswith('-') else column)
+    min_total = request.args.get('min_total', type=float)
+    if min_total is not None:
+        query = query.filter(PurchaseOrder.cached_total >= min_total)
+    return query
+
 
 @inventory_blueprint.route('/purchase_order/')
 @inventory_blueprint.route('/purchase_order/<int:po_id>',
@@ -195,12 +304,25 @@ def edit_vendor(vendor_id):
 @login_required
 def view_purchase_order(po_id=None):
     if po_id:
-        order = PurchaseOrder.query.get_or_404(po_id)
+        order = PurchaseOrder.query.options(
+            db.joinedload('vendor').joinedload('address'),
+            db.subqueryload('line_item').joinedload('vendor_component'),
+            db.defaultload('line_item').lazyload('purchase_order'))\
+            .filter_by(id=po_id).first_or_404()
         return render_template('inventory/purchase_order/view.html',
                                result=order)
-    purchase_orders = PurchaseOrder.query.all()
+    page = request.args.get('page', 1, type=int)
+    purchase_orders = sort_purchase_orders(
+        PurchaseOrder.query
+        .join(PurchaseOrder.vendor).join(PurchaseOrder.user)
+        .options(db.contains_eager(PurchaseOrder.vendor),
+                 db.contains_eager(PurchaseOrder.user).lazyload('*')))\
+        .paginate(page, per_page=PER_PAGE)
     return render_template('inventory/purchase_order/view_all.html',
-                           result=purchase_orders)
+                           result=purchase_orders.items,
+                           pagination=purchase_orders,
+                           sort=request.args.get('sort'),
+                           min_total=request.args.get('min_total'))
 
 
 @inventory_blueprint.route('/purchase_order/create/<int:vendor_id>',
@@ -214,7 +336,7 @@ def create_purchase_order(vendor_id):
     if form.validate_on_submit():
         with db.session.no_autoflush:
             order = PurchaseOrder()
-            order.created_on = datetime.date.today()
+            order.created_on = datetime.datetime.utcnow().date()
             order.vendor = vendor
             order.user_id = form.user_id.data
             db.session.add(order)
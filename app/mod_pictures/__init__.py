@@ -0,0 +1 @@
+# app/mod_pictures/__init__.py
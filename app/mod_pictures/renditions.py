@@ -0,0 +1,144 @@
+# app/mod_pictures/renditions.py
+
+
+#################
+#### imports ####
+#################
+
+import os
+import shutil
+
+from PIL import Image
+
+
+################
+#### config ####
+################
+
+EXIF_ORIENTATION = 0x0112
+
+# EXIF orientation -> transposes that bring the pixels upright
+ORIENTATIONS = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
+    6: (Image.ROTATE_270,),
+    7: (Image.ROTATE_270, Image.FLIP_TOP_BOTTOM),
+    8: (Image.ROTATE_90,),
+}
+
+
+#################
+#### helpers ####
+#################
+
+def orientation(im):
+    try:
+        exif = im._getexif() or {}
+    except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+        return 1
+    return exif.get(EXIF_ORIENTATION, 1)
+
+
+def scaled(size, height):
+    """size scaled down to height, or size when it is not taller."""
+    width, current = size
+    if current <= height:
+        return size
+    return max(1, int(round(float(width) * height / current))), height
+
+
+def save(im, dest, image_format, quality=75, progressive=False):
+    """Writes im to dest through a temp file renamed into place, so
+    readers never see half a file. Returns the bytes written."""
+    options = {}
+    if image_format == 'JPEG':
+        if im.mode not in ('RGB', 'L'):
+            im = im.convert('RGB')
+        options = dict(quality=quality, progressive=progressive)
+    elif image_format == 'WEBP':
+        options = dict(quality=quality, method=4)
+    tmp = dest + '.tmp'
+    im.save(tmp, format=image_format, **options)
+    os.rename(tmp, dest)
+    return os.path.getsize(dest)
+
+
+def link(source, dest):
+    """Puts a copy of source at dest, as a hard link where the filesystem
+    has them, through a temp file renamed into place. Returns the bytes."""
+    tmp = dest + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, tmp)
+    os.rename(tmp, dest)
+    return os.path.getsize(dest)
+
+
+def webp_supported():
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def render_all(source, folder, filename, renditions, quality=75,
+               progressive=False, webp=False, resample=Image.BILINEAR):
+    """Makes every rendition of source with a single decode.
+
+    renditions is a sequence of (filename prefix, maximum height); each is
+    written to prefix + filename in folder and never to source itself,
+    which stays as uploaded. JPEGs
+    are decoded in draft mode straight at the smallest scale that still
+    covers the largest rendition; each smaller rendition is scaled from the
+    previous one. Pixels are turned upright according to the EXIF
+    orientation. A rendition that would come out the same as the upload
+    is linked to it rather than encoded again. With webp a .webp copy of
+    every rendition is written too. Returns {path: bytes written}.
+    """
+    for prefix, height in renditions:
+        if os.path.abspath(os.path.join(folder, prefix + filename)) == \
+                os.path.abspath(source):
+            raise ValueError('rendition %r would overwrite its source' %
+                             prefix)
+    im = original = Image.open(source)
+    image_format = im.format
+    turn = ORIENTATIONS.get(orientation(im), ())
+    renditions = sorted(renditions, key=lambda r: r[1], reverse=True)
+    largest = renditions[0][1]
+    # the stored pixels are sideways for orientations 5 to 8
+    stored_width, stored_height = im.size
+    sideways = bool(turn) and turn[0] in (Image.ROTATE_90, Image.ROTATE_270)
+    upright = (stored_height, stored_width) if sideways else im.size
+    target = scaled(upright, largest)
+    if sideways:
+        target = target[1], target[0]
+    if image_format == 'JPEG':
+        im.draft(im.mode, target)
+    im.load()
+    for method in turn:
+        im = im.transpose(method)
+    webp = webp and webp_supported()
+    written = {}
+    # an upload already upright, small enough and encoded as asked for
+    # is kept as it is; one the draft decoded smaller is not small enough
+    untouched = not turn and \
+        im.size == (stored_width, stored_height) and \
+        original.info.get('progressive', 0) == \
+        (progressive if image_format == 'JPEG' else 0)
+    for prefix, height in renditions:
+        size = scaled(im.size, height)
+        if size != im.size:
+            im = im.resize(size, resample)
+            untouched = False
+        dest = os.path.join(folder, prefix + filename)
+        if untouched:
+            written[dest] = link(source, dest)
+        else:
+            written[dest] = save(im, dest, image_format, quality, progressive)
+        if webp:
+            written[dest + '.webp'] = save(im, dest + '.webp', 'WEBP',
+                                           quality)
+    return written
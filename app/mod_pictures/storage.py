@@ -0,0 +1,208 @@
+# app/mod_pictures/storage.py
+
+
+#################
+#### imports ####
+#################
+
+import errno
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from ..models import db, Picture, PictureJob, components_pictures, \
+    touch_tables
+
+
+################
+#### config ####
+################
+
+CHUNK_SIZE = 64 * 1024
+
+SHARD = re.compile(r'^[0-9a-f]{2}$')
+# what a blob or one of its renditions is called inside a shard
+BLOB_NAME = re.compile(r'^(?P<prefix>.*?)(?P<digest>[0-9a-f]{64})'
+                       r'(?P<extension>\.[a-z0-9]+)?(\.webp)?$')
+
+
+#################
+#### helpers ####
+#################
+
+def blob_name(digest, extension=''):
+    """Where the blob for digest lives, relative to the pictures folder:
+    two levels of shards keep every directory small."""
+    return '/'.join((digest[:2], digest[2:4], digest + extension.lower()))
+
+
+def blob_path(folder, name):
+    return os.path.join(folder, *name.split('/'))
+
+
+def rendition_names(name, prefixes):
+    """Every file the renditions of blob name may be written to."""
+    directory, base = name.rsplit('/', 1) if '/' in name else ('', name)
+    names = []
+    for prefix in prefixes:
+        rendition = prefix + base
+        if directory:
+            rendition = directory + '/' + rendition
+        names.extend((rendition, rendition + '.webp'))
+    return names
+
+
+def blob_files(name, prefixes):
+    """Blob name and every file its renditions may be written to."""
+    return [name] + rendition_names(name, prefixes)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def place(tmp, folder, name):
+    """Renames the finished file tmp into blob name, or drops it when the
+    blob is already stored. A stored blob is touched, since it may be an
+    orphan collect() would otherwise remove before its new picture
+    commits."""
+    dest = blob_path(folder, name)
+    _makedirs(os.path.dirname(dest))
+    if os.path.exists(dest):
+        try:
+            os.utime(dest, None)
+        except OSError:
+            # collected in the meantime
+            os.rename(tmp, dest)
+        else:
+            os.remove(tmp)
+    else:
+        os.rename(tmp, dest)
+
+
+def store(stream, folder, extension=''):
+    """Copies stream into the blob named after its SHA-256, hashing while it
+    writes. Content already stored is not written twice. Returns (digest,
+    blob name)."""
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        name = blob_name(digest.hexdigest(), extension)
+        place(tmp, folder, name)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return digest.hexdigest(), name
+
+
+def _link(source, dest):
+    _makedirs(os.path.dirname(dest))
+    if os.path.exists(dest):
+        return
+    try:
+        os.link(source, dest)
+    except (AttributeError, OSError):
+        shutil.copy2(source, dest)
+
+
+def _merge(picture, keeper):
+    """Points the components of picture at keeper, then deletes picture."""
+    table = components_pictures
+    linked = db.select([table.c.component_id]) \
+        .where(table.c.picture_id == keeper.id)
+    db.session.execute(table.update().where(db.and_(
+        table.c.picture_id == picture.id,
+        ~table.c.component_id.in_(linked))).values(picture_id=keeper.id))
+    db.session.execute(table.delete().where(
+        table.c.picture_id == picture.id))
+    PictureJob.query.filter_by(picture_id=picture.id) \
+        .delete(synchronize_session=False)
+    touch_tables(db.session, 'component')
+    db.session.expire(picture, ['components', 'component'])
+    db.session.delete(picture)
+
+
+def migrate(folder, prefixes):
+    """Moves pictures still stored under their upload name into blobs.
+
+    Pictures whose files are identical are merged into the oldest one. The
+    blob is linked in and committed before the old files are removed, so an
+    interrupted run can simply be started again. Returns (moved, merged,
+    missing) picture counts.
+    """
+    moved = merged = missing = 0
+    pending = Picture.query.filter(Picture.content_hash == None) \
+        .order_by(Picture.id).all()
+    for picture in pending:
+        old = picture.filename
+        if not os.path.exists(blob_path(folder, old)):
+            missing += 1
+            continue
+        digest = hash_file(blob_path(folder, old))
+        keeper = Picture.query.filter_by(content_hash=digest).first()
+        if keeper is None:
+            name = blob_name(digest, os.path.splitext(old)[1])
+            for source, dest in zip(blob_files(old, prefixes),
+                                    blob_files(name, prefixes)):
+                if os.path.exists(blob_path(folder, source)):
+                    _link(blob_path(folder, source), blob_path(folder, dest))
+            picture.filename = name
+            picture.content_hash = digest
+            moved += 1
+        else:
+            _merge(picture, keeper)
+            merged += 1
+        db.session.commit()
+        for stale in blob_files(old, prefixes):
+            if os.path.exists(blob_path(folder, stale)):
+                os.remove(blob_path(folder, stale))
+    return moved, merged, missing
+
+
+def collect(folder, prefixes, grace=3600):
+    """Deletes blobs and renditions no picture references. Files younger
+    than grace seconds are spared, as their picture may not be committed
+    yet. Returns the names removed."""
+    keep = set()
+    for name, in db.session.query(Picture.filename):
+        keep.update(blob_files(name, prefixes))
+    cutoff = time.time() - grace
+    removed = []
+    # empty shards are left in place: an upload may be renaming into one
+    for top in sorted(os.listdir(folder)):
+        if not SHARD.match(top) or \
+                not os.path.isdir(os.path.join(folder, top)):
+            continue
+        for shard in sorted(os.listdir(os.path.join(folder, top))):
+            directory = os.path.join(folder, top, shard)
+            if not SHARD.match(shard) or not os.path.isdir(directory):
+                continue
+            for base in sorted(os.listdir(directory)):
+                name = '/'.join((top, shard, base))
+                path = os.path.join(directory, base)
+                if name in keep or not BLOB_NAME.match(base) or \
+                        os.path.getmtime(path) > cutoff:
+                    continue
+                os.remove(path)
+                removed.append(name)
+    return removed
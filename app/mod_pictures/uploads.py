@@ -0,0 +1,154 @@
+# app/mod_pictures/uploads.py
+
+
+#################
+#### imports ####
+#################
+
+import hashlib
+import os
+import re
+import tempfile
+
+from io import BytesIO
+
+from werkzeug.formparser import parse_form_data
+from werkzeug.wsgi import get_content_length
+
+from .storage import blob_name, place
+
+
+################
+#### config ####
+################
+
+# leading bytes of the image types we store, and the extension they get
+SIGNATURES = (
+    (re.compile(br'\A\xff\xd8\xff'), 'jpg'),
+    (re.compile(br'\A\x89PNG\r\n\x1a\n'), 'png'),
+    (re.compile(br'\AGIF8[79]a'), 'gif'),
+    (re.compile(br'\ARIFF.{4}WEBP', re.S), 'webp'),
+)
+SNIFF_BYTES = 12
+# room for the multipart boundaries and part headers around the file
+FORM_OVERHEAD = 16 * 1024
+EXTENSION_ALIASES = {'jpeg': 'jpg'}
+
+
+#################
+#### helpers ####
+#################
+
+class UploadRejected(Exception):
+    """Raised while an upload streams in, as soon as it is clear that it
+    cannot be stored."""
+
+    def __init__(self, message, status=400):
+        super(UploadRejected, self).__init__(message)
+        self.status = status
+
+
+def allowed_file(filename, extensions):
+    return '.' in filename and \
+        filename.rsplit('.', 1)[1].lower() in extensions
+
+
+def sniff(head):
+    """The extension matching the first bytes of a file, or None."""
+    for signature, extension in SIGNATURES:
+        if signature.match(head):
+            return extension
+    return None
+
+
+class BlobWriter(object):
+    """Where the form parser writes an uploaded file.
+
+    Chunks are hashed and written to a temp file in the pictures folder as
+    they arrive, so the upload is never held in memory and never copied
+    again. The type is checked from the first bytes and the size after
+    every chunk; either failing stops the parser then and there.
+    """
+
+    def __init__(self, folder, max_size, extensions):
+        self.folder = folder
+        self.max_size = max_size
+        self.extensions = set(EXTENSION_ALIASES.get(e, e) for e in extensions)
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.extension = None
+        fd, self.tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            self.discard()
+            raise UploadRejected('Pictures are limited to %d bytes' %
+                                 self.max_size, 413)
+        if self.extension is None:
+            self.head += chunk
+            if len(self.head) >= SNIFF_BYTES:
+                self._identify()
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def seek(self, offset, whence=0):
+        # the parser rewinds the file once its part is complete
+        self.file.flush()
+
+    def _identify(self):
+        self.extension = sniff(self.head)
+        self.head = b''
+        if self.extension not in self.extensions:
+            self.discard()
+            raise UploadRejected('Unsupported picture type', 415)
+
+    def commit(self):
+        """Moves the complete upload into its blob. Returns (digest, blob
+        name)."""
+        if self.extension is None:
+            self._identify()
+        self.file.close()
+        digest = self.digest.hexdigest()
+        name = blob_name(digest, '.' + self.extension)
+        place(self.tmp, self.folder, name)
+        return digest, name
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def receive(environ, field, folder, max_size, extensions):
+    """Parses a multipart request, streaming the file sent as field into a
+    blob in folder. Returns (digest, blob name), or None when no file was
+    sent; raises UploadRejected.
+    """
+    if (get_content_length(environ) or 0) > max_size + FORM_OVERHEAD:
+        raise UploadRejected('Pictures are limited to %d bytes' % max_size,
+                             413)
+    writers = []
+
+    def stream_factory(total_content_length, content_type, filename,
+                       content_length=None):
+        if not filename:
+            # a file input left empty
+            return BytesIO()
+        if not allowed_file(filename, extensions):
+            raise UploadRejected('Unsupported picture type', 415)
+        writers.append(BlobWriter(folder, max_size, extensions))
+        return writers[-1]
+
+    try:
+        stream, form, files = parse_form_data(environ,
+                                              stream_factory=stream_factory)
+        upload = files.get(field)
+        if upload is None or not isinstance(upload.stream, BlobWriter):
+            return None
+        return upload.stream.commit()
+    finally:
+        for writer in writers:
+            writer.discard()
@@ -0,0 +1,172 @@
+# app/mod_pictures/views.py
+
+
+#################
+#### imports ####
+#################
+
+import hashlib
+import mimetypes
+import os
+
+from flask import Blueprint, abort, current_app, redirect, request, \
+    url_for, safe_join
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+
+from .storage import BLOB_NAME, blob_path
+
+
+################
+#### config ####
+################
+
+pictures_blueprint = Blueprint('pictures', __name__, url_prefix='/pictures')
+
+# a fingerprinted URL never changes what it points at
+IMMUTABLE = 'public, max-age=31536000, immutable'
+CHUNK_SIZE = 64 * 1024
+
+
+#################
+#### helpers ####
+#################
+
+def rendition_settings():
+    config = current_app.config
+    return repr((config['PICTURE_RENDITIONS'], config['PICTURE_QUALITY'],
+                 config['PICTURE_PROGRESSIVE']))
+
+
+def file_fingerprint(path):
+    """Fingerprint of the picture file at path. Blobs are named after the
+    SHA-256 of the upload and never rewritten, so the content hash and the
+    file name settle it, the same on every server and after every copy.
+    Renditions are made again when their settings change, so theirs also
+    covers the settings and the size of the rendition itself. Files from
+    before content addressing fall back to their modification time and
+    size."""
+    base = os.path.basename(path)
+    match = BLOB_NAME.match(base)
+    if match:
+        key = '%s:%s' % (match.group('digest'), base)
+        if match.group('prefix'):
+            key += ':%d:%s' % (os.path.getsize(path), rendition_settings())
+    else:
+        stat = os.stat(path)
+        key = '%s:%d:%d' % (base, stat.st_mtime, stat.st_size)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def rendition(filename, prefix):
+    directory, base = os.path.split(filename)
+    return '/'.join(filter(None, (directory, prefix + base)))
+
+
+def picture_url(filename, prefix=''):
+    """Fingerprinted URL of a picture as uploaded, or of its rendition with
+    prefix. A rendition not made yet falls back to the picture itself."""
+    folder = current_app.config['PICTURES_FOLDER']
+    name = rendition(filename, prefix)
+    path = blob_path(folder, name)
+    if not os.path.isfile(path):
+        if not prefix:
+            return None
+        return picture_url(filename)
+    return url_for('pictures.serve', fingerprint=file_fingerprint(path),
+                   filename=name)
+
+
+def display_url(filename):
+    prefix, height = max(current_app.config['PICTURE_RENDITIONS'],
+                         key=lambda r: r[1])
+    return picture_url(filename, prefix)
+
+
+def thumbnail_url(filename):
+    prefix, height = min(current_app.config['PICTURE_RENDITIONS'],
+                         key=lambda r: r[1])
+    return picture_url(filename, prefix)
+
+
+def read_range(f, start, stop):
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+################
+#### routes ####
+################
+
+@pictures_blueprint.route('/<fingerprint>/<path:filename>')
+def serve(fingerprint, filename):
+    """Sends a picture for good: the URL carries a fingerprint of the file,
+    so browsers and proxies may keep it forever. With PICTURE_SENDFILE the
+    front-end server sends the bytes, ranges included; otherwise single
+    byte ranges are answered here.
+    """
+    config = current_app.config
+    path = safe_join(config['PICTURES_FOLDER'], filename)
+    if not os.path.isfile(path) or path.endswith('.tmp'):
+        abort(404)
+    current = file_fingerprint(path)
+    if fingerprint != current:
+        response = redirect(url_for('pictures.serve', fingerprint=current,
+                                    filename=filename))
+        response.cache_control.no_cache = True
+        return response
+
+    mimetype = mimetypes.guess_type(filename)[0] or \
+        'application/octet-stream'
+    response = current_app.response_class(mimetype=mimetype)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.set_etag(current)
+    response.last_modified = int(os.path.getmtime(path))
+    if not is_resource_modified(request.environ, etag=current,
+                                last_modified=response.last_modified):
+        response.status_code = 304
+        return response
+
+    sendfile = config.get('PICTURE_SENDFILE')
+    if sendfile == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = \
+            config['PICTURE_ACCEL_PREFIX'].rstrip('/') + '/' + filename
+        return response
+    if sendfile == 'x-sendfile':
+        response.headers['X-Sendfile'] = path
+        return response
+
+    length = os.path.getsize(path)
+    response.accept_ranges = 'bytes'
+    byte_range = None
+    if request.range and request.range.units == 'bytes':
+        if_range = request.if_range
+        # a range of some other version of the file is no use
+        if if_range.etag == current or \
+                (if_range.etag is None and if_range.date is None):
+            byte_range = request.range.range_for_length(length)
+            if byte_range is None and len(request.range.ranges) == 1:
+                response.status_code = 416
+                response.headers['Content-Range'] = 'bytes */%d' % length
+                return response
+    f = open(path, 'rb')
+    if byte_range:
+        start, stop = byte_range
+        response.status_code = 206
+        response.content_range = request.range.make_content_range(length)
+        response.response = read_range(f, start, stop)
+        response.content_length = stop - start
+    else:
+        response.response = wrap_file(request.environ, f, CHUNK_SIZE)
+        response.content_length = length
+    response.direct_passthrough = True
+    return response
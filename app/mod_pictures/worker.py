@@ -0,0 +1,67 @@
+# app/mod_pictures/worker.py
+
+
+#################
+#### imports ####
+#################
+
+import multiprocessing
+import os
+import socket
+import time
+
+from flask import current_app
+
+from ..models import db, PictureJob
+from .renditions import render_all
+from .storage import blob_path
+
+
+#################
+#### helpers ####
+#################
+
+def process(pool, jobs, config):
+    """Renders the jobs in parallel on pool, then records the outcome."""
+    folder = config['PICTURES_FOLDER']
+    options = dict(quality=config['PICTURE_QUALITY'],
+                   progressive=config['PICTURE_PROGRESSIVE'],
+                   webp=config['PICTURE_WEBP'])
+    pending = []
+    for job in jobs:
+        # renditions sit next to the blob, in its shard
+        source = blob_path(folder, job.picture.filename)
+        directory, filename = os.path.split(source)
+        pending.append((job, pool.apply_async(render_all, (
+            source, directory, filename, config['PICTURE_RENDITIONS']),
+            options)))
+    for job, result in pending:
+        try:
+            result.get()
+        except Exception as e:
+            job.fail(e, config['PICTURE_JOB_ATTEMPTS'])
+        else:
+            job.finish()
+    db.session.commit()
+
+
+def run(processes=None, once=False, poll=1.0):
+    """Processes picture jobs until interrupted, or with once until the
+    queue is empty. Pictures are spread over processes cores."""
+    config = current_app.config
+    processes = processes or multiprocessing.cpu_count()
+    worker = '%s:%s' % (socket.gethostname(), os.getpid())
+    pool = multiprocessing.Pool(processes)
+    try:
+        while True:
+            jobs = PictureJob.claim(worker, limit=processes,
+                                    timeout=config['PICTURE_JOB_TIMEOUT'])
+            if jobs:
+                process(pool, jobs, config)
+            elif once:
+                return
+            else:
+                time.sleep(poll)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,111 @@
+# app/mod_user/loader.py
+
+
+#################
+#### imports ####
+#################
+
+import threading
+import time
+
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from ..models import db, User
+
+
+################
+#### config ####
+################
+
+DEFAULT_TTL = 60
+
+_cache = {}
+_lock = threading.Lock()
+
+
+#################
+#### helpers ####
+#################
+
+class SessionUser(object):
+    """The identity Flask-Login keeps as current_user.
+
+    Only the identity columns are loaded; call load() when a view needs
+    the mapped User and its relationships.
+    """
+
+    __slots__ = ('id', 'email', 'admin')
+
+    def __init__(self, id, email, admin):
+        self.id = id
+        self.email = email
+        self.admin = admin
+
+    def is_authenticated(self):
+        return True
+
+    def is_active(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return self.id
+
+    def load(self):
+        return User.query.get(self.id)
+
+    def __repr__(self):
+        return '<User {0}>'.format(self.email)
+
+
+def load_user(user_id):
+    """Return the SessionUser for user_id, cached for USER_CACHE_TTL."""
+    user_id = int(user_id)
+    ttl = current_app.config.get('USER_CACHE_TTL', DEFAULT_TTL)
+    now = time.time()
+    cached = _cache.get(user_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    row = db.session.query(User.id, User.email, User.admin).filter(
+        User.id == user_id).first()
+    if row is None:
+        return None
+    user = SessionUser(*row)
+    if ttl > 0:
+        with _lock:
+            _cache[user_id] = (now + ttl, user)
+    return user
+
+
+def invalidate(user_id=None):
+    """Drop one cached identity, or all of them."""
+    with _lock:
+        if user_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(user_id, None)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    changed = [obj.id for obj in session.new | session.dirty | session.deleted
+               if isinstance(obj, User)]
+    if changed:
+        session.info.setdefault('changed_users', set()).update(changed)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _invalidate_after_commit(session):
+    # only once the change is visible, or a concurrent request could
+    # cache the old row again for another USER_CACHE_TTL
+    for user_id in session.info.pop('changed_users', ()):
+        invalidate(user_id)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _discard_invalidations(session):
+    session.info.pop('changed_users', None)
@@ -2,20 +2,36 @@
 
 
 import datetime
+import random
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.sql.functions import sum
 
 from . import bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 db = SQLAlchemy()
 
+# every timestamp is naive UTC. A ledger entry is stamped before it commits,
+# so a snapshot only covers what is at least this old: anything stamped
+# earlier has long committed or rolled back by then
+SNAPSHOT_LAG = datetime.timedelta(minutes=1)
+
 tag_categories_tags = db.Table('tag_categories_tags',
                                db.Column('tag_category_id',
                                          db.Integer(),
                                          db.ForeignKey('tag_category.id')
                                          ),
                                db.Column('tag_id', db.Integer(),
-                                         db.ForeignKey('tag.id')))
+                                         db.ForeignKey('tag.id')),
+                               db.Index('ix_tag_categories_tags_category',
+                                        'tag_category_id', 'tag_id'),
+                               db.Index('ix_tag_categories_tags_tag',
+                                        'tag_id', 'tag_category_id'))
 
 components_tags = db.Table('components_tags',
                            db.Column('component_id',
@@ -23,7 +39,11 @@ components_tags = db.Table('components_tags',
                                      db.ForeignKey('component.id')),
                            db.Column('tag_id',
                                      db.Integer(),
-                                     db.ForeignKey('tag.id')))
+                                     db.ForeignKey('tag.id')),
+                           db.Index('ix_components_tags_component',
+                                    'component_id', 'tag_id'),
+                           db.Index('ix_components_tags_tag',
+                                    'tag_id', 'component_id'))
 
 components_pictures = db.Table('components_pictures',
                            db.Column('component_id',
@@ -34,13 +54,48 @@ components_pictures = db.Table('components_pictures',
                                      db.ForeignKey('picture.id')))
 
 
+class InsufficientStock(Exception):
+    """Raised when a ledger entry would drive a stock level below zero."""
+
+    def __init__(self, component_id, available):
+        super(InsufficientStock, self).__init__(
+            'Not enough items, only %s available' % available)
+        self.component_id = component_id
+        self.available = available
+
+
+def _update_or_insert(connection, update, insert):
+    """Runs update, or insert when update matches no row.
+
+    Two transactions can both miss the row and race to insert it; the
+    loser's insert runs in a savepoint, so its transaction survives the
+    IntegrityError and updates the row the winner committed instead.
+    SQLite needs none of this: the UPDATE already holds the write lock,
+    and its Python 2 driver would commit before a SAVEPOINT anyway.
+    """
+    if connection.execute(update).rowcount:
+        return
+    if connection.dialect.name == 'sqlite':
+        connection.execute(insert)
+        return
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(insert)
+    except IntegrityError:
+        savepoint.rollback()
+        if not connection.execute(update).rowcount:
+            raise
+    else:
+        savepoint.commit()
+
+
 class Base(db.Model):
     __abstract__ = True
     id = db.Column(db.Integer, primary_key=True)
-    date_create = db.Column(db.DateTime, default=db.func.current_timestamp())
+    date_create = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     date_modified = db.Column(db.DateTime,
-                              default=db.func.current_timestamp(),
-                              onupdate=db.func.current_timestamp())
+                              default=datetime.datetime.utcnow,
+                              onupdate=datetime.datetime.utcnow)
 
 
 class User(db.Model):
@@ -53,14 +108,14 @@ class User(db.Model):
     registered_on = db.Column(db.DateTime, nullable=False)
     admin = db.Column(db.Boolean, nullable=False, default=False)
     transactions = db.relationship('Transaction', backref='user',
-                                   lazy='joined')
+                                   lazy='dynamic')
     purchase_orders = db.relationship('PurchaseOrder', backref='user',
-                                   lazy='joined')
+                                   lazy='dynamic')
 
     def __init__(self, email, password, admin=False):
         self.email = email
         self.password = bcrypt.generate_password_hash(password)
-        self.registered_on = datetime.datetime.now()
+        self.registered_on = datetime.datetime.utcnow()
         self.admin = admin
 
     def is_authenticated(self):
@@ -119,6 +174,10 @@ class PurchaseOrder(db.Model):
     tax = db.Column(db.Numeric(12, 2), nullable=False, default=0.00)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
                         nullable=False)
+    # denormalized sub_total + shipping + tax, kept in sync by the line
+    # item events below so order lists can sort on an indexed column
+    cached_total = db.Column(db.Numeric(12, 2), nullable=False, default=0,
+                             index=True)
 
     @hybrid_property
     def sub_total(self):
@@ -127,10 +186,33 @@ class PurchaseOrder(db.Model):
             price += line.total_price
         return price
 
+    @sub_total.expression
+    def sub_total(cls):
+        return db.select([db.func.coalesce(db.func.sum(LineItem.total_price),
+                                           0)])\
+            .where(LineItem.purchase_order_id == cls.id).as_scalar()
+
     @hybrid_property
     def total(self):
         return self.sub_total + self.shipping + self.tax
 
+    @staticmethod
+    def refresh_cached_total(connection, purchase_order_id):
+        table = PurchaseOrder.__table__
+        connection.execute(
+            table.update()
+            .where(table.c.id == purchase_order_id)
+            .values(cached_total=PurchaseOrder.sub_total +
+                    table.c.shipping + table.c.tax))
+
+    @staticmethod
+    def rebuild_cached_totals():
+        table = PurchaseOrder.__table__
+        db.session.execute(table.update().values(
+            cached_total=PurchaseOrder.sub_total +
+            table.c.shipping + table.c.tax))
+        db.session.commit()
+
     def as_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
@@ -140,6 +222,10 @@ class PurchaseOrder(db.Model):
 
 class VendorComponent(db.Model):
     __tablename__ = "vendor_component"
+    __table_args__ = (
+        db.UniqueConstraint('vendor_id', 'sku',
+                            name='uq_vendor_component_vendor_sku'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     sku = db.Column(db.String(5), unique=False, nullable=False)
@@ -176,6 +262,32 @@ class LineItem(db.Model):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+@event.listens_for(PurchaseOrder, 'after_insert')
+def _po_total_after_insert(mapper, connection, target):
+    PurchaseOrder.refresh_cached_total(connection, target.id)
+
+
+@event.listens_for(PurchaseOrder, 'after_update')
+def _po_total_after_update(mapper, connection, target):
+    if get_history(target, 'shipping').has_changes() or \
+            get_history(target, 'tax').has_changes():
+        PurchaseOrder.refresh_cached_total(connection, target.id)
+
+
+@event.listens_for(LineItem, 'after_insert')
+@event.listens_for(LineItem, 'after_delete')
+def _po_total_after_line_change(mapper, connection, target):
+    PurchaseOrder.refresh_cached_total(connection, target.purchase_order_id)
+
+
+@event.listens_for(LineItem, 'after_update')
+def _po_total_after_line_update(mapper, connection, target):
+    order = get_history(target, 'purchase_order_id')
+    for purchase_order_id in order.deleted:
+        PurchaseOrder.refresh_cached_total(connection, purchase_order_id)
+    PurchaseOrder.refresh_cached_total(connection, target.purchase_order_id)
+
+
 class Component(db.Model):
     __tablename__ = "component"
 
@@ -190,50 +302,75 @@ class Component(db.Model):
                            secondary=components_pictures,
                            backref='component')
 
-    # @hybrid_property
+    stock = db.relationship("StockLevel", uselist=False, lazy="joined")
+
     @property
     def qty(self):
-        qty_available = [x.qty for x in self.transactions]
-        s = 0
-        for i in qty_available:
-            s += i
-        return s
+        return self.stock.qty if self.stock else 0
+
+    @staticmethod
+    def search(prefix=None, tags=(), categories=()):
+        """Components matching every given filter.
+
+        prefix matches the start of the SKU or the description; each tag
+        name and each category name must be carried by the component, a
+        category through any of its tags.
+        """
+        query = Component.query
+        if prefix:
+            pattern = prefix.replace('\\', '\\\\').replace('%', '\\%') \
+                .replace('_', '\\_') + '%'
+            query = query.filter(db.or_(
+                Component.sku.like(pattern, escape='\\'),
+                Component.description.like(pattern, escape='\\')))
+        for name in tags:
+            query = query.filter(Component.id.in_(
+                db.select([components_tags.c.component_id])
+                .select_from(components_tags.join(
+                    Tag, Tag.id == components_tags.c.tag_id))
+                .where(Tag.name == name.strip().upper())))
+        for name in categories:
+            query = query.filter(Component.id.in_(
+                db.select([components_tags.c.component_id])
+                .select_from(components_tags.join(
+                    tag_categories_tags, tag_categories_tags.c.tag_id ==
+                    components_tags.c.tag_id).join(
+                    TagCategory, TagCategory.id ==
+                    tag_categories_tags.c.tag_category_id))
+                .where(TagCategory.name == name.strip().upper())))
+        return query
+
     def tag_with(self, tag, cat=None):
-        tag = tag.strip().upper()
-        if cat: cat = cat.strip().upper()
-        tag_obj = Tag.query.filter_by(name=tag).first() 
-        cat_obj = TagCategory.query.filter_by(name=cat).first() if cat else None
-        commit = False
-        if cat and not cat_obj:
-            cat_obj = TagCategory(cat)
-            db.session.add(cat_obj)
-            commit = True
-        if not tag_obj:
-            tag_obj = Tag(tag)
-            db.session.add(tag_obj)
-            commit = True
-        if cat_obj and tag_obj not in cat_obj.tags:
-            cat_obj.tags.append(tag_obj)
-            commit = True
-        if tag_obj not in self.tags:
-            self.tags.append(tag_obj)
+        tag_obj, commit = TagManager.resolve(tag, cat)
+        if commit or not TagManager.linked(components_tags,
+                                           component_id=self.id,
+                                           tag_id=tag_obj.id):
+            TagManager.link(components_tags, component_id=self.id,
+                            tag_id=tag_obj.id)
+            touch_tables(db.session, 'component')
             commit = True
         if commit:
             db.session.commit()
             return tag_obj
         return None
     def remove_tag(self, tag):
-        for idx, tag_obj in enumerate(self.tags):
-            if tag_obj.name == tag:
-                self.tags.pop(idx)
-                break
+        tag_obj = tag_names.load(tag)
+        if tag_obj is not None and db.session.execute(
+                components_tags.delete().where(db.and_(
+                    components_tags.c.component_id == self.id,
+                    components_tags.c.tag_id == tag_obj.id))).rowcount:
+            touch_tables(db.session, 'component')
         db.session.commit()
         return self
 
 
-
 class Transaction(Base):
     __tablename__ = "transaction"
+    __table_args__ = (
+        db.Index('ix_transaction_component_date', 'component_id',
+                 'date_create'),
+        db.Index('ix_transaction_date_id', 'date_create', 'id'),
+    )
     component_id = db.Column(db.Integer, db.ForeignKey('component.id'),
                              nullable=False)
     component = db.relationship("Component", backref="transactions")
@@ -241,6 +378,201 @@ class Transaction(Base):
     notes = db.Column(db.String(40))
     qty = db.Column(db.Integer, nullable=False)
 
+    @staticmethod
+    def record(component_id, qty, user_id, notes=None, retries=3):
+        """Adds a ledger entry and commits it.
+
+        Check-outs are guarded by the stock_level row of the component alone,
+        so writers on different components never wait on each other.  Raises
+        InsufficientStock when the stock is too low; commits that fail
+        because the database is busy are retried with a randomized backoff.
+        """
+        for attempt in range(retries + 1):
+            entry = Transaction(component_id=component_id, qty=qty,
+                                user_id=user_id, notes=notes,
+                                date_create=datetime.datetime.utcnow())
+            db.session.add(entry)
+            try:
+                db.session.commit()
+                return entry
+            except InsufficientStock:
+                db.session.rollback()
+                raise
+            except OperationalError:
+                db.session.rollback()
+                if attempt == retries:
+                    raise
+                time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+
+class StockLevel(db.Model):
+    """Quantity on hand per component, materialized from the ledger.
+
+    Rows are adjusted in the same database transaction as every
+    ``Transaction`` write, so reading a component's quantity is a primary
+    key lookup instead of a sum over its whole history.
+    """
+    __tablename__ = "stock_level"
+
+    component_id = db.Column(db.Integer, db.ForeignKey('component.id'),
+                             primary_key=True, autoincrement=False)
+    qty = db.Column(db.Integer, nullable=False, default=0)
+    date_modified = db.Column(db.DateTime, nullable=False, index=True,
+                              default=datetime.datetime.utcnow)
+
+    @staticmethod
+    def adjust(connection, component_id, delta, guard=False):
+        """Adds ``delta`` to the stock level of a component.
+
+        With ``guard`` a negative delta is applied by a conditional UPDATE
+        that only matches while enough stock is left, and InsufficientStock
+        is raised when it does not match.
+        """
+        table = StockLevel.__table__
+        now = datetime.datetime.utcnow()
+        update = table.update()\
+            .where(table.c.component_id == component_id)\
+            .values(qty=table.c.qty + delta, date_modified=now)
+        if guard and delta < 0:
+            update = update.where(table.c.qty >= -delta)
+        insert = table.insert().values(
+            component_id=component_id, qty=delta, date_modified=now)
+        if not (guard and delta < 0):
+            _update_or_insert(connection, update, insert)
+        elif not connection.execute(update).rowcount:
+            available = connection.scalar(
+                db.select([table.c.qty])
+                .where(table.c.component_id == component_id))
+            raise InsufficientStock(component_id, available or 0)
+        TableVersion.bump(connection, ['stock_level'])
+
+    @staticmethod
+    def ledger_totals():
+        """Query of (component_id, qty) summed from the ledger."""
+        return db.session.query(
+            Component.id,
+            db.func.coalesce(db.func.sum(Transaction.qty), 0)
+        ).outerjoin(Transaction, Transaction.component_id == Component.id)\
+            .group_by(Component.id)
+
+    @staticmethod
+    def rebuild():
+        table = StockLevel.__table__
+        db.session.execute(table.delete())
+        db.session.execute(table.insert().from_select(
+            ['component_id', 'qty'], StockLevel.ledger_totals().statement))
+        TableVersion.bump(db.session.connection(), ['stock_level'])
+        db.session.commit()
+
+    @staticmethod
+    def verify():
+        """Returns (component_id, stored, ledger) for every mismatch."""
+        stored = dict(db.session.query(StockLevel.component_id,
+                                       StockLevel.qty))
+        mismatches = []
+        for component_id, ledger_qty in StockLevel.ledger_totals():
+            stored_qty = stored.get(component_id, 0)
+            if stored_qty != ledger_qty:
+                mismatches.append((component_id, stored_qty, ledger_qty))
+        return mismatches
+
+
+class StockSnapshot(db.Model):
+    """Per-component balance written at a checkpoint.
+
+    The quantity on hand at any time T is the nearest snapshot taken at or
+    before T plus the ledger rows dated after it, so point-in-time queries
+    only replay the ledger since the last checkpoint.
+    """
+    __tablename__ = "stock_snapshot"
+    __table_args__ = (
+        db.Index('ix_stock_snapshot_component_taken', 'component_id',
+                 'taken_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    component_id = db.Column(db.Integer, db.ForeignKey('component.id'),
+                             nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False, index=True)
+    qty = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def qty_at(component_id, when):
+        """Quantity on hand for one component as of ``when``."""
+        snapshot = db.session.query(
+            StockSnapshot.taken_at, StockSnapshot.qty).filter(
+            StockSnapshot.component_id == component_id,
+            StockSnapshot.taken_at <= when)\
+            .order_by(StockSnapshot.taken_at.desc()).first()
+        delta = db.session.query(
+            db.func.coalesce(db.func.sum(Transaction.qty), 0)).filter(
+            Transaction.component_id == component_id,
+            Transaction.date_create <= when)
+        if snapshot is None:
+            return delta.scalar()
+        taken_at, qty = snapshot
+        return qty + delta.filter(Transaction.date_create > taken_at).scalar()
+
+    @staticmethod
+    def quantities_at(when):
+        """Returns {component_id: qty} for every component as of ``when``."""
+        checkpoint = db.session.query(
+            db.func.max(StockSnapshot.taken_at)).filter(
+            StockSnapshot.taken_at <= when).scalar()
+        balances = dict((component_id, 0) for component_id, in
+                        db.session.query(Component.id))
+        delta = db.session.query(
+            Transaction.component_id, db.func.sum(Transaction.qty)).filter(
+            Transaction.date_create <= when)
+        if checkpoint is not None:
+            balances.update(db.session.query(
+                StockSnapshot.component_id, StockSnapshot.qty).filter(
+                StockSnapshot.taken_at == checkpoint))
+            delta = delta.filter(Transaction.date_create > checkpoint)
+        for component_id, qty in delta.group_by(Transaction.component_id):
+            balances[component_id] = balances.get(component_id, 0) + qty
+        return balances
+
+    @staticmethod
+    def take(when=None):
+        """Writes a checkpoint for every component and returns its time.
+
+        The checkpoint is never later than SNAPSHOT_LAG ago, so a ledger
+        entry stamped before it but still committing is not left out of
+        both the snapshot and the replay after it.
+        """
+        latest = datetime.datetime.utcnow() - SNAPSHOT_LAG
+        when = min(when or latest, latest)
+        rows = [dict(component_id=component_id, taken_at=when, qty=qty)
+                for component_id, qty in
+                StockSnapshot.quantities_at(when).items()]
+        if rows:
+            db.session.execute(StockSnapshot.__table__.insert(), rows)
+        db.session.commit()
+        return when
+
+
+@event.listens_for(Transaction, 'after_insert')
+def _stock_after_insert(mapper, connection, target):
+    StockLevel.adjust(connection, target.component_id, target.qty, guard=True)
+
+
+@event.listens_for(Transaction, 'after_update')
+def _stock_after_update(mapper, connection, target):
+    component = get_history(target, 'component_id')
+    qty = get_history(target, 'qty')
+    if not (component.has_changes() or qty.has_changes()):
+        return
+    old_component = (component.deleted or component.unchanged)[0]
+    old_qty = (qty.deleted or qty.unchanged)[0]
+    StockLevel.adjust(connection, old_component, -old_qty)
+    StockLevel.adjust(connection, target.component_id, target.qty)
+
+
+@event.listens_for(Transaction, 'after_delete')
+def _stock_after_delete(mapper, connection, target):
+    StockLevel.adjust(connection, target.component_id, -target.qty)
+
 
 class TagCategory(db.Model):
     __tablename__ = "tag_category"
@@ -271,31 +603,226 @@ class Tag(db.Model):
             None) if self.categories is None else ",".join([x.name for x in self.categories]))
 
 
+class NameCache(object):
+    """Bounded LRU map from name to primary key for a model with a unique
+    name column.
+
+    Only names that exist are cached. Renames and deletes drop their
+    entries; load() re-checks the row it gets, so an id left stale by
+    another process or a rolled back insert is looked up again.
+    """
+
+    def __init__(self, model, size=1024):
+        self.model = model
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Returns the id of the row named name, or None."""
+        with self._lock:
+            id = self._ids.pop(name, None)
+            if id is not None:
+                self._ids[name] = id
+                return id
+        id = db.session.query(self.model.id) \
+            .filter(self.model.name == name).scalar()
+        if id is not None:
+            with self._lock:
+                self._ids[name] = id
+                while len(self._ids) > self.size:
+                    self._ids.popitem(last=False)
+        return id
+
+    def load(self, name):
+        """Returns the row named name, or None."""
+        id = self.get(name)
+        if id is None:
+            return None
+        obj = self.model.query.get(id)
+        if obj is not None and obj.name == name:
+            return obj
+        self.discard(name)
+        id = self.get(name)
+        return self.model.query.get(id) if id is not None else None
+
+    def discard(self, *names):
+        with self._lock:
+            for name in names:
+                self._ids.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+tag_names = NameCache(Tag)
+category_names = NameCache(TagCategory)
+
+
+@event.listens_for(Tag, 'after_update')
+@event.listens_for(TagCategory, 'after_update')
+def _name_cache_after_rename(mapper, connection, target):
+    cache = tag_names if isinstance(target, Tag) else category_names
+    cache.discard(*get_history(target, 'name').deleted)
+
+
+@event.listens_for(Tag, 'after_delete')
+@event.listens_for(TagCategory, 'after_delete')
+def _name_cache_after_delete(mapper, connection, target):
+    cache = tag_names if isinstance(target, Tag) else category_names
+    cache.discard(target.name)
+
+
 class TagManager():
     @staticmethod
     def new_tag(tag, cat=None):
+        tag_obj, commit = TagManager.resolve(tag, cat)
+        if commit:  db.session.commit()
+        return tag_obj
+
+    @staticmethod
+    def resolve(tag, cat=None):
+        """Finds or creates a tag, and its category when given, without
+        committing. Returns (tag, changed)."""
         tag = tag.strip().upper()
         if cat: cat = cat.strip().upper()
-        cat_obj = TagCategory.query.filter_by(name=cat).first() if cat else None
-        tag_obj = Tag.query.filter_by(name=tag).first()
-        commit = False
+        cat_obj = category_names.load(cat) if cat else None
+        tag_obj = tag_names.load(tag)
+        changed = False
         if not cat_obj and cat:
             cat_obj = TagCategory(cat)
             db.session.add(cat_obj)
-            commit = True
+            changed = True
         if not tag_obj:
             tag_obj = Tag(tag)
             db.session.add(tag_obj)
-            commit = True
-        if cat_obj and tag_obj not in cat_obj.tags:
-            cat_obj.tags.append(tag_obj)
-            commit = True
-        if commit:  db.session.commit()
-        return tag_obj
+            changed = True
+        if changed:
+            db.session.flush()
+        if cat_obj and (changed or not TagManager.linked(
+                tag_categories_tags, tag_category_id=cat_obj.id,
+                tag_id=tag_obj.id)):
+            TagManager.link(tag_categories_tags, tag_category_id=cat_obj.id,
+                            tag_id=tag_obj.id)
+            touch_tables(db.session, 'tag', 'tag_category')
+            changed = True
+        return tag_obj, changed
+
+    @staticmethod
+    def linked(table, **columns):
+        """Whether an association row exists, checked with one query
+        instead of loading either side's collection."""
+        return db.session.query(db.exists().where(db.and_(*[
+            table.c[name] == value for name, value in columns.items()
+        ]))).scalar()
+
+    @staticmethod
+    def link(table, **columns):
+        db.session.execute(table.insert().values(**columns))
+
+    @staticmethod
+    def _resolve(model, names):
+        """Returns ({name: id}, created) for names, inserting the ones
+        not stored yet."""
+        if not names:
+            return {}, False
+        ids = dict(db.session.query(model.name, model.id)
+                   .filter(model.name.in_(names)))
+        missing = [name for name in names if name not in ids]
+        if missing:
+            db.session.execute(model.__table__.insert(),
+                               [{'name': name} for name in missing])
+            ids.update(db.session.query(model.name, model.id)
+                       .filter(model.name.in_(missing)))
+        return ids, bool(missing)
+
+    @staticmethod
+    def bulk_tag(component_ids, tags):
+        """Tags many components at once and commits.
+
+        tags is an iterable of (tag, category) name pairs, category may be
+        None. Missing tags and categories are created, and every missing
+        components_tags row is added by a single INSERT ... SELECT.
+        Returns the number of rows added.
+        """
+        pairs = set((tag.strip().upper(), cat.strip().upper() if cat else None)
+                    for tag, cat in tags)
+        tag_ids, new_tags = TagManager._resolve(
+            Tag, set(tag for tag, cat in pairs))
+        cat_ids, new_cats = TagManager._resolve(
+            TagCategory, set(cat for tag, cat in pairs if cat))
+        touched = set()
+        if new_tags:
+            touched.add('tag')
+        if new_cats:
+            touched.add('tag_category')
+        links = set((cat_ids[cat], tag_ids[tag]) for tag, cat in pairs if cat)
+        if links:
+            links -= set(db.session.query(
+                tag_categories_tags.c.tag_category_id,
+                tag_categories_tags.c.tag_id).filter(
+                tag_categories_tags.c.tag_id.in_(tag_ids.values())))
+        if links:
+            db.session.execute(tag_categories_tags.insert(), [
+                {'tag_category_id': cat_id, 'tag_id': tag_id}
+                for cat_id, tag_id in links])
+            touched.add('tag_category')
+        added = 0
+        if component_ids and tag_ids:
+            rows = db.select([Component.id, Tag.id]).where(db.and_(
+                Component.id.in_(component_ids),
+                Tag.id.in_(tag_ids.values()),
+                ~db.exists().where(db.and_(
+                    components_tags.c.component_id == Component.id,
+                    components_tags.c.tag_id == Tag.id))))
+            added = db.session.execute(components_tags.insert().from_select(
+                ['component_id', 'tag_id'], rows)).rowcount
+        if added:
+            touched.add('component')
+        touch_tables(db.session, *touched)
+        db.session.commit()
+        return added
+
+    @staticmethod
+    def bulk_untag(component_ids, tags):
+        """Removes tag names from many components with one DELETE and
+        commits. Returns the number of rows removed."""
+        names = set(tag.strip().upper() for tag in tags)
+        if not component_ids or not names:
+            return 0
+        removed = db.session.execute(components_tags.delete().where(db.and_(
+            components_tags.c.component_id.in_(component_ids),
+            components_tags.c.tag_id.in_(
+                db.select([Tag.id]).where(Tag.name.in_(names)))))).rowcount
+        if removed:
+            touch_tables(db.session, 'component')
+        db.session.commit()
+        return removed
+
+    @staticmethod
+    def facet_counts(components):
+        """Counts the components of a query per tag, in one grouped query.
+
+        Returns (tag id, tag name, count) rows, most used tag first.
+        """
+        ids = components.with_entities(Component.id).order_by(None) \
+            .subquery()
+        count = db.func.count(components_tags.c.component_id)
+        return db.session.query(Tag.id, Tag.name, count) \
+            .join(components_tags, components_tags.c.tag_id == Tag.id) \
+            .filter(components_tags.c.component_id.in_(db.select([ids.c.id]))) \
+            .group_by(Tag.id, Tag.name) \
+            .order_by(count.desc(), Tag.name).all()
 
 class Picture(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    filename = db.Column(db.String(25), unique=True, nullable=False)
+    # the blob, relative to PICTURES_FOLDER; see mod_pictures.storage
+    filename = db.Column(db.String(100), unique=True, nullable=False)
+    # SHA-256 of the upload; unset for pictures stored before blobs
+    content_hash = db.Column(db.String(64), unique=True)
+    # processing while a PictureJob is making its renditions
+    status = db.Column(db.String(12), nullable=False, default='ready')
 
     components = db.relationship("Component",
                            secondary=components_pictures,
@@ -306,4 +833,203 @@ class Picture(db.Model):
         return "<Picture: filename:%s, for items(%s): [%s] >" % (
             self.filename,
             len(self.components),
-            components_list)
\ No newline at end of file
+            components_list)
+
+
+class PictureJob(db.Model):
+    """Durable queue of pictures waiting for their renditions.
+
+    Workers claim pending jobs with a conditional UPDATE, so each job runs
+    once even with several workers polling. A job left running past the
+    timeout (its worker died) is handed out again until it runs out of
+    attempts.
+    """
+    __tablename__ = "picture_job"
+
+    id = db.Column(db.Integer, primary_key=True)
+    picture_id = db.Column(db.Integer, db.ForeignKey('picture.id'),
+                           nullable=False)
+    picture = db.relationship('Picture')
+    status = db.Column(db.String(12), nullable=False, default='pending',
+                       index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker = db.Column(db.String(64))
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    @staticmethod
+    def enqueue(picture):
+        """Adds a job for picture and marks it processing; not committed."""
+        picture.status = 'processing'
+        job = PictureJob(picture=picture)
+        db.session.add(job)
+        return job
+
+    @staticmethod
+    def claim(worker, limit=1, timeout=600):
+        """Marks up to limit pending jobs as running for worker, commits
+        and returns them."""
+        table = PictureJob.__table__
+        now = datetime.datetime.utcnow()
+        db.session.execute(table.update().where(db.and_(
+            table.c.status == 'running',
+            table.c.started_at < now - datetime.timedelta(seconds=timeout)))
+            .values(status='pending'))
+        claimed = []
+        candidates = db.session.query(PictureJob.id) \
+            .filter(PictureJob.status == 'pending') \
+            .order_by(PictureJob.id).limit(limit).all()
+        for job_id, in candidates:
+            if db.session.execute(table.update().where(db.and_(
+                    table.c.id == job_id, table.c.status == 'pending'))
+                    .values(status='running', worker=worker,
+                            started_at=now,
+                            attempts=table.c.attempts + 1)).rowcount:
+                claimed.append(job_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return PictureJob.query.filter(PictureJob.id.in_(claimed)) \
+            .order_by(PictureJob.id).all()
+
+    def finish(self):
+        self.status = 'done'
+        self.error = None
+        self.finished_at = datetime.datetime.utcnow()
+        self.picture.status = 'ready'
+
+    def fail(self, error, max_attempts=3):
+        """Requeues the job, or gives up once it has used max_attempts."""
+        self.error = str(error)[:255]
+        if self.attempts < max_attempts:
+            self.status = 'pending'
+            return
+        self.status = 'failed'
+        self.finished_at = datetime.datetime.utcnow()
+        self.picture.status = 'failed'
+
+
+class ImportRun(db.Model):
+    """Progress of a bulk import, checkpointed with every committed chunk.
+
+    position counts the data rows already dealt with, inserted or
+    rejected; an import of the same source that did not finish picks up
+    from there.
+    """
+    __tablename__ = "import_run"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    source = db.Column(db.String(255), index=True)
+    status = db.Column(db.String(12), nullable=False, default='running')
+    position = db.Column(db.Integer, nullable=False, default=0)
+    inserted = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255))
+    started_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @staticmethod
+    def start(kind, source=None):
+        """Resumes the unfinished import of source, or starts a new one;
+        commits."""
+        run = None
+        if source:
+            run = ImportRun.query.filter(
+                ImportRun.kind == kind, ImportRun.source == source,
+                ImportRun.status.in_(['running', 'failed'])) \
+                .order_by(ImportRun.id.desc()).first()
+        if run is None:
+            run = ImportRun(kind=kind, source=source)
+            db.session.add(run)
+        run.status = 'running'
+        run.error = None
+        db.session.commit()
+        return run
+
+    def checkpoint(self, rows, inserted, rejected):
+        """Records a chunk; committed together with its rows."""
+        self.position += rows
+        self.inserted += inserted
+        self.rejected += rejected
+
+    def finish(self):
+        self.status = 'done'
+        self.finished_at = datetime.datetime.utcnow()
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.error = str(error)[:255]
+
+
+class TableVersion(db.Model):
+    """Change counter per table, for cheap HTTP cache validators.
+
+    Bumped from the flush that changes a table, so a version commits or
+    rolls back together with the change. A bump waits for the row lock of
+    any earlier one, so versions follow commit order even where the
+    timestamps written before the commit do not. The ledger itself is left
+    out; stock_level is bumped by every StockLevel.adjust, which only
+    holds the row from the flush to the commit.
+    """
+    __tablename__ = "table_version"
+
+    UNTRACKED = frozenset(['table_version', 'transaction', 'stock_snapshot',
+                           'picture_job', 'import_run'])
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified_at = db.Column(db.DateTime, nullable=False)
+
+    @staticmethod
+    def bump(connection, names):
+        table = TableVersion.__table__
+        now = datetime.datetime.utcnow()
+        # now was read before any wait for the row; never go back in time
+        modified_at = db.case([(table.c.modified_at > now,
+                                table.c.modified_at)], else_=now)
+        for name in sorted(names):
+            _update_or_insert(
+                connection,
+                table.update().where(table.c.name == name)
+                .values(version=table.c.version + 1,
+                        modified_at=modified_at),
+                table.insert().values(name=name, version=1,
+                                      modified_at=now))
+
+    @staticmethod
+    def current(names):
+        """Returns {name: (version, modified_at)} for the given tables."""
+        return dict((name, (version, modified_at))
+                    for name, version, modified_at in db.session.query(
+                        TableVersion.name, TableVersion.version,
+                        TableVersion.modified_at)
+                    .filter(TableVersion.name.in_(names)))
+
+
+def touch_tables(session, *names):
+    """Records changes made with Core statements, which skip the flush
+    hooks: bumps the table versions and flags the tables for the response
+    cache, which is invalidated when the session commits."""
+    if not names:
+        return
+    TableVersion.bump(session.connection(),
+                      set(names) - TableVersion.UNTRACKED)
+    session.info.setdefault('touched_tables', set()).update(names)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _bump_table_versions(session, flush_context):
+    names = set()
+    for obj in session.new | session.deleted:
+        names.update(t.name for t in db.object_mapper(obj).tables)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            names.update(t.name for t in db.object_mapper(obj).tables)
+    names -= TableVersion.UNTRACKED
+    if names:
+        TableVersion.bump(session.connection(), names)
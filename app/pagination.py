@@ -0,0 +1,120 @@
+# app/pagination.py
+
+
+#################
+#### imports ####
+#################
+
+import base64
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import and_, or_
+
+
+################
+#### config ####
+################
+
+DEFAULT_COUNT_TTL = 300
+DEFAULT_COUNT_CACHE_SIZE = 256
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# key -> (expires, count), oldest first
+_counts = OrderedDict()
+_lock = threading.Lock()
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+#################
+#### helpers ####
+#################
+
+def encode_cursor(date, id):
+    token = '%s|%d' % (date.strftime(CURSOR_FORMAT), id)
+    return base64.urlsafe_b64encode(token.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(token):
+    try:
+        date, id = base64.urlsafe_b64decode(
+            str(token)).decode('ascii').split('|')
+        return datetime.datetime.strptime(date, CURSOR_FORMAT), int(id)
+    except (TypeError, ValueError):
+        raise InvalidCursor(token)
+
+
+class KeysetPage(object):
+    """One page of a query walked newest first on (date column, id).
+
+    ``after`` continues past the oldest row of the previous page and
+    ``before`` walks back towards newer rows. Both only ever seek on the
+    index, so any page costs the same as the first one.
+    """
+
+    def __init__(self, query, date_column, id_column, per_page=20,
+                 after=None, before=None):
+        self.per_page = per_page
+        if before is not None:
+            date, id = decode_cursor(before)
+            query = query.filter(or_(
+                date_column > date,
+                and_(date_column == date, id_column > id)))
+            query = query.order_by(date_column.asc(), id_column.asc())
+        else:
+            if after is not None:
+                date, id = decode_cursor(after)
+                query = query.filter(or_(
+                    date_column < date,
+                    and_(date_column == date, id_column < id)))
+            query = query.order_by(date_column.desc(), id_column.desc())
+        rows = query.limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if before is not None:
+            rows.reverse()
+            self.has_prev, self.has_next = more, True
+        else:
+            self.has_prev, self.has_next = after is not None, more
+        self.items = rows
+        key = lambda row: encode_cursor(getattr(row, date_column.key),
+                                        getattr(row, id_column.key))
+        self.next_cursor = key(rows[-1]) if rows and self.has_next else None
+        self.prev_cursor = key(rows[0]) if rows and self.has_prev else None
+
+
+def cached_count(key, query):
+    """Row count for query, recomputed at most every COUNT_CACHE_TTL.
+
+    Good enough for an "about N results" label; the key should describe
+    the filters rather than their bound values, which may shift with the
+    clock. Keys include free-text searches, so at most COUNT_CACHE_SIZE
+    counts are kept and expired ones are dropped as new ones come in.
+    """
+    ttl = current_app.config.get('COUNT_CACHE_TTL', DEFAULT_COUNT_TTL)
+    size = current_app.config.get('COUNT_CACHE_SIZE',
+                                  DEFAULT_COUNT_CACHE_SIZE)
+    now = time.time()
+    cached = _counts.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    count = query.order_by(None).count()
+    with _lock:
+        _counts.pop(key, None)
+        _counts[key] = (now + ttl, count)
+        # entries go in oldest first, so the expired ones lead
+        while _counts and (len(_counts) > size or
+                           next(iter(_counts.values()))[0] <= now):
+            _counts.popitem(last=False)
+    return count
+
+
+def clear_counts():
+    with _lock:
+        _counts.clear()
@@ -0,0 +1,241 @@
+# app/search.py
+
+
+#################
+#### imports ####
+#################
+
+from sqlalchemy import event, func
+from sqlalchemy.sql import table, column
+
+from .models import db, Transaction
+
+
+################
+#### config ####
+################
+
+FTS_TABLE = 'transaction_notes_fts'
+# the shortest search the trigram index can answer
+TRIGRAM = 3
+TS_CONFIG = 'english'
+
+
+#################
+#### indexes ####
+#################
+
+def like_pattern(terms):
+    """terms as a LIKE pattern matching it anywhere, wildcards escaped."""
+    return '%' + terms.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_') + '%'
+
+
+class NotesIndex(object):
+    """Plain substring search over Transaction.notes.
+
+    Every backend searches the same way: an entry matches when its notes
+    contain the search text, ignoring case, and surrounding whitespace
+    is ignored. Subclasses only make that faster, keeping an index in sync
+    through DDL emitted alongside the transaction table.
+
+    Used as is when the database has no usable full-text support; it
+    scans the ledger and ranks newest first.
+    """
+
+    ddl = ()
+    drop_ddl = ()
+
+    def supported(self, bind):
+        return True
+
+    def create(self, connection):
+        for statement in self.ddl:
+            connection.execute(statement)
+
+    def drop(self, connection):
+        for statement in self.drop_ddl:
+            connection.execute(statement)
+
+    def reindex(self, connection):
+        self.drop(connection)
+        self.create(connection)
+
+    def _contains(self, terms):
+        return Transaction.notes.ilike(like_pattern(terms.strip()),
+                                       escape='\\')
+
+    def match(self, query, terms):
+        """Filter query down to the ledger entries matching terms."""
+        if not terms.strip():
+            return query
+        return query.filter(self._contains(terms))
+
+    def ranked(self, query, terms):
+        """Like match(), ordered best match first."""
+        return self.match(query, terms).order_by(
+            Transaction.date_create.desc(), Transaction.id.desc())
+
+
+class SqliteNotesIndex(NotesIndex):
+    """FTS5 external-content table kept in sync by triggers.
+
+    The trigram tokenizer indexes every three character sequence, so
+    substrings are found through the index. Searches shorter than that
+    cannot use it and scan the ledger. SQLite builds without FTS5 or
+    without the trigram tokenizer (before 3.34) get the plain scan.
+    """
+
+    fts = table(FTS_TABLE, column('rowid'), column('rank'),
+                column(FTS_TABLE), column('notes'))
+
+    ddl = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5("
+        "notes, content='transaction', content_rowid='id', "
+        "tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS {0}_ai AFTER INSERT ON \"transaction\" "
+        "BEGIN INSERT INTO {0}(rowid, notes) VALUES (new.id, new.notes); END",
+        "CREATE TRIGGER IF NOT EXISTS {0}_ad AFTER DELETE ON \"transaction\" "
+        "BEGIN INSERT INTO {0}({0}, rowid, notes) "
+        "VALUES ('delete', old.id, old.notes); END",
+        "CREATE TRIGGER IF NOT EXISTS {0}_au AFTER UPDATE OF notes "
+        "ON \"transaction\" BEGIN "
+        "INSERT INTO {0}({0}, rowid, notes) "
+        "VALUES ('delete', old.id, old.notes); "
+        "INSERT INTO {0}(rowid, notes) VALUES (new.id, new.notes); END",
+    )
+    drop_ddl = (
+        "DROP TRIGGER IF EXISTS {0}_ai",
+        "DROP TRIGGER IF EXISTS {0}_ad",
+        "DROP TRIGGER IF EXISTS {0}_au",
+        "DROP TABLE IF EXISTS {0}",
+    )
+    ddl = tuple(s.format(FTS_TABLE) for s in ddl)
+    drop_ddl = tuple(s.format(FTS_TABLE) for s in drop_ddl)
+
+    def __init__(self):
+        self.available = None
+
+    def supported(self, bind):
+        # probed on a scratch connection of the same library, so that no
+        # transaction of the application is touched
+        if self.available is None:
+            dbapi = bind.dialect.dbapi
+            probe = dbapi.connect(':memory:')
+            try:
+                probe.execute("CREATE VIRTUAL TABLE probe USING "
+                              "fts5(notes, tokenize='trigram')")
+                self.available = True
+            except dbapi.Error:
+                self.available = False
+            finally:
+                probe.close()
+        return self.available
+
+    def reindex(self, connection):
+        # recreated, so that an index made with another tokenizer goes
+        self.drop(connection)
+        self.create(connection)
+        connection.execute(
+            "INSERT INTO {0}({0}) VALUES ('rebuild')".format(FTS_TABLE))
+
+    @staticmethod
+    def expression(terms):
+        # one quoted phrase, so user input can't form FTS5 syntax; with
+        # trigrams a phrase matches wherever it occurs inside the notes
+        return '"%s"' % terms.strip().replace('"', '""')
+
+    @staticmethod
+    def indexable(terms):
+        return len(terms.strip()) >= TRIGRAM
+
+    def _matches(self, terms):
+        return self.fts.c[FTS_TABLE].match(self.expression(terms))
+
+    def match(self, query, terms):
+        if not self.indexable(terms):
+            return super(SqliteNotesIndex, self).match(query, terms)
+        return query.filter(Transaction.id.in_(
+            db.select([self.fts.c.rowid]).where(self._matches(terms))))
+
+    def ranked(self, query, terms):
+        if not self.indexable(terms):
+            return super(SqliteNotesIndex, self).ranked(query, terms)
+        return query.join(self.fts, self.fts.c.rowid == Transaction.id) \
+            .filter(self._matches(terms)) \
+            .order_by(self.fts.c.rank, Transaction.id.desc())
+
+
+class PostgresNotesIndex(NotesIndex):
+    """Substring search through a pg_trgm index, ranked by ts_rank.
+
+    The trigram index is a plain expression index, so Postgres maintains
+    it on insert without any triggers. Creating the pg_trgm extension
+    takes privileges the application's role rarely has, so it is left to
+    'manage.py create_search_extension'; until it exists the index is
+    skipped and searches scan the ledger.
+    """
+
+    trigram_ddl = (
+        "CREATE INDEX IF NOT EXISTS ix_transaction_notes_trgm "
+        "ON \"transaction\" USING gin (notes gin_trgm_ops)",
+    )
+    drop_ddl = (
+        # the word index of earlier versions, no longer used
+        "DROP INDEX IF EXISTS ix_transaction_notes_tsv",
+        "DROP INDEX IF EXISTS ix_transaction_notes_trgm",
+    )
+    extension_ddl = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+
+    vector = func.to_tsvector(TS_CONFIG, func.coalesce(Transaction.notes, ''))
+
+    @staticmethod
+    def has_trigrams(connection):
+        return connection.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'") \
+            .scalar() is not None
+
+    def create(self, connection):
+        if self.has_trigrams(connection):
+            for statement in self.trigram_ddl:
+                connection.execute(statement)
+
+    def reindex(self, connection):
+        self.drop(connection)
+        self.create(connection)
+
+    def install(self, connection):
+        """Creates pg_trgm; needs a role allowed to create extensions."""
+        connection.execute(self.extension_ddl)
+
+    def ranked(self, query, terms):
+        if not terms.strip():
+            return super(PostgresNotesIndex, self).ranked(query, terms)
+        rank = func.ts_rank(self.vector,
+                            func.plainto_tsquery(TS_CONFIG, terms))
+        return self.match(query, terms) \
+            .order_by(rank.desc(), Transaction.date_create.desc())
+
+
+BACKENDS = {
+    'sqlite': SqliteNotesIndex(),
+    'postgresql': PostgresNotesIndex(),
+}
+FALLBACK = NotesIndex()
+
+
+def notes_index(bind=None):
+    """Return the notes index for bind, the session's engine by default."""
+    bind = bind or db.session.get_bind()
+    index = BACKENDS.get(bind.dialect.name, FALLBACK)
+    return index if index.supported(bind) else FALLBACK
+
+
+@event.listens_for(Transaction.__table__, 'after_create')
+def _create_notes_index(target, connection, **kw):
+    notes_index(connection).create(connection)
+
+
+@event.listens_for(Transaction.__table__, 'before_drop')
+def _drop_notes_index(target, connection, **kw):
+    notes_index(connection).drop(connection)
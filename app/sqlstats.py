@@ -0,0 +1,178 @@
+# app/sqlstats.py
+
+
+#################
+#### imports ####
+#################
+
+import heapq
+import json
+import logging
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+################
+#### config ####
+################
+
+logger = logging.getLogger(__name__)
+
+# logged statements are cut to this many characters
+STATEMENT_LENGTH = 200
+
+
+#################
+#### helpers ####
+#################
+
+class RequestStats(object):
+    """Statement count, database time and the slowest statements of one
+    request."""
+
+    def __init__(self, keep=3):
+        self.started = time.time()
+        self.count = 0
+        self.seconds = 0.0
+        self.keep = keep
+        self._slowest = []
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if not self.keep:
+            return
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, (seconds, statement))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, statement))
+
+    @property
+    def slowest(self):
+        """(seconds, statement) of the slowest statements, slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+
+class SQLStats(object):
+    """Counts and times the SQL statements every request runs.
+
+    Engine events feed the RequestStats of the current request. With
+    SQL_STATS_HEADERS, which defaults to on in debug mode, the numbers go
+    out as X-SQL-Queries, X-SQL-Time and Server-Timing headers. With
+    SQL_STATS_LOG, which defaults to on otherwise, every request logs one
+    JSON line to the app.sqlstats logger, at WARNING once it runs
+    SQL_STATS_WARN_QUERIES statements or more. A streamed response runs
+    its statements after its headers are sent, so it carries no headers
+    and is logged once it has been closed.
+    """
+
+    def __init__(self, app=None):
+        self.headers = False
+        self.log = False
+        self.keep = 3
+        self.warn_queries = 50
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('SQL_STATS_ENABLED', True):
+            return
+        self.headers = app.config.get('SQL_STATS_HEADERS', app.debug)
+        self.log = app.config.get('SQL_STATS_LOG', not app.debug)
+        self.keep = app.config.get('SQL_STATS_SLOWEST', self.keep)
+        self.warn_queries = app.config.get('SQL_STATS_WARN_QUERIES',
+                                           self.warn_queries)
+        if self.log:
+            # unless logging is set up already, write the lines to stderr
+            if logger.level == logging.NOTSET:
+                logger.setLevel(logging.INFO)
+            if not logger.handlers and not logging.getLogger().handlers:
+                handler = logging.StreamHandler()
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                logger.addHandler(handler)
+        if not event.contains(Engine, 'before_cursor_execute', _start_timer):
+            event.listen(Engine, 'before_cursor_execute', _start_timer)
+            event.listen(Engine, 'after_cursor_execute', _stop_timer)
+            event.listen(Engine, 'handle_error', _drop_timer)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def _start(self):
+        g.sql_stats = RequestStats(self.keep)
+
+    def _finish(self, response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+        if response.is_streamed:
+            # the body runs its statements while it is sent, after the
+            # headers have gone out: leave the stats in place for it and
+            # only log them once the response is closed
+            details = self._details(response)
+            response.call_on_close(lambda: self._report(stats, details))
+            return response
+        g.pop('sql_stats')
+        if self.headers:
+            response.headers['X-SQL-Queries'] = str(stats.count)
+            response.headers['X-SQL-Time'] = '%.1f' % (stats.seconds * 1000)
+            response.headers['X-SQL-Slowest'] = ', '.join(
+                '%.1f' % (seconds * 1000) for seconds, _ in stats.slowest)
+            response.headers['Server-Timing'] = \
+                'db;dur=%.1f;desc="%d queries"' % (stats.seconds * 1000,
+                                                   stats.count)
+        self._report(stats, self._details(response))
+        return response
+
+    def _details(self, response):
+        return {'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'streamed': response.is_streamed}
+
+    def _report(self, stats, details):
+        if not self.log:
+            return
+        level = logging.WARNING if stats.count >= self.warn_queries \
+            else logging.INFO
+        line = dict(details)
+        line.update({
+            'queries': stats.count,
+            'db_ms': round(stats.seconds * 1000, 3),
+            'request_ms': round((time.time() - stats.started) * 1000, 3),
+            'slowest': [{'ms': round(seconds * 1000, 3),
+                         'statement': statement[:STATEMENT_LENGTH]}
+                        for seconds, statement in stats.slowest],
+        })
+        logger.log(level, json.dumps(line, sort_keys=True))
+
+
+def current_stats():
+    """RequestStats of the request being handled, or None."""
+    return g.get('sql_stats') if has_app_context() else None
+
+
+sql_stats = SQLStats()
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_stats_started', []).append(time.time())
+
+
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['sql_stats_started'].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, time.time() - started)
+
+
+def _drop_timer(context):
+    # a failed statement never reaches after_cursor_execute
+    connection = context.connection
+    started = connection is not None and \
+        connection.info.get('sql_stats_started')
+    if started:
+        started.pop()
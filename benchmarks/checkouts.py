@@ -0,0 +1,112 @@
+# benchmarks/checkouts.py
+#
+# Runs concurrent check-outs through Transaction.record, the way
+# tests/test_concurrency.py does, and reports check-outs per second for
+# growing numbers of threads. Half the threads fight over one component,
+# the others spread over the rest, so both the contended and the
+# independent paths are exercised. Every run is checked for overselling.
+#
+#     python -m benchmarks.checkouts [-n checkouts] [threads...]
+
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+
+from app import create_app
+from app.models import db, Component, InsufficientStock, StockLevel, \
+    Transaction, User
+
+THREADS = (1, 2, 4, 8)
+CHECKOUTS = 400
+COMPONENTS = 8
+RETRIES = 20
+
+
+def seed(stock):
+    db.drop_all()
+    db.create_all()
+    db.session.add(User(email='bench@example.com', password='bench'))
+    db.session.execute(Component.__table__.insert(), [
+        dict(sku='K%04d' % i, description='bench %d' % i)
+        for i in range(COMPONENTS)])
+    db.session.commit()
+    for component_id in range(1, COMPONENTS + 1):
+        Transaction.record(component_id, stock, 1, 'stock')
+    db.session.remove()
+
+
+def worker(app, index, attempts, results):
+    # even threads share component 1, odd ones take the rest in turn
+    with app.app_context():
+        for i in range(attempts):
+            component_id = 1 if index % 2 == 0 else \
+                2 + (index + i) % (COMPONENTS - 1)
+            try:
+                Transaction.record(component_id, -1, 1, 'bench',
+                                   retries=RETRIES)
+                results.append(component_id)
+            except InsufficientStock:
+                pass
+        db.session.remove()
+
+
+def measure(app, threads, checkouts):
+    """Seconds and successful check-outs of checkouts spread over
+    threads."""
+    with app.app_context():
+        seed(checkouts)
+    results = []
+    workers = [threading.Thread(target=worker,
+                                args=(app, index, checkouts // threads,
+                                      results))
+               for index in range(threads)]
+    started = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - started
+    with app.app_context():
+        mismatches = StockLevel.verify()
+        oversold = db.session.query(StockLevel.component_id).filter(
+            StockLevel.qty < 0).count()
+        db.session.remove()
+    if mismatches or oversold:
+        raise AssertionError('stock levels off after %d threads: %r' % (
+            threads, mismatches))
+    return elapsed, len(results)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Concurrent check-outs per second.')
+    parser.add_argument('threads', nargs='*', type=int, default=list(THREADS))
+    parser.add_argument('-n', '--checkouts', type=int, default=CHECKOUTS)
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp()
+    app = create_app()
+    # threads need their own connections to a shared database
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(tmp, 'bench.sqlite')
+    try:
+        print('%8s %10s %10s %12s' % ('threads', 'checkouts', 'seconds',
+                                      'checkouts/s'))
+        for threads in args.threads:
+            elapsed, done = measure(app, threads, args.checkouts)
+            print('%8d %10d %10.2f %12.0f' % (threads, done, elapsed,
+                                               done / elapsed))
+    finally:
+        shutil.rmtree(tmp)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
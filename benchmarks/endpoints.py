@@ -0,0 +1,241 @@
+# benchmarks/endpoints.py
+#
+# Drives the busiest pages and API endpoints through the test client
+# against generated databases of growing size. It records latency
+# percentiles and SQL statement counts for every size, then fits how each
+# one grows with the size of the data. An exponent near 0 means constant,
+# near 1 linear, near 2 quadratic. The report is written as JSON; when it
+# is given a baseline report, it exits non-zero if some endpoint now scales
+# worse than it did. A response with an unexpected status fails the run,
+# since an error page would be measured instead of the endpoint.
+#
+#     python -m benchmarks.endpoints [-r requests] [-o report.json]
+#         [--baseline old.json] [sizes...]
+
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+
+from app import create_app
+from app.generator import DataGenerator
+from app.models import db, StockLevel, User
+from tests.helpers import QueryCounter
+
+SIZES = (1000, 10000, 100000)
+REQUESTS = 20
+SEED = 1
+EMAIL = 'user000@example.com'
+PASSWORD = 'password'
+PERCENTILES = (50, 90, 99)
+# how much an exponent may grow over the baseline before it counts
+TOLERANCE = 0.3
+
+ENDPOINTS = (
+    ('components', 'GET', '/component/'),
+    ('transactions', 'GET', '/transactions/'),
+    ('api_components', 'GET', '/api/components'),
+    ('api_categories', 'GET', '/api/categories'),
+    ('check_in_form', 'GET', '/transactions/check-in'),
+    ('check_in', 'POST', '/transactions/check-in'),
+    ('check_out', 'POST', '/transactions/check-out'),
+    ('purchase_orders', 'GET', '/purchase_order/'),
+)
+# the forms redirect once they are accepted
+EXPECTED_STATUS = {'GET': 200, 'POST': 302}
+
+
+class UnexpectedStatus(Exception):
+    pass
+
+
+def catalog(size):
+    """Generator options for a database with size ledger entries; the
+    catalog grows along with the ledger."""
+    return dict(seed=SEED, transactions=size,
+                components=max(50, size // 20),
+                vendors=max(5, size // 2000),
+                purchase_orders=max(20, size // 50),
+                tags=min(1000, max(20, size // 100)),
+                days=365)
+
+
+def seed(size):
+    db.drop_all()
+    db.create_all()
+    options = catalog(size)
+    started = time.time()
+    DataGenerator(**options).run()
+    options['seed_seconds'] = round(time.time() - started, 3)
+    user_id = User.query.filter_by(email=EMAIL).one().id
+    # the best stocked component can take every check-out of the run
+    component_id = db.session.query(StockLevel.component_id) \
+        .order_by(StockLevel.qty.desc()).limit(1).scalar()
+    db.session.remove()
+    return options, user_id, component_id
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def exponent(points):
+    """Least squares slope of log(value) against log(size)."""
+    points = [(math.log(size), math.log(max(value, 1e-6)))
+              for size, value in points]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, y in points)
+    if not spread:
+        return None
+    # "or" turns a flat -0.0 into 0.0
+    return round(sum((x - mean_x) * (y - mean_y)
+                     for x, y in points) / spread, 3) or 0.0
+
+
+def measure(client, engine, method, path, data, requests):
+    """Latencies in ms and statement counts of requests calls, after one
+    warm-up call. Raises UnexpectedStatus unless every call answers with
+    the status expected of method."""
+    call = client.post if method == 'POST' else client.get
+    expected = EXPECTED_STATUS[method]
+    latencies, queries = [], []
+    for attempt in range(requests + 1):
+        with QueryCounter(engine) as counter:
+            started = time.time()
+            response = call(path, data=data)
+            response.get_data()
+            elapsed = (time.time() - started) * 1000
+        if response.status_code != expected:
+            raise UnexpectedStatus('%s %s answered %d instead of %d' % (
+                method, path, response.status_code, expected))
+        if attempt:
+            latencies.append(elapsed)
+            queries.append(counter.count)
+    return expected, latencies, queries
+
+
+def run(sizes, requests):
+    tmp = tempfile.mkdtemp()
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(tmp, 'bench.sqlite')
+    report = {
+        'generated_at': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'database': 'sqlite',
+        'requests': requests,
+        'sizes': [],
+        'endpoints': dict((name, {'method': method, 'path': path,
+                                  'runs': []})
+                          for name, method, path in ENDPOINTS),
+    }
+    try:
+        for size in sizes:
+            with app.app_context():
+                options, user_id, component_id = seed(size)
+                engine = db.engine
+            report['sizes'].append(options)
+            client = app.test_client()
+            client.post('/login', data=dict(email=EMAIL, password=PASSWORD))
+            forms = {
+                'check_in': dict(component=component_id, qty=5,
+                                 notes='benchmark', user_id=user_id,
+                                 checkin='Check In'),
+                'check_out': dict(component=component_id, qty=1,
+                                  notes='benchmark', user_id=user_id,
+                                  checkout='Check Out'),
+            }
+            for name, method, path in ENDPOINTS:
+                status, latencies, queries = measure(
+                    client, engine, method, path, forms.get(name), requests)
+                result = {'size': size, 'status': status,
+                          'mean_ms': round(sum(latencies) / len(latencies), 3),
+                          'max_ms': round(max(latencies), 3),
+                          'queries': percentile(queries, 50),
+                          'max_queries': max(queries)}
+                for p in PERCENTILES:
+                    result['p%d_ms' % p] = round(percentile(latencies, p), 3)
+                report['endpoints'][name]['runs'].append(result)
+                print('%10d %-16s %4d %10.1f %10.1f %8d' % (
+                    size, name, status, result['p50_ms'], result['p99_ms'],
+                    result['queries']))
+    finally:
+        shutil.rmtree(tmp)
+    for endpoint in report['endpoints'].values():
+        runs = endpoint['runs']
+        endpoint['latency_exponent'] = exponent(
+            [(r['size'], r['p50_ms']) for r in runs])
+        endpoint['query_exponent'] = exponent(
+            [(r['size'], r['queries']) for r in runs])
+    return report
+
+
+def regressions(report, baseline, tolerance=TOLERANCE):
+    """(endpoint, measure, baseline exponent, exponent) for every exponent
+    that grew by more than tolerance."""
+    found = []
+    for name, endpoint in sorted(report['endpoints'].items()):
+        before = baseline['endpoints'].get(name, {})
+        for key in ('latency_exponent', 'query_exponent'):
+            if endpoint.get(key) is None or before.get(key) is None:
+                continue
+            if endpoint[key] > before[key] + tolerance:
+                found.append((name, key, before[key], endpoint[key]))
+    return found
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Endpoint latency and query counts against data size.')
+    parser.add_argument('sizes', nargs='*', type=int, default=list(SIZES),
+                        help='Ledger entries of each generated database.')
+    parser.add_argument('-r', '--requests', type=int, default=REQUESTS)
+    parser.add_argument('-o', '--output', default='benchmark-report.json')
+    parser.add_argument('--baseline',
+                        help='Earlier report to check the exponents against.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    print('%10s %-16s %4s %10s %10s %8s' % ('size', 'endpoint', 'code',
+                                            'p50 (ms)', 'p99 (ms)',
+                                            'queries'))
+    try:
+        report = run(sorted(args.sizes), args.requests)
+    except UnexpectedStatus as e:
+        print('FAILED %s' % e)
+        return 2
+    print('%-16s %10s %10s' % ('endpoint', 'latency^', 'queries^'))
+    for name, method, path in ENDPOINTS:
+        endpoint = report['endpoints'][name]
+        print('%-16s %10s %10s' % (name, endpoint['latency_exponent'],
+                                   endpoint['query_exponent']))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Report written to %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for name, key, before, after in found:
+            print('REGRESSION %s %s: %.2f -> %.2f' % (name, key, before,
+                                                      after))
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
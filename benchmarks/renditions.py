@@ -0,0 +1,106 @@
+# benchmarks/renditions.py
+#
+# Compares CPU time and output size of the rendition engine against the
+# resize code PicturesAPI.post used to run, over the sample pictures and
+# a camera sized photo made from one of them.
+#
+#     python -m benchmarks.renditions [repeat]
+
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+from PIL import Image
+
+from app.mod_pictures.renditions import render_all
+
+PICTURES = os.path.join(os.path.dirname(__file__), os.pardir, 'app', 'static',
+                        'pictures')
+RENDITIONS = (('display_', 900), ('thumbnail_', 200))
+CAMERA = (4032, 3024)
+
+
+def legacy(source, folder, filename):
+    # the old request-time path, with its im.reize typo fixed
+    dest = os.path.join(folder, filename)
+    shutil.copy(source, dest)
+    im = Image.open(dest)
+    if im.size[0] == im.size[1] and im.size[0] > 900:
+        im = im.resize((900, 900))
+        im.save(dest)
+    elif im.size[1] > 900:
+        coeff = float(900) / float(im.size[1])
+        im = im.resize((int(im.size[0] * coeff), int(im.size[1] * coeff)))
+        im.save(dest)
+    coeff = float(200) / float(im.size[1])
+    im = im.resize((int(im.size[0] * coeff), int(im.size[1] * coeff)))
+    im.save(os.path.join(folder, 'thumbnail_' + filename))
+
+
+def engine(source, folder, filename, **options):
+    dest = os.path.join(folder, filename)
+    shutil.copy(source, dest)
+    render_all(dest, folder, filename, RENDITIONS, **options)
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(fn, source, filename, repeat, **options):
+    """Best CPU seconds over repeat runs and the bytes written."""
+    best = None
+    for _ in range(repeat):
+        folder = tempfile.mkdtemp()
+        try:
+            started = cpu()
+            fn(source, folder, filename, **options)
+            elapsed = cpu() - started
+            size = sum(os.path.getsize(os.path.join(folder, name))
+                       for name in os.listdir(folder))
+        finally:
+            shutil.rmtree(folder)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def samples(folder):
+    """(filename, path) of every sample picture, plus a camera sized one."""
+    pictures = [(name, os.path.join(PICTURES, name))
+                for name in sorted(os.listdir(PICTURES))]
+    camera = os.path.join(folder, 'camera.jpg')
+    im = Image.open(pictures[0][1]).convert('RGB')
+    im.resize(CAMERA, Image.BICUBIC).save(camera, quality=92)
+    return pictures + [('camera.jpg', camera)]
+
+
+def main(repeat):
+    variants = [('legacy', legacy, {}),
+                ('engine', engine, {}),
+                ('progressive', engine, {'progressive': True})]
+    print('%-32s %-12s %10s %10s' % ('picture', 'path', 'cpu (ms)', 'bytes'))
+    totals = dict((name, [0.0, 0]) for name, fn, options in variants)
+    folder = tempfile.mkdtemp()
+    try:
+        for filename, source in samples(folder):
+            for name, fn, options in variants:
+                seconds, size = measure(fn, source, filename, repeat,
+                                        **options)
+                totals[name][0] += seconds
+                totals[name][1] += size
+                print('%-32s %-12s %10.1f %10d' % (filename[:32], name,
+                                                   seconds * 1000, size))
+    finally:
+        shutil.rmtree(folder)
+    for name, fn, options in variants:
+        print('%-32s %-12s %10.1f %10d' % ('TOTAL', name,
+                                           totals[name][0] * 1000,
+                                           totals[name][1]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
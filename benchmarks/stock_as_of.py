@@ -0,0 +1,93 @@
+# benchmarks/stock_as_of.py
+#
+# Times "quantity on hand as of T" with daily snapshots against a full
+# replay of the ledger, for growing ledger sizes.
+#
+#     python -m benchmarks.stock_as_of 10000 100000 1000000
+
+
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+os.environ.setdefault('APP_SETTINGS', 'config.TestingConfig')
+
+from app import create_app
+from app.models import db, Component, StockSnapshot, Transaction, User
+
+COMPONENTS = 50
+DAYS = 365
+QUERIES = 200
+START = datetime.datetime(2016, 1, 1)
+
+
+def seed(size, rnd):
+    db.drop_all()
+    db.create_all()
+    db.session.add(User(email='bench@example.com', password='bench'))
+    db.session.execute(Component.__table__.insert(), [
+        dict(sku='B%04d' % i, description='bench %s' % i)
+        for i in range(COMPONENTS)])
+    step = datetime.timedelta(days=DAYS) // size
+    rows = []
+    for i in range(size):
+        rows.append(dict(component_id=rnd.randint(1, COMPONENTS), user_id=1,
+                         qty=rnd.choice((-1, 1, 2)),
+                         date_create=START + step * i))
+        if len(rows) == 10000:
+            db.session.execute(Transaction.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Transaction.__table__.insert(), rows)
+    db.session.commit()
+    for day in range(1, DAYS + 1):
+        StockSnapshot.take(START + datetime.timedelta(days=day))
+
+
+def replay(component_id, when):
+    return db.session.query(
+        db.func.coalesce(db.func.sum(Transaction.qty), 0)).filter(
+        Transaction.component_id == component_id,
+        Transaction.date_create <= when).scalar()
+
+
+def measure(fn, probes):
+    def run():
+        for component_id, when in probes:
+            fn(component_id, when)
+    return min(timeit.repeat(run, number=1, repeat=3)) / len(probes)
+
+
+def main(sizes):
+    rnd = random.Random(1)
+    probes = [(rnd.randint(1, COMPONENTS),
+               START + datetime.timedelta(seconds=rnd.randint(0, DAYS * 86400)))
+              for _ in range(QUERIES)]
+    tmp = tempfile.mkdtemp()
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(tmp, 'bench.sqlite')
+    try:
+        with app.app_context():
+            print('%12s %16s %16s' % ('ledger rows', 'snapshot (ms)',
+                                      'replay (ms)'))
+            for size in sizes:
+                seed(size, rnd)
+                for component_id, when in probes[:20]:
+                    assert StockSnapshot.qty_at(component_id, when) == \
+                        replay(component_id, when)
+                print('%12d %16.3f %16.3f' % (
+                    size,
+                    measure(StockSnapshot.qty_at, probes) * 1000,
+                    measure(replay, probes) * 1000))
+            db.session.remove()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 500000])
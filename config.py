@@ -12,6 +12,33 @@ class BaseConfig(object):
     WTF_CSRF_ENABLED = True
     DEBUG_TB_ENABLED = False
     DEBUG_TB_INTERCEPT_REDIRECTS = False
+    USER_CACHE_TTL = 60
+    COUNT_CACHE_TTL = 300
+    COUNT_CACHE_SIZE = 256
+    RESPONSE_CACHE_TYPE = 'simple'
+    RESPONSE_CACHE_TIMEOUT = 300
+    IMPORT_CHUNK_SIZE = 1000
+    PICTURES_FOLDER = os.path.join(basedir, 'app', 'static', 'pictures')
+    ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+    PICTURE_MAX_SIZE = 16 * 1024 * 1024
+    PICTURE_JOB_ATTEMPTS = 3
+    PICTURE_JOB_TIMEOUT = 600
+    # (filename prefix, maximum height), written beside the blob; the blob
+    # keeps the upload as it came, so every prefix must be non-empty
+    PICTURE_RENDITIONS = (('display_', 900), ('thumbnail_', 200))
+    PICTURE_QUALITY = 75
+    PICTURE_PROGRESSIVE = False
+    PICTURE_WEBP = False
+    # None sends pictures from Python; 'x-sendfile' (Apache, lighttpd) or
+    # 'x-accel-redirect' (nginx, with an internal location serving
+    # PICTURES_FOLDER at PICTURE_ACCEL_PREFIX) leaves it to the front end
+    PICTURE_SENDFILE = None
+    PICTURE_ACCEL_PREFIX = '/_pictures/'
+    # per-request SQL statement counts and timings; headers default to on
+    # in debug mode, JSON log lines on the app.sqlstats logger otherwise
+    SQL_STATS_ENABLED = True
+    SQL_STATS_SLOWEST = 3
+    SQL_STATS_WARN_QUERIES = 50
 
 
 class DevConfig(BaseConfig):
@@ -20,7 +47,6 @@ class DevConfig(BaseConfig):
     BCRYPT_LOG_ROUNDS = 1
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'dev.sqlite')
-    PICTURES_FOLDER = os.path.join(basedir,'app','static','pictures')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     DEBUG_TB_ENABLED = False
 
@@ -33,6 +59,7 @@ class TestingConfig(BaseConfig):
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'
     DEBUG_TB_ENABLED = False
+    RESPONSE_CACHE_TYPE = 'null'
 
 
 class ProductionConfig(BaseConfig):
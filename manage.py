@@ -1,10 +1,11 @@
 # manage.py
 
 import os
+import time
 import unittest
 import coverage
 
-from flask_script import Manager
+from flask_script import Command, Manager, Option
 from flask_migrate import Migrate, MigrateCommand
 
 COV = coverage.coverage(
@@ -15,7 +16,11 @@ COV = coverage.coverage(
 COV.start()
 
 from app import create_app
-from app.models import db, User
+from app.models import db, User, StockLevel, StockSnapshot, PurchaseOrder
+from app.search import notes_index
+from app import generator
+from app.importer import import_stream, guess_format, FORMATS, IMPORTERS
+from app.mod_pictures import storage, worker
 
 app = create_app()
 migrate = Migrate(app, db)
@@ -25,6 +30,37 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+class ImportCommand(Command):
+    """Bulk loads components or vendor components from a CSV or JSONL
+    file. Running it again on a file whose import failed resumes it."""
+
+    option_list = (
+        Option('path', help='CSV file with a header line, or JSONL file.'),
+        Option('-k', '--kind', dest='kind', default='components',
+               choices=sorted(IMPORTERS)),
+        Option('-f', '--format', dest='format', default=None,
+               choices=FORMATS,
+               help='Defaults to jsonl for .jsonl files, else csv.'),
+        Option('-c', '--chunk-size', dest='chunk_size', type=int,
+               default=None, help='Rows per insert and commit.'),
+    )
+
+    def run(self, path, kind='components', format=None, chunk_size=None):
+        started = time.time()
+        with open(path, 'rb') as f:
+            run, rejected = import_stream(
+                kind, f, format or guess_format(path),
+                os.path.abspath(path),
+                chunk_size or app.config['IMPORT_CHUNK_SIZE'])
+        for row in rejected:
+            print('Line %(line)s (%(sku)s): %(error)s' % row)
+        print('%d rows imported, %d rejected in %.1fs.' % (
+            run.inserted, run.rejected, time.time() - started))
+
+
+manager.add_command('import', ImportCommand())
+
+
 @manager.command
 def test():
     """Runs the unit tests without coverage."""
@@ -86,9 +122,123 @@ def create_admin():
 
 
 @manager.command
-def create_data():
-    """Creates sample data."""
-    pass
+def rebuild_stock():
+    """Recomputes the stock levels from the transaction ledger."""
+    StockLevel.rebuild()
+
+
+@manager.command
+def verify_stock():
+    """Compares the stock levels against the transaction ledger."""
+    mismatches = StockLevel.verify()
+    for component_id, stored, ledger in mismatches:
+        print('Component %s: stock level %s, ledger %s' %
+              (component_id, stored, ledger))
+    if mismatches:
+        return 1
+    print('Stock levels match the ledger.')
+    return 0
+
+
+@manager.command
+def rebuild_po_totals():
+    """Recomputes the cached purchase order totals from their line items."""
+    PurchaseOrder.rebuild_cached_totals()
+
+
+@manager.command
+def reindex_notes():
+    """Rebuilds the full-text index over transaction notes."""
+    with db.engine.begin() as connection:
+        notes_index(connection).reindex(connection)
+
+
+@manager.command
+def create_search_extension():
+    """Installs pg_trgm for the notes index on Postgres, then rebuilds the
+    index. Run once during setup, as a role allowed to create
+    extensions."""
+    with db.engine.begin() as connection:
+        index = notes_index(connection)
+        if not hasattr(index, 'install'):
+            print('Nothing to install for %s.' % connection.dialect.name)
+            return
+        index.install(connection)
+        index.reindex(connection)
+
+
+@manager.option('-i', '--interval', dest='interval', type=int, default=0,
+                help='Seconds between snapshots; 0 takes a single snapshot.')
+def snapshot_stock(interval=0):
+    """Writes stock snapshots, repeating every interval seconds."""
+    while True:
+        taken_at = StockSnapshot.take()
+        print('Stock snapshot taken at %s' % taken_at.isoformat())
+        if not interval:
+            return
+        time.sleep(interval)
+
+
+@manager.option('-p', '--processes', dest='processes', type=int, default=None,
+                help='Worker processes; defaults to one per core.')
+@manager.option('--once', dest='once', action='store_true', default=False,
+                help='Exit once the queue is empty.')
+def process_pictures(processes=None, once=False):
+    """Makes the renditions of uploaded pictures."""
+    worker.run(processes, once)
+
+
+@manager.command
+def migrate_pictures():
+    """Moves pictures into content addressed blobs, merging duplicates."""
+    moved, merged, missing = storage.migrate(
+        app.config['PICTURES_FOLDER'],
+        [prefix for prefix, height in app.config['PICTURE_RENDITIONS']])
+    print('%d pictures moved, %d duplicates merged, %d files missing.' %
+          (moved, merged, missing))
+
+
+@manager.option('-g', '--grace', dest='grace', type=int, default=3600,
+                help='Spare files younger than this many seconds.')
+def collect_pictures(grace=3600):
+    """Deletes picture blobs no picture references."""
+    removed = storage.collect(
+        app.config['PICTURES_FOLDER'],
+        [prefix for prefix, height in app.config['PICTURE_RENDITIONS']],
+        grace)
+    for name in removed:
+        print('Removed %s' % name)
+    print('%d files removed.' % len(removed))
+
+
+@manager.option('-s', '--seed', dest='seed', type=int,
+                default=generator.DEFAULT_SEED)
+@manager.option('-u', '--users', dest='users', type=int, default=10)
+@manager.option('-v', '--vendors', dest='vendors', type=int, default=50)
+@manager.option('-c', '--components', dest='components', type=int,
+                default=5000)
+@manager.option('--vendor-components', dest='vendor_components', type=int,
+                default=2, help='Average vendors selling each component.')
+@manager.option('--categories', dest='categories', type=int, default=20)
+@manager.option('--tags', dest='tags', type=int, default=200)
+@manager.option('-p', '--purchase-orders', dest='purchase_orders', type=int,
+                default=2000)
+@manager.option('-t', '--transactions', dest='transactions', type=int,
+                default=100000)
+@manager.option('-d', '--days', dest='days', type=int, default=730,
+                help='Days of history, ending on 2017-03-01.')
+@manager.option('--chunk-size', dest='chunk_size', type=int,
+                default=generator.DEFAULT_CHUNK_SIZE,
+                help='Rows per insert.')
+def create_data(**options):
+    """Fills an empty database with seeded sample data; the same options
+    always give the same data."""
+    def log(message):
+        print(message)
+
+    started = time.time()
+    generator.DataGenerator(log=log, **options).run()
+    print('Sample data created in %.1fs.' % (time.time() - started))
 
 
 if __name__ == '__main__':
@@ -1 +1,53 @@
 # tests/helpers.py
+
+
+from sqlalchemy import event
+
+from app.models import db
+
+
+class QueryCounter(object):
+    """Records the SQL statements run on the engine inside a with block.
+
+        with QueryCounter() as queries:
+            self.client.get('/purchase_order/')
+        self.assertLessEqual(queries.count, 5)
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or db.engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class QueryBudgetMixin(object):
+    """assertQueryBudget for test cases with a test client: fails, listing
+    the statements, when a request runs more of them than its budget.
+
+        self.assertQueryBudget(3, '/component/')
+    """
+
+    def assertQueryBudget(self, budget, url, method='get', **kwargs):
+        # requests share the test's session, so start each one empty
+        db.session.expunge_all()
+        with QueryCounter() as queries:
+            response = getattr(self.client, method)(url, **kwargs)
+        if queries.count > budget:
+            self.fail('%s %s ran %d queries, over its budget of %d:\n%s' % (
+                method.upper(), url, queries.count, budget,
+                '\n'.join(queries.statements)))
+        return response
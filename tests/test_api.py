@@ -3,11 +3,14 @@
 
 import unittest
 
-from app.models import Component, Tag
+from app import search
+from app.models import db, Component, StockLevel, Tag, Transaction
 from tests.base import BaseTestCase
+from tests.helpers import QueryCounter
 
 
 from flask import jsonify
+import datetime
 import json
 
 class TestApi(BaseTestCase):
@@ -170,6 +173,288 @@ class TestApi(BaseTestCase):
             # raise ValueError(comp.sku)
             self.assertEqual(comp.sku, u'OK123')
             self.assertEqual(comp.description, u'should update')
+
+    def test_stock_as_of(self):
+        self.login()
+        self.create_component()
+        db.session.add(Transaction(component_id=1, user_id=1, qty=4,
+                                   date_create=datetime.datetime(2017, 1, 1)))
+        db.session.add(Transaction(component_id=1, user_id=1, qty=-1,
+                                   date_create=datetime.datetime(2017, 2, 1)))
+        db.session.commit()
+        response = self.client.get('/api/stock/1?as_of=2017-01-15T00:00:00')
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['qty'], 4)
+        response = self.client.get('/api/stock?as_of=2017-03-01T00:00:00')
+        self.assertEqual(json.loads(response.data.decode('utf-8')),
+                         [{'component_id': 1, 'qty': 3,
+                           'as_of': '2017-03-01T00:00:00'}])
+        response = self.client.get('/api/stock/42')
+        self.assertEqual(response.status_code, 404)
+
+    def test_bulk_transactions(self):
+        self.login()
+        self.create_component()
+        response = self.client.post(
+            '/api/transactions/check-in',
+            data=json.dumps([{'component_id': 1, 'qty': 5, 'notes': 'pallet'},
+                             {'component_id': 1, 'qty': 3}]),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Component.query.get(1).qty, 8)
+        response = self.client.post(
+            '/api/transactions/check-out',
+            data=json.dumps([{'component_id': 1, 'qty': 6},
+                             {'component_id': 1, 'qty': 6},
+                             {'component_id': 7, 'qty': 1},
+                             {'component_id': 1, 'qty': 'x'}]),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        errors = json.loads(response.data.decode('utf-8'))['errors']
+        self.assertEqual([e['line'] for e in errors], [1, 2, 3])
+        self.assertIn('only 2 available', errors[0]['error'])
+        self.assertEqual(Transaction.query.count(), 2)
+        self.assertEqual(Component.query.get(1).qty, 8)
+        # a line that fails takes nothing from the lines after it
+        response = self.client.post(
+            '/api/transactions/check-out',
+            data=json.dumps([{'component_id': 1, 'qty': 10},
+                             {'component_id': 1, 'qty': 5},
+                             {'component_id': 1, 'qty': 5}]),
+            content_type='application/json')
+        errors = json.loads(response.data.decode('utf-8'))['errors']
+        self.assertEqual([(e['line'], e['error']) for e in errors],
+                         [(0, 'Not enough items, only 8 available'),
+                          (2, 'Not enough items, only 3 available')])
+        response = self.client.post(
+            '/api/transactions/check-out',
+            data=json.dumps([{'component_id': 1, 'qty': 8}]),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Component.query.get(1).qty, 0)
+
+    def test_search_transaction_notes(self):
+        self.login()
+        self.create_component()
+        for notes in ('red resistor reel', 'blue resistor', 'red led',
+                      'resistor resistor resistor', None):
+            db.session.add(Transaction(component_id=1, user_id=1, qty=1,
+                                       notes=notes))
+        db.session.commit()
+        # bulk inserts skip the ORM but are indexed all the same
+        db.session.execute(Transaction.__table__.insert(), [
+            dict(component_id=1, user_id=1, qty=1, notes='green resistors')])
+        entry = Transaction.query.filter_by(notes='red led').first()
+        entry.notes = 'amber led'
+        db.session.delete(Transaction.query.filter_by(
+            notes='blue resistor').first())
+        db.session.commit()
+
+        def search(q):
+            response = self.client.get('/api/transactions/search?q=' + q)
+            self.assertEqual(response.status_code, 200)
+            return [t['notes']
+                    for t in json.loads(response.data.decode('utf-8'))]
+
+        found = search('resistor')
+        self.assertEqual(found[0], 'resistor resistor resistor')
+        self.assertEqual(sorted(found), ['green resistors',
+                                         'red resistor reel',
+                                         'resistor resistor resistor'])
+        self.assertEqual(search('red%20res'), ['red resistor reel'])
+        self.assertEqual(search('led'), ['amber led'])
+        self.assertEqual(search('"AND*'), [])
+        response = self.client.get('/api/transactions/search')
+        self.assertEqual(response.status_code, 400)
+
+    def test_every_notes_index_finds_the_same_entries(self):
+        self.create_component()
+        for notes in ('Red Resistor reel', 'resistors, 10% tolerance',
+                      'led_strip', 'PO-1234 resistor', None):
+            db.session.add(Transaction(component_id=1, user_id=1, qty=1,
+                                       notes=notes))
+        db.session.commit()
+        index = search.notes_index()
+        self.assertIsInstance(index, search.SqliteNotesIndex)
+
+        def found(index, terms):
+            return sorted(t.notes for t in index.ranked(
+                Transaction.query.filter(Transaction.notes != None), terms))
+
+        for terms in ('sisto', 'RESISTOR', ' red res ', '10%', 'd_s',
+                      'O-12', 're', 'xyz', '"AND*'):
+            self.assertEqual(found(index, terms),
+                             found(search.FALLBACK, terms), terms)
+        self.assertEqual(found(index, 'sisto'),
+                         ['PO-1234 resistor', 'Red Resistor reel',
+                          'resistors, 10% tolerance'])
+
+    def test_database_without_fts5_falls_back_to_a_scan(self):
+        index = search.BACKENDS['sqlite']
+        self.addCleanup(setattr, index, 'available', index.available)
+        db.session.remove()
+        db.drop_all()
+        index.available = False
+        db.create_all()
+        self.assertIs(search.notes_index(), search.FALLBACK)
+        self.assertNotIn(search.FTS_TABLE, db.engine.table_names())
+        db.session.add(Component(sku='F0001', description='fallback'))
+        db.session.add(Transaction(component_id=1, user_id=1, qty=1,
+                                   notes='found by scanning'))
+        db.session.commit()
+        self.assertEqual([t.notes for t in search.notes_index().ranked(
+            Transaction.query, 'scan')], ['found by scanning'])
+
+    def tag_components(self, count, offset=0):
+        for i in range(offset, offset + count):
+            component = Component(sku='R%04d' % i,
+                                  description='resistor %s ohm' % i)
+            db.session.add(component)
+            component.tag_with('smd' if i % 2 else 'through hole', 'mount')
+            component.tag_with('e%s' % (i % 3), 'series')
+
+    def test_component_search_facets(self):
+        self.login()
+        self.tag_components(6)
+        db.session.add(Component(sku='C0001', description='capacitor'))
+        db.session.commit()
+
+        def search(query):
+            response = self.client.get('/api/components/search?' + query)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.data.decode('utf-8'))
+
+        result = search('q=res')
+        self.assertEqual(result['total'], 6)
+        self.assertEqual(search('q=C0')['total'], 1)
+        self.assertEqual(search('q=%25')['total'], 0)
+        result = search('q=R&tag=smd&tag=e1')
+        self.assertEqual([c['sku'] for c in result['components']],
+                         ['R0001'])
+        result = search('category=series&tag=SMD&limit=2')
+        self.assertEqual(result['total'], 3)
+        self.assertEqual(len(result['components']), 2)
+        self.assertEqual(dict((f['name'], f['count'])
+                              for f in result['facets']),
+                         {'SMD': 3, 'E0': 1, 'E1': 1, 'E2': 1})
+        self.assertEqual(search('category=colour')['total'], 0)
+
+    def test_component_search_query_count(self):
+        self.login()
+        self.tag_components(5)
+        db.session.commit()
+        db.session.expunge_all()
+        with QueryCounter() as small:
+            self.client.get('/api/components/search?category=mount')
+        self.tag_components(20, offset=5)
+        db.session.commit()
+        db.session.expunge_all()
+        with QueryCounter() as large:
+            self.client.get('/api/components/search?category=mount')
+        self.assertEqual(small.count, large.count)
+        self.assertLessEqual(large.count, 6)
+
+    def test_components_limit_cursor_fields(self):
+        self.login()
+        self.tag_components(7)
+        db.session.commit()
+        seen, url = [], '/api/components?limit=3&fields=sku,qty'
+        while url:
+            db.session.expunge_all()
+            with QueryCounter() as queries:
+                response = self.client.get(url)
+            self.assertFalse(any('tag' in q or 'picture' in q
+                                 for q in queries.statements))
+            page = json.loads(response.data.decode('utf-8'))
+            self.assertTrue(all(sorted(c) == ['qty', 'sku'] for c in page))
+            seen.extend(c['sku'] for c in page)
+            cursor = response.headers.get('X-Next-Cursor')
+            url = cursor and '/api/components?limit=3&fields=sku,qty' \
+                '&cursor=' + cursor
+        self.assertEqual(seen, ['R%04d' % i for i in range(7)])
+        response = self.client.get('/api/components?fields=sku,price')
+        self.assertEqual(response.status_code, 400)
+
+    def test_components_stream(self):
+        self.login()
+        self.tag_components(7)
+        db.session.commit()
+
+        def components(response):
+            # tag collections carry no order of their own
+            result = json.loads(response.data.decode('utf-8'))
+            for component in result:
+                component.get('tags', []).sort(key=lambda t: t['id'])
+            return result
+
+        plain = components(self.client.get('/api/components'))
+        for fields in ('', '&fields=id,sku,qty'):
+            streamed = self.client.get('/api/components?stream=1' + fields)
+            self.assertEqual(streamed.mimetype, 'application/json')
+            expected = plain
+            if fields:
+                expected = [dict((k, c[k]) for k in ('id', 'sku', 'qty'))
+                            for c in plain]
+            self.assertEqual(components(streamed), expected)
+        streamed = self.client.get('/api/components?stream=1&limit=2&cursor=3')
+        self.assertEqual([c['id'] for c in
+                          json.loads(streamed.data.decode('utf-8'))],
+                         ['4', '5'])
+
+    def test_conditional_get(self):
+        self.login()
+        self.tag_components(3)
+        db.session.commit()
+
+        def get(url, etag):
+            return self.client.get(url, headers={'If-None-Match': etag})
+
+        first = self.client.get('/api/components')
+        etag = first.headers['ETag']
+        categories = self.client.get('/api/categories').headers['ETag']
+        db.session.expunge_all()
+        with QueryCounter() as queries:
+            response = get('/api/components', etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertFalse(any('FROM component' in q
+                             for q in queries.statements))
+        self.assertEqual(get('/api/components?fields=sku', etag).status_code,
+                         200)
+        # a check-in changes quantities but no tags
+        self.client.post('/api/transactions/check-in',
+                         data=json.dumps([{'component_id': 1, 'qty': 2}]),
+                         content_type='application/json')
+        response = get('/api/components', etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertEqual(get('/api/categories', categories).status_code, 304)
+        # tagging changes both
+        Component.query.get(2).tag_with('e5', 'series')
+        self.assertEqual(get('/api/components', etag).status_code, 200)
+        self.assertEqual(get('/api/categories', categories).status_code, 200)
+        response = self.client.get('/api/single-tags')
+        self.assertEqual(self.client.get('/api/single-tags', headers={
+            'If-Modified-Since': response.headers['Last-Modified']
+        }).status_code, 304)
+
+    def test_conditional_get_follows_stock_commit_order(self):
+        self.login()
+        self.tag_components(2)
+        db.session.commit()
+        for component_id in (1, 2):
+            Transaction.record(component_id, 5, 1)
+        etag = self.client.get('/api/components').headers['ETag']
+        # a check-in stamped before the newest stock change, committed after
+        Transaction.record(1, 1, 1)
+        table = StockLevel.__table__
+        db.session.execute(table.update()
+                           .where(table.c.component_id == 1)
+                           .values(date_modified=datetime.datetime(2000, 1, 1)))
+        db.session.commit()
+        response = self.client.get('/api/components',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
     def test_about(self):
         # Ensure about route behaves correctly.
         response = self.client.get('/about', follow_redirects=True)
@@ -0,0 +1,71 @@
+# tests/test_concurrency.py
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tests.base import BaseTestCase
+from app.models import db, Component, StockLevel, Transaction, \
+    InsufficientStock
+
+
+class TestConcurrentCheckout(BaseTestCase):
+
+    THREADS = 8
+    ATTEMPTS = 15
+    STOCK = 40
+
+    def create_app(self):
+        app = super(TestConcurrentCheckout, self).create_app()
+        # threads need their own connections to a shared database
+        self.db_dir = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(self.db_dir, 'stress.sqlite')
+        return app
+
+    def tearDown(self):
+        super(TestConcurrentCheckout, self).tearDown()
+        shutil.rmtree(self.db_dir)
+
+    def checkout_worker(self, component_ids, results):
+        with self.app.app_context():
+            for i in range(self.ATTEMPTS):
+                component_id = component_ids[i % len(component_ids)]
+                try:
+                    Transaction.record(component_id, -1, 1, 'stress',
+                                       retries=20)
+                    results.append(component_id)
+                except InsufficientStock:
+                    pass
+            db.session.remove()
+
+    def test_concurrent_checkouts_never_oversell(self):
+        for sku in ('A0001', 'B0001'):
+            db.session.add(Component(sku=sku, description=sku))
+        db.session.commit()
+        for component_id in (1, 2):
+            Transaction.record(component_id, self.STOCK, 1, 'stock')
+        db.session.remove()
+
+        # benchmarks/checkouts.py measures the check-outs per second
+        results = []
+        threads = [threading.Thread(target=self.checkout_worker,
+                                    args=([1, 2], results))
+                   for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        attempts = self.THREADS * self.ATTEMPTS
+        self.assertEqual(len(results), min(attempts, 2 * self.STOCK))
+        for component_id in (1, 2):
+            self.assertEqual(StockLevel.query.get(component_id).qty, 0)
+        self.assertEqual(StockLevel.verify(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
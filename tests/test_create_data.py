@@ -0,0 +1,65 @@
+# tests/test_create_data.py
+
+
+import unittest
+
+from tests.base import BaseTestCase
+from app.models import db, Component, PurchaseOrder, StockLevel, Tag, \
+    Transaction, Vendor, VendorComponent
+from app.generator import DataGenerator, base36
+
+
+SMALL = dict(users=3, vendors=4, components=30, purchase_orders=10,
+             categories=5, tags=25, transactions=500, days=30)
+
+
+class TestCreateData(BaseTestCase):
+
+    def generate(self, **options):
+        DataGenerator(**dict(SMALL, **options)).run()
+
+    def reset(self):
+        self.tearDown()
+        self.setUp()
+
+    def ledger(self):
+        return db.session.query(
+            Transaction.component_id, Transaction.user_id, Transaction.qty,
+            Transaction.notes, Transaction.date_create
+        ).order_by(Transaction.id).all()
+
+    def test_counts_and_consistent_stock(self):
+        self.generate()
+        self.assertEqual(Component.query.count(), 30)
+        self.assertEqual(Vendor.query.filter(
+            Vendor.name.like('Vendor %')).count(), 4)
+        self.assertEqual(Tag.query.count(), 25)
+        self.assertEqual(Transaction.query.count(), 500)
+        self.assertTrue(VendorComponent.query.count() >= 30)
+        self.assertEqual(StockLevel.verify(), [])
+        self.assertEqual(StockLevel.query.filter(StockLevel.qty < 0).count(),
+                         0)
+        dates = [row.date_create for row in self.ledger()]
+        self.assertEqual(dates, sorted(dates))
+        self.assertTrue(all(o.cached_total == o.total
+                            for o in PurchaseOrder.query))
+
+    def test_same_seed_same_data(self):
+        self.generate(seed=7)
+        first = self.ledger()
+        self.reset()
+        self.generate(seed=7)
+        self.assertEqual(self.ledger(), first)
+        self.reset()
+        self.generate(seed=8)
+        self.assertNotEqual(self.ledger(), first)
+
+    def test_refuses_a_database_with_data(self):
+        db.session.add(Component(sku=base36(0), description='already here'))
+        db.session.commit()
+        with self.assertRaises(ValueError):
+            self.generate()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# tests/test_import.py
+
+
+import csv
+import io
+import json
+import unittest
+
+from sqlalchemy.exc import IntegrityError
+
+from tests.base import BaseTestCase
+from tests.helpers import QueryCounter
+from app.models import db, Component, ImportRun, Vendor, VendorComponent
+from app.importer import ComponentImporter, VendorComponentImporter, \
+    import_stream, read_csv
+
+
+class FailingStream(object):
+    """Gives up after lines lines, like a dropped connection."""
+
+    def __init__(self, data, lines):
+        self.stream = io.BytesIO(data)
+        self.lines = lines
+
+    def readline(self):
+        if not self.lines:
+            raise IOError('connection lost')
+        self.lines -= 1
+        return self.stream.readline()
+
+
+class TestImport(BaseTestCase):
+
+    def setUp(self):
+        super(TestImport, self).setUp()
+        db.session.add(Component(sku='A0001', description='already there'))
+        db.session.commit()
+        self.client.post('/login', data=dict(email="ad@min.com",
+                                             password="admin_user"))
+
+    def post(self, path, data, content_type='text/csv'):
+        response = self.client.post(path, data=data,
+                                    content_type=content_type)
+        return response, json.loads(response.data.decode('utf-8'))
+
+    def test_csv_rows_are_checked_and_rejected_rows_reported(self):
+        data = (b'SKU,Description\n'
+                b'B0001,first\n'
+                b'A0001,clashes with a stored component\n'
+                b'B0002,second\n'
+                b'B0001,clashes with an earlier row\n'
+                b'TOOLONG,sku too long\n'
+                b'B0003,\n'
+                b'\n'
+                b'B0004,"quoted, with a comma"\n')
+        response, body = self.post('/api/import/components', data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((body['run']['status'], body['run']['inserted'],
+                          body['run']['rejected']), ('done', 3, 4))
+        self.assertEqual([(r['line'], r['error']) for r in body['rejected']],
+                         [(3, 'duplicate sku'), (5, 'duplicate sku'),
+                          (6, 'sku is longer than 5 characters'),
+                          (7, 'description is required')])
+        self.assertEqual(
+            [c.description for c in Component.query.order_by(Component.sku)
+             if c.sku.startswith('B')],
+            ['first', 'second', 'quoted, with a comma'])
+
+    def test_unreadable_csv_lines_are_rejected(self):
+        data = (b'sku,description\n'
+                b'C0001,first\n'
+                b'C0002,caf\xe9 in latin-1\n'
+                b'C0003,' + b'x' * (csv.field_size_limit() + 1) + b'\n'
+                b'C0004,last\n')
+        response, body = self.post('/api/import/components', data)
+        self.assertEqual((body['run']['status'], body['run']['inserted'],
+                          body['run']['rejected']), ('done', 2, 2))
+        self.assertEqual([(r['line'], r['sku'], r['error'][:12])
+                          for r in body['rejected']],
+                         [(3, None, 'not valid UT'), (4, None, 'not valid CS')])
+        self.assertEqual(
+            sorted(c.sku for c in Component.query
+                   if c.sku.startswith('C')), ['C0001', 'C0004'])
+
+    def test_jsonl_goes_in_one_insert_per_chunk(self):
+        lines = [json.dumps({'sku': 'J%04d' % i, 'description': 'row %d' % i})
+                 for i in range(10)]
+        lines.insert(4, '{not json')
+        data = '\n'.join(lines).encode('utf-8')
+        with QueryCounter() as queries:
+            response, body = self.post(
+                '/api/import/components?chunk_size=4', data,
+                'application/x-ndjson')
+        self.assertEqual((body['run']['inserted'], body['run']['rejected']),
+                         (10, 1))
+        self.assertEqual(body['rejected'],
+                         [{'line': 5, 'sku': None,
+                           'error': 'not a JSON object'}])
+        inserts = [s for s in queries.statements
+                   if s.startswith('INSERT INTO component ')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(Component.query.count(), 11)
+
+    def test_vendor_components_name_their_vendor(self):
+        db.session.add(Vendor(name='Achme'))
+        db.session.commit()
+        data = (b'sku,description,vendor,vendor_id\n'
+                b'V0001,by name,Achme,\n'
+                b'V0002,by id,,1\n'
+                b'V0001,same sku again,Achme,\n'
+                b'V0003,nobody,Nobody Inc,\n')
+        response, body = self.post('/api/import/vendor-components', data)
+        self.assertEqual((body['run']['inserted'], body['run']['rejected']),
+                         (2, 2))
+        self.assertEqual([r['error'] for r in body['rejected']],
+                         ['duplicate sku', 'unknown vendor'])
+        self.assertEqual(
+            sorted((v.sku, v.vendor.name) for v in VendorComponent.query),
+            [('V0001', 'Achme'), ('V0002', 'Achme')])
+
+    def test_failed_import_resumes_after_last_chunk(self):
+        data = b'sku,description\n' + b''.join(
+            b'R%04d,row %d\n' % (i, i) for i in range(10))
+        with self.assertRaises(IOError):
+            import_stream('components', FailingStream(data, 8), 'csv',
+                          'catalog.csv', chunk_size=3)
+        run = ImportRun.query.one()
+        self.assertEqual((run.status, run.position, run.inserted),
+                         ('failed', 6, 6))
+        self.assertEqual(run.error, 'connection lost')
+
+        run, rejected = import_stream('components', io.BytesIO(data), 'csv',
+                                      'catalog.csv', chunk_size=3)
+        self.assertEqual((run.id, run.status, run.position, run.inserted,
+                          run.rejected), (1, 'done', 10, 10, 0))
+        self.assertEqual(rejected, [])
+        self.assertEqual(Component.query.filter(
+            Component.sku.like('R%')).count(), 10)
+
+    def test_rows_stored_meanwhile_are_rejected_as_duplicates(self):
+        db.session.add(Vendor(name='Achme'))
+        db.session.commit()
+        importer = VendorComponentImporter()
+        # stored after the importer fetched the known keys
+        db.session.add(VendorComponent(sku='V0001', description='first',
+                                       vendor_id=1))
+        db.session.commit()
+        run = importer.run(read_csv(io.BytesIO(
+            b'sku,description,vendor_id\n'
+            b'V0001,again,1\n'
+            b'V0002,new,1\n')), ImportRun.start('vendor-components'))
+        self.assertEqual((run.status, run.inserted, run.rejected),
+                         ('done', 1, 1))
+        self.assertEqual(importer.rejected,
+                         [{'line': 2, 'sku': 'V0001',
+                           'error': 'duplicate sku'}])
+        self.assertEqual(VendorComponent.query.count(), 2)
+
+    def test_other_constraint_failures_are_not_retried(self):
+        class NoDescription(ComponentImporter):
+            def values(self, row):
+                values = super(NoDescription, self).values(row)
+                values['description'] = None
+                return values
+
+        run = ImportRun.start('components')
+        with QueryCounter() as queries:
+            with self.assertRaises(IntegrityError):
+                NoDescription().run(read_csv(io.BytesIO(
+                    b'sku,description\nN0001,gone\n')), run)
+        inserts = [q for q in queries.statements
+                   if q.startswith('INSERT INTO component ')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(run.status, 'failed')
+
+    def test_import_needs_known_kind_and_format(self):
+        response = self.client.post('/api/import/tags', data=b'sku\n')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post('/api/import/components?format=xml',
+                                    data=b'sku\n')
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,16 @@
 # tests/test_vendor.py
 
 
+import csv
+import datetime
 import unittest
 
 from tests.base import BaseTestCase
-from app.models import LineItem, Component, Vendor, VendorComponent
+from tests.helpers import QueryCounter
+from app.models import db, LineItem, Component, Vendor, VendorComponent, \
+    StockLevel, StockSnapshot, Transaction, PurchaseOrder, Address
+from app import pagination
+from app.pagination import cached_count, clear_counts
 from app.mod_inventory.forms import VendorCreateForm, PurchaseOrderForm, \
     ComponentCreateForm
 
@@ -65,6 +71,34 @@ class TestInventoryBlueprint(BaseTestCase):
                                           user_id=1),
                                 follow_redirects=True)
 
+    def seed_purchase_orders(self, vendors, orders_per_vendor):
+        offset = Vendor.query.count()
+        for v in range(offset, offset + vendors):
+            vendor = Vendor(name='Vendor %s' % v,
+                            address=Address(line1='%s Main St' % v))
+            part = VendorComponent(sku='P%04d' % v, description='part',
+                                   vendor=vendor)
+            for _ in range(orders_per_vendor):
+                order = PurchaseOrder(created_on=datetime.datetime.now(),
+                                      vendor=vendor, user_id=1)
+                order.line_item.append(LineItem(vendor_component=part,
+                                                quantity=1, total_price=1))
+                db.session.add(order)
+        db.session.commit()
+
+    def assertConstantQueries(self, url, grow, max_queries):
+        # requests share the test's session, so start each one empty
+        db.session.expunge_all()
+        with QueryCounter() as small:
+            self.client.get(url)
+        grow()
+        db.session.expunge_all()
+        with QueryCounter() as large:
+            response = self.client.get(url)
+        self.assertEqual(small.count, large.count)
+        self.assertLessEqual(large.count, max_queries)
+        return response
+
 #############
 ### Tests ###
 #############
@@ -425,3 +459,296 @@ class TestInventoryBlueprint(BaseTestCase):
                           user_id="1"),
                 follow_redirects=True)
             self.assertIn(b'qty', response.data)
+            # a negative check-in would be a check-out past the guard
+            for action, button in (('check-in', 'checkin'),
+                                   ('check-out', 'checkout')):
+                response = self.client.post(
+                    '/transactions/' + action,
+                    data={'component': '1', 'qty': '-50', 'user_id': '1',
+                          'notes': 'negative', button: 'go'})
+                # the form is shown again rather than redirecting
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(StockLevel.query.get(1).qty, 6)
+
+    def test_stock_level_follows_transactions(self):
+        with self.client:
+            self.login()
+            self.create_component()
+            self.client.post(
+                '/transactions/check-in',
+                data=dict(component='1',
+                          qty='6',
+                          notes="Checking in 6 of em\'",
+                          checkin="Check In",
+                          user_id="1"))
+            self.client.post(
+                '/transactions/check-out',
+                data=dict(component='1',
+                          qty='2',
+                          notes="Checking out 2 of em\'",
+                          checkout="Check Out",
+                          user_id="1"))
+        self.assertEqual(StockLevel.query.get(1).qty, 4)
+        self.assertEqual(Component.query.get(1).qty, 4)
+        self.assertEqual(StockLevel.verify(), [])
+
+    def test_rebuild_stock_level(self):
+        with self.client:
+            self.login()
+            self.create_component()
+        db.session.add(Transaction(component_id=1, user_id=1, qty=5))
+        db.session.commit()
+        StockLevel.query.delete()
+        db.session.commit()
+        self.assertEqual(StockLevel.verify(), [(1, 0, 5)])
+        StockLevel.rebuild()
+        self.assertEqual(StockLevel.verify(), [])
+        self.assertEqual(Component.query.get(1).qty, 5)
+
+    def test_stock_snapshot_qty_at(self):
+        with self.client:
+            self.login()
+            self.create_component()
+        day = datetime.datetime(2017, 1, 1)
+        for offset, qty in ((0, 10), (1, -3), (3, 5)):
+            db.session.add(Transaction(
+                component_id=1, user_id=1, qty=qty,
+                date_create=day + datetime.timedelta(days=offset)))
+        db.session.commit()
+        StockSnapshot.take(day + datetime.timedelta(days=2))
+        db.session.add(Transaction(
+            component_id=1, user_id=1, qty=-2,
+            date_create=day + datetime.timedelta(days=4)))
+        db.session.commit()
+        self.assertEqual(StockSnapshot.query.count(), 1)
+        self.assertEqual(StockSnapshot.query.first().qty, 7)
+        self.assertEqual(
+            StockSnapshot.qty_at(1, day + datetime.timedelta(hours=12)), 10)
+        self.assertEqual(
+            StockSnapshot.qty_at(1, day + datetime.timedelta(days=3)), 12)
+        self.assertEqual(
+            StockSnapshot.qty_at(1, day + datetime.timedelta(days=5)), 10)
+        self.assertEqual(
+            StockSnapshot.quantities_at(day + datetime.timedelta(days=3)),
+            {1: 12})
+
+    def test_stock_snapshot_waits_for_late_commits(self):
+        with self.client:
+            self.login()
+            self.create_component()
+        # stamped a moment ago, but only committed after the snapshot
+        stamped = datetime.datetime.utcnow() - datetime.timedelta(seconds=5)
+        self.assertLess(StockSnapshot.take(), stamped)
+        self.assertLess(StockSnapshot.take(datetime.datetime.utcnow()),
+                        stamped)
+        db.session.add(Transaction(component_id=1, user_id=1, qty=4,
+                                   date_create=stamped))
+        db.session.commit()
+        now = datetime.datetime.utcnow()
+        self.assertEqual(StockSnapshot.qty_at(1, now), 4)
+        self.assertEqual(StockSnapshot.quantities_at(now), {1: 4})
+
+    def test_purchase_order_totals_in_sql(self):
+        with self.client:
+            self.login()
+            self.create_purchase_order()
+        order = PurchaseOrder.query.get(1)
+        order.line_item.append(LineItem(vendor_component_id=1, quantity=1,
+                                        total_price=3.50))
+        order.shipping = 1
+        db.session.commit()
+        self.assertEqual(float(db.session.query(PurchaseOrder.sub_total)
+                               .scalar()), 5.50)
+        self.assertEqual(float(db.session.query(PurchaseOrder.total)
+                               .scalar()), 6.50)
+        self.assertEqual(float(PurchaseOrder.query.get(1).cached_total), 6.50)
+        self.assertEqual(PurchaseOrder.query.filter(
+            PurchaseOrder.total > 6).count(), 1)
+        db.session.delete(LineItem.query.get(1))
+        db.session.commit()
+        self.assertEqual(float(PurchaseOrder.query.get(1).cached_total), 4.50)
+
+    def test_view_purchase_order_sorted_by_total(self):
+        with self.client:
+            self.login()
+            self.create_purchase_order()
+            self.client.post('/purchase_order/create/1',
+                             data=dict(sku=12345, quantity=1,
+                                       total_price=9.00, user_id=1))
+            response = self.client.get('/purchase_order/?sort=-total')
+            self.assertLess(response.data.index(b'9.00'),
+                            response.data.index(b'2.00'))
+            response = self.client.get('/purchase_order/?min_total=5')
+            self.assertIn(b'9.00', response.data)
+            self.assertNotIn(b'2.00', response.data)
+
+    def test_view_purchase_order_all_query_count(self):
+        with self.client:
+            self.login()
+            self.seed_purchase_orders(5, 5)
+            response = self.assertConstantQueries(
+                '/purchase_order/?page=2',
+                lambda: self.seed_purchase_orders(20, 5), 3)
+            self.assertIn(b'page=3', response.data)
+            self.assertIn(b'Vendor 4', response.data)
+
+    def test_view_purchase_order_query_count(self):
+        with self.client:
+            self.login()
+            self.seed_purchase_orders(1, 1)
+
+            def add_lines():
+                order = PurchaseOrder.query.get(1)
+                for v in range(5):
+                    part = VendorComponent(sku='Q%04d' % v,
+                                           description='line %s' % v,
+                                           vendor_id=1)
+                    order.line_item.append(LineItem(
+                        vendor_component=part, quantity=1, total_price=1))
+                db.session.commit()
+            response = self.assertConstantQueries(
+                '/purchase_order/1', add_lines, 3)
+            self.assertIn(b'line 4', response.data)
+
+    def test_view_vendor_all_query_count(self):
+        with self.client:
+            self.login()
+            self.seed_purchase_orders(25, 1)
+            response = self.assertConstantQueries(
+                '/inventory/vendor/',
+                lambda: self.seed_purchase_orders(50, 1), 3)
+            self.assertIn(b'page=2', response.data)
+
+    def test_view_vendor_query_count(self):
+        with self.client:
+            self.login()
+            self.seed_purchase_orders(1, 25)
+
+            def add_orders():
+                for _ in range(50):
+                    db.session.add(PurchaseOrder(
+                        created_on=datetime.datetime.now(),
+                        vendor_id=1, user_id=1))
+                db.session.commit()
+            response = self.assertConstantQueries(
+                '/inventory/vendor/1', add_orders, 4)
+            self.assertIn(b'page=2', response.data)
+
+    def seed_ledger(self, rows):
+        # timestamps repeat so the id tie-break is exercised
+        start = datetime.datetime(2016, 1, 1)
+        db.session.execute(Transaction.__table__.insert(), [
+            dict(component_id=1, user_id=1, qty=1, notes='row %03d' % i,
+                 date_create=start + datetime.timedelta(minutes=i // 3))
+            for i in range(rows)])
+        db.session.commit()
+
+    def test_transactions_cursor_walks_whole_ledger(self):
+        with self.client:
+            self.login()
+            self.create_component()
+            self.seed_ledger(50)
+            clear_counts()
+            seen, pages, url = [], [], '/transactions/?period=all'
+            while url:
+                self.client.get(url)
+                page = self.get_context_variable('transactions')
+                seen.extend(t.notes for t in page.items)
+                pages.append(page)
+                url = page.has_next and \
+                    '/transactions/?period=all&after=' + page.next_cursor
+            self.assertEqual(seen, ['row %03d' % i for i in range(49, -1, -1)])
+            self.assertEqual([len(p.items) for p in pages], [20, 20, 10])
+            self.client.get('/transactions/?period=all&before=' +
+                            pages[2].prev_cursor)
+            back = self.get_context_variable('transactions')
+            self.assertEqual([t.id for t in back.items],
+                             [t.id for t in pages[1].items])
+            self.assertEqual(self.get_context_variable('total'), 50)
+            response = self.client.get('/transactions/?after=bogus')
+            self.assertEqual(response.status_code, 400)
+
+    def test_count_cache_is_bounded(self):
+        clear_counts()
+        self.addCleanup(clear_counts)
+        settings = (self.app.config['COUNT_CACHE_TTL'],
+                    self.app.config['COUNT_CACHE_SIZE'])
+        self.addCleanup(self.app.config.update,
+                        COUNT_CACHE_TTL=settings[0],
+                        COUNT_CACHE_SIZE=settings[1])
+        self.app.config.update(COUNT_CACHE_TTL=0, COUNT_CACHE_SIZE=3)
+        cached_count(('transactions', 'all', None), Transaction.query)
+        self.assertEqual(len(pagination._counts), 0)
+        self.app.config['COUNT_CACHE_TTL'] = 300
+        for search in range(10):
+            cached_count(('transactions', 'all', search), Transaction.query)
+        self.assertEqual(list(pagination._counts),
+                         [('transactions', 'all', search)
+                          for search in (7, 8, 9)])
+
+    def test_transactions_deep_page_costs_like_first(self):
+        with self.client:
+            self.login()
+            self.create_component()
+            self.seed_ledger(100)
+            self.client.get('/transactions/')
+            first = self.get_context_variable('transactions')
+            db.session.expunge_all()
+            with QueryCounter() as shallow:
+                self.client.get('/transactions/?after=' + first.next_cursor)
+            cursor = self.get_context_variable('transactions').next_cursor
+            for _ in range(2):
+                self.client.get('/transactions/?after=' + cursor)
+                cursor = self.get_context_variable(
+                    'transactions').next_cursor
+            db.session.expunge_all()
+            with QueryCounter() as deep:
+                self.client.get('/transactions/?after=' + cursor)
+            self.assertEqual(shallow.count, deep.count)
+            self.assertFalse(any('count(' in q for q in deep.statements))
+
+    def test_transactions_export_streams_filtered_ledger(self):
+        self.login()
+        self.create_component()
+        self.seed_ledger(30)
+        with QueryCounter() as queries:
+            response = self.client.get('/transactions/export.csv?period=all')
+            lines = response.data.decode('utf-8').splitlines()
+            response.close()
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.headers['Content-Disposition'],
+                         'attachment; filename="transactions-all.csv"')
+        self.assertEqual(lines[0], 'id,date,sku,qty,notes,user')
+        self.assertEqual(len(lines), 31)
+        newest = lines[1].split(',')
+        self.assertEqual(newest[1:], ['2016-01-01T00:09:00', '12345', '1',
+                                      'row 029', 'ad@min.com'])
+        # one query for the rows, not one per row for SKU and email
+        ledger = [q for q in queries.statements
+                  if 'FROM "transaction"' in q or 'FROM transaction' in q]
+        self.assertEqual(len(ledger), 1)
+        self.assertIn('JOIN user', ledger[0])
+
+        response = self.client.get('/transactions/export.csv?search=row 01')
+        lines = response.data.decode('utf-8').splitlines()
+        response.close()
+        self.assertEqual([line.split(',')[4] for line in lines[1:]],
+                         ['row %03d' % i for i in range(19, 9, -1)])
+
+    def test_transactions_export_is_safe_to_open(self):
+        self.login()
+        self.create_component()
+        for qty, notes in ((10, 'plain'), (-1, '=HYPERLINK("http://x")'),
+                           (-1, '+1'), (-1, '-2'), (-1, '@SUM(A1)')):
+            db.session.add(Transaction(component_id=1, user_id=1, qty=qty,
+                                       notes=notes))
+        db.session.commit()
+        response = self.client.get(
+            '/transactions/export.csv?period=x%0d%0aSet-Cookie:%20a=b')
+        rows = list(csv.reader(response.data.decode('utf-8').splitlines()))
+        response.close()
+        self.assertEqual(response.headers['Content-Disposition'],
+                         'attachment; filename="transactions-all.csv"')
+        self.assertEqual([row[3:5] for row in rows[1:]],
+                         [['-1', "'@SUM(A1)"], ['-1', "'-2"], ['-1', "'+1"],
+                          ['-1', '\'=HYPERLINK("http://x")'], ['10', 'plain']])
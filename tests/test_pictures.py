@@ -0,0 +1,374 @@
+# tests/test_pictures.py
+
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from tests.base import BaseTestCase
+from app.models import db, Component, Picture, PictureJob
+from app.mod_pictures import storage, worker
+from app.mod_pictures.storage import blob_path
+from app.mod_pictures.renditions import render_all
+
+
+class TestPictureJobs(BaseTestCase):
+
+    def setUp(self):
+        super(TestPictureJobs, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.app.config['PICTURES_FOLDER'] = self.folder
+        db.session.add(Component(sku='P0001', description='pictured'))
+        db.session.commit()
+        self.client.post('/login', data=dict(email="ad@min.com",
+                                             password="admin_user"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        super(TestPictureJobs, self).tearDown()
+
+    def upload(self, data, filename='photo.jpg'):
+        return self.client.post('/api/pictures/1', data={
+            'picture_file': (io.BytesIO(data), filename)})
+
+    def jpeg(self, size):
+        out = io.BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(out, 'JPEG')
+        return out.getvalue()
+
+    def test_upload_is_queued_then_processed(self):
+        response = self.upload(self.jpeg((1200, 1600)))
+        self.assertEqual(response.status_code, 202)
+        body = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(body['picture']['status'], 'processing')
+        self.assertEqual(body['job']['status'], 'pending')
+        location = response.headers['Location']
+        self.assertTrue(location.endswith('/api/picture-jobs/%s' %
+                                          body['job']['id']))
+        filename = body['picture']['filename']
+        digest = Picture.query.get(1).content_hash
+        self.assertEqual(filename, '%s/%s/%s.jpg' % (digest[:2], digest[2:4],
+                                                   digest))
+
+        worker.run(processes=2, once=True)
+        job = json.loads(self.client.get(location).data.decode('utf-8'))
+        self.assertEqual((job['status'], job['attempts']), ('done', 1))
+        self.assertEqual(Picture.query.get(1).status, 'ready')
+        # the blob stays as uploaded, renditions sit beside it
+        self.assertEqual(storage.hash_file(blob_path(self.folder, filename)),
+                         digest)
+        directory = os.path.dirname(blob_path(self.folder, filename))
+        display = Image.open(os.path.join(directory,
+                                          'display_%s.jpg' % digest))
+        thumbnail = Image.open(os.path.join(directory,
+                                            'thumbnail_%s.jpg' % digest))
+        self.assertEqual(display.size, (675, 900))
+        self.assertEqual(thumbnail.size, (150, 200))
+        self.assertEqual(storage.migrate(self.folder, ['display_',
+                                                       'thumbnail_']),
+                         (0, 0, 0))
+
+    def test_broken_upload_fails_after_retries(self):
+        # looks like a JPEG up front, so only the worker finds out
+        self.upload(b'\xff\xd8\xff\xe0 but not an image')
+        worker.run(processes=1, once=True)
+        job = PictureJob.query.get(1)
+        self.assertEqual((job.status, job.attempts), ('failed', 3))
+        self.assertTrue(job.error)
+        self.assertEqual(Picture.query.get(1).status, 'failed')
+
+    def test_claim_hands_out_each_job_once(self):
+        for side in range(10, 13):
+            self.upload(self.jpeg((side, side)))
+        first = PictureJob.claim('a', limit=2)
+        second = PictureJob.claim('b', limit=2)
+        self.assertEqual([job.id for job in first], [1, 2])
+        self.assertEqual([job.id for job in second], [3])
+        self.assertEqual(PictureJob.claim('c'), [])
+        # a job whose worker died is handed out again
+        self.assertEqual([job.id for job in PictureJob.claim('c', timeout=-1)],
+                         [1])
+
+    def test_identical_upload_reuses_the_picture(self):
+        data = self.jpeg((40, 30))
+        self.upload(data, 'first.jpg')
+        db.session.add(Component(sku='P0002', description='same picture'))
+        db.session.commit()
+        response = self.client.post('/api/pictures/2', data={
+            'picture_file': (io.BytesIO(data), 'second.jpg')})
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.data.decode('utf-8'))
+        self.assertEqual((body['picture']['id'], body['job']), ('1', None))
+        self.assertEqual(Picture.query.count(), 1)
+        self.assertEqual(PictureJob.query.count(), 1)
+        self.assertEqual([c.sku for c in Picture.query.get(1).components],
+                         ['P0001', 'P0002'])
+        blobs = [name for _, _, names in os.walk(self.folder)
+                 for name in names]
+        self.assertEqual(len(blobs), 1)
+
+    def test_migrate_merges_duplicates_and_collect_removes_orphans(self):
+        data = self.jpeg((40, 30))
+        for name in ('00001a.jpg', '00002a.jpg', 'thumbnail_00001a.jpg'):
+            with open(os.path.join(self.folder, name), 'wb') as f:
+                f.write(data)
+        first = Picture(filename='00001a.jpg')
+        second = Picture(filename='00002a.jpg')
+        component = Component.query.get(1)
+        component.pictures.extend([first, second])
+        other = Component(sku='P0002', description='second copy only')
+        other.pictures.append(second)
+        db.session.add(other)
+        db.session.commit()
+
+        prefixes = ['display_', 'thumbnail_']
+        self.assertEqual(storage.migrate(self.folder, prefixes), (1, 1, 0))
+        self.assertEqual(Picture.query.count(), 1)
+        picture = Picture.query.get(1)
+        self.assertEqual(picture.content_hash,
+                         hashlib.sha256(data).hexdigest())
+        self.assertEqual(sorted(c.sku for c in picture.components),
+                         ['P0001', 'P0002'])
+        directory = os.path.dirname(blob_path(self.folder, picture.filename))
+        self.assertEqual(sorted(os.listdir(directory)),
+                         [picture.content_hash + '.jpg',
+                          'thumbnail_' + picture.content_hash + '.jpg'])
+        self.assertFalse([name for name in os.listdir(self.folder)
+                          if name.endswith('.jpg')])
+
+        # an orphaned blob goes, once it is past the grace period
+        digest, orphan = storage.store(io.BytesIO(b'orphan'), self.folder,
+                                       '.jpg')
+        self.assertEqual(storage.collect(self.folder, prefixes), [])
+        self.assertEqual(storage.collect(self.folder, prefixes, grace=-1),
+                         [orphan])
+        self.assertFalse(os.path.exists(blob_path(self.folder, orphan)))
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+        # uploading an old orphan again restarts its grace period
+        digest, orphan = storage.store(io.BytesIO(b'orphan'), self.folder,
+                                       '.jpg')
+        os.utime(blob_path(self.folder, orphan), (0, 0))
+        storage.store(io.BytesIO(b'orphan'), self.folder, '.jpg')
+        self.assertEqual(storage.collect(self.folder, prefixes), [])
+        self.assertTrue(os.path.exists(blob_path(self.folder, orphan)))
+
+    def test_upload_is_checked_while_it_streams(self):
+        self.app.config['PICTURE_MAX_SIZE'] = 1024
+        response = self.upload(self.jpeg((10, 10)) + b'\0' * 2048)
+        self.assertEqual(response.status_code, 413)
+        response = self.upload(b'\xff\xd8\xff' + b'\0' * 64 * 1024)
+        self.assertEqual(response.status_code, 413)
+        response = self.upload(b'%PDF-1.4 not a picture at all')
+        self.assertEqual(response.status_code, 415)
+        response = self.upload(self.jpeg((10, 10)), 'photo.exe')
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(Picture.query.count(), 0)
+        self.assertEqual(os.listdir(self.folder), [])
+
+        # the type comes from the bytes, not the name
+        png = io.BytesIO()
+        Image.new('RGB', (10, 10)).save(png, 'PNG')
+        response = self.upload(png.getvalue(), 'photo.jpg')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(json.loads(response.data.decode('utf-8'))
+                        ['picture']['filename'].endswith('.png'))
+
+    def test_upload_needs_component_and_file(self):
+        response = self.client.post('/api/pictures/42', data={
+            'picture_file': (io.BytesIO(b'x'), 'x.jpg')})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post('/api/pictures/1', data={})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/picture-jobs/9').status_code,
+                         404)
+
+
+class TestPictureServing(BaseTestCase):
+
+    def setUp(self):
+        super(TestPictureServing, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.app.config['PICTURES_FOLDER'] = self.folder
+        db.session.add(Component(sku='P0001', description='pictured'))
+        db.session.commit()
+        self.client.post('/login', data=dict(email="ad@min.com",
+                                             password="admin_user"))
+        out = io.BytesIO()
+        Image.new('RGB', (300, 400), (20, 90, 200)).save(out, 'JPEG')
+        response = self.client.post('/api/pictures/1', data={
+            'picture_file': (io.BytesIO(out.getvalue()), 'photo.jpg')})
+        self.picture = json.loads(response.data.decode('utf-8'))['picture']
+        with open(blob_path(self.folder, self.picture['filename']),
+                  'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        super(TestPictureServing, self).tearDown()
+
+    def test_picture_is_served_for_good(self):
+        url = self.picture['url']
+        self.assertTrue(url.startswith('/pictures/'))
+        self.assertTrue(url.endswith('/' + self.picture['filename']))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.data)
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        etag = response.headers['ETag']
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_rendition_urls_follow_the_worker(self):
+        # no renditions before the worker ran
+        self.assertEqual(self.picture['thumbnail_url'], self.picture['url'])
+        self.assertEqual(self.picture['original_url'], self.picture['url'])
+        worker.run(processes=1, once=True)
+        body = json.loads(self.client.get('/api/pictures').data
+                          .decode('utf-8'))[0]
+        self.assertIn('/thumbnail_', body['thumbnail_url'])
+        self.assertIn('/display_', body['url'])
+        self.assertEqual(body['original_url'], self.picture['original_url'])
+        self.assertEqual(self.client.get(body['thumbnail_url']).status_code,
+                         200)
+        self.assertEqual(self.client.get(body['original_url']).data,
+                         self.data)
+
+    def test_fingerprint_follows_content_not_the_file(self):
+        path = blob_path(self.folder, self.picture['filename'])
+        os.utime(path, (0, 0))
+        body = json.loads(self.client.get('/api/pictures').data
+                          .decode('utf-8'))[0]
+        self.assertEqual(body['original_url'], self.picture['original_url'])
+        self.assertEqual(self.client.get(body['original_url']).status_code,
+                         200)
+
+    def test_regenerated_renditions_get_new_urls(self):
+        worker.run(processes=1, once=True)
+
+        def thumbnail_url():
+            return json.loads(self.client.get('/api/pictures').data
+                              .decode('utf-8'))[0]['thumbnail_url']
+        before = thumbnail_url()
+        self.addCleanup(self.app.config.update,
+                        PICTURE_QUALITY=self.app.config['PICTURE_QUALITY'])
+        self.app.config['PICTURE_QUALITY'] = 30
+        render_all(blob_path(self.folder, self.picture['filename']),
+                   os.path.dirname(blob_path(self.folder,
+                                             self.picture['filename'])),
+                   os.path.basename(self.picture['filename']),
+                   self.app.config['PICTURE_RENDITIONS'], quality=30)
+        self.assertNotEqual(thumbnail_url(), before)
+
+    def test_stale_fingerprint_redirects(self):
+        stale = '/pictures/000000000000/' + self.picture['filename']
+        response = self.client.get(stale)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].endswith(
+            self.picture['url']))
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        self.assertEqual(self.client.get(
+            '/pictures/000000000000/../../config.py').status_code, 404)
+
+    def test_byte_ranges(self):
+        url = self.picture['url']
+        response = self.client.get(url, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.data[:10])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 0-9/%d' % len(self.data))
+        response = self.client.get(url, headers={'Range': 'bytes=-5'})
+        self.assertEqual(response.data, self.data[-5:])
+        response = self.client.get(url, headers={
+            'Range': 'bytes=%d-' % len(self.data)})
+        self.assertEqual(response.status_code, 416)
+        # a range of another version of the file gets the whole file
+        response = self.client.get(url, headers={'Range': 'bytes=0-9',
+                                                 'If-Range': '"other"'})
+        self.assertEqual((response.status_code, response.data),
+                         (200, self.data))
+
+    def test_sendfile_offload(self):
+        url = self.picture['url']
+        self.app.config['PICTURE_SENDFILE'] = 'x-accel-redirect'
+        response = self.client.get(url)
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+                         '/_pictures/' + self.picture['filename'])
+        self.assertEqual(response.data, b'')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.app.config['PICTURE_SENDFILE'] = 'x-sendfile'
+        response = self.client.get(url)
+        self.assertEqual(response.headers['X-Sendfile'],
+                         blob_path(self.folder, self.picture['filename']))
+
+
+class TestRenditions(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, im, filename, **options):
+        path = os.path.join(self.folder, filename)
+        im.save(path, 'JPEG', **options)
+        return path
+
+    def test_sideways_photo_is_turned_upright(self):
+        # a little endian IFD holding just orientation 6
+        exif = (b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x01\x00'
+                b'\x12\x01\x03\x00\x01\x00\x00\x00\x06\x00\x00\x00'
+                b'\x00\x00\x00\x00')
+        path = self.write(Image.new('RGB', (1600, 1200)), 'p.jpg', exif=exif)
+        render_all(path, self.folder, 'p.jpg', (('d_', 900), ('t_', 200)))
+        self.assertEqual(Image.open(path).size, (1600, 1200))
+        self.assertEqual(Image.open(os.path.join(self.folder, 'd_p.jpg')).size,
+                         (675, 900))
+        self.assertEqual(Image.open(os.path.join(self.folder, 't_p.jpg')).size,
+                         (150, 200))
+
+    def test_small_upright_upload_is_linked_not_encoded(self):
+        path = self.write(Image.new('RGB', (300, 400)), 'p.jpg')
+        with open(path, 'rb') as f:
+            before = f.read()
+        written = render_all(path, self.folder, 'p.jpg',
+                             (('d_', 900), ('t_', 200)))
+        display = os.path.join(self.folder, 'd_p.jpg')
+        for name in (path, display):
+            with open(name, 'rb') as f:
+                self.assertEqual(f.read(), before)
+        self.assertEqual(written[display], len(before))
+        self.assertNotIn(path, written)
+        self.assertEqual(Image.open(os.path.join(self.folder, 't_p.jpg')).size,
+                         (150, 200))
+
+    def test_upload_drafted_to_rendition_size_is_encoded(self):
+        # the JPEG draft decodes these at exactly the display size
+        for size, display in (((1800, 1800), (900, 900)),
+                              ((2400, 1800), (1200, 900))):
+            path = self.write(Image.new('RGB', size), 'p.jpg')
+            render_all(path, self.folder, 'p.jpg',
+                       (('d_', 900), ('t_', 200)))
+            rendition = os.path.join(self.folder, 'd_p.jpg')
+            self.assertEqual(Image.open(rendition).size, display)
+            self.assertNotEqual(os.stat(rendition).st_ino,
+                                os.stat(path).st_ino)
+
+    def test_source_is_never_a_rendition(self):
+        path = self.write(Image.new('RGB', (300, 400)), 'p.jpg')
+        with self.assertRaises(ValueError):
+            render_all(path, self.folder, 'p.jpg', (('', 900),))
+
+
+if __name__ == '__main__':
+    unittest.main()
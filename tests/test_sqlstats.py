@@ -0,0 +1,156 @@
+# tests/test_sqlstats.py
+
+
+import json
+import logging
+import unittest
+
+from tests.base import BaseTestCase
+from tests.helpers import QueryBudgetMixin, QueryCounter
+from app.models import db, Component, PurchaseOrder, touch_tables
+from app.generator import DataGenerator
+from app.sqlstats import RequestStats, logger, sql_stats
+
+
+# statements each page may run, whatever the number of rows behind it; a
+# request may also load the logged in user
+BUDGETS = (
+    ('/component/', 2),
+    ('/component/%(component)d', 2),
+    ('/transactions/', 3),
+    ('/api/components', 7),
+    ('/api/categories', 5),
+    ('/api/single-tags', 3),
+    ('/transactions/check-in', 2),
+    ('/purchase_order/', 2),
+    ('/purchase_order/%(order)d', 3),
+    ('/inventory/vendor/', 2),
+    ('/manage-tags', 3),
+)
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestQueryBudgets(QueryBudgetMixin, BaseTestCase):
+
+    def setUp(self):
+        super(TestQueryBudgets, self).setUp()
+        DataGenerator(users=2, vendors=3, components=25, categories=4,
+                      tags=15, purchase_orders=10, transactions=200,
+                      days=30).run()
+        self.client.post('/login', data=dict(email="ad@min.com",
+                                             password="admin_user"))
+
+    def test_pages_stay_within_budget(self):
+        ids = {'component': Component.query.first().id,
+               'order': PurchaseOrder.query.first().id}
+        for url, budget in BUDGETS:
+            response = self.assertQueryBudget(budget, url % ids)
+            self.assertEqual(response.status_code, 200, url)
+
+    def test_check_in_stays_within_budget(self):
+        component = Component.query.first()
+        response = self.assertQueryBudget(
+            5, '/transactions/check-in', method='post',
+            data=dict(component=component.id, qty=2, notes='restock',
+                      user_id=1, checkin='Check In'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_budget_failure_lists_the_statements(self):
+        with self.assertRaises(AssertionError) as raised:
+            self.assertQueryBudget(0, '/api/categories')
+        self.assertIn('over its budget of 0', str(raised.exception))
+        self.assertIn('SELECT', str(raised.exception))
+
+
+class TestSQLStats(BaseTestCase):
+
+    def setUp(self):
+        super(TestSQLStats, self).setUp()
+        db.session.add(Component(sku='S0001', description='counted'))
+        db.session.commit()
+        self.handler = RecordingHandler()
+        logger.addHandler(self.handler)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+        settings = (sql_stats.headers, sql_stats.log, sql_stats.warn_queries)
+        self.addCleanup(logger.removeHandler, self.handler)
+        self.addCleanup(self.restore, settings)
+
+    def restore(self, settings):
+        sql_stats.headers, sql_stats.log, sql_stats.warn_queries = settings
+
+    def test_debug_responses_carry_the_numbers(self):
+        db.session.expunge_all()
+        with QueryCounter() as queries:
+            response = self.client.get('/api/components')
+        self.assertEqual(int(response.headers['X-SQL-Queries']),
+                         queries.count)
+        self.assertGreaterEqual(float(response.headers['X-SQL-Time']), 0)
+        self.assertIn('desc="%d queries"' % queries.count,
+                      response.headers['Server-Timing'])
+        self.assertEqual(self.handler.records, [])
+
+    def test_production_logs_one_json_line_a_request(self):
+        sql_stats.headers, sql_stats.log = False, True
+        response = self.client.get('/api/components')
+        self.assertNotIn('X-SQL-Queries', response.headers)
+        record, = self.handler.records
+        self.assertEqual(record.levelno, logging.INFO)
+        line = json.loads(record.getMessage())
+        self.assertEqual((line['method'], line['path'], line['status']),
+                         ('GET', '/api/components', 200))
+        self.assertGreater(line['queries'], 0)
+        self.assertLessEqual(len(line['slowest']), 3)
+        self.assertEqual([s['ms'] for s in line['slowest']],
+                         sorted([s['ms'] for s in line['slowest']],
+                                reverse=True))
+        self.assertTrue(line['slowest'][0]['statement'].startswith('SELECT'))
+
+    def test_heavy_requests_log_a_warning(self):
+        sql_stats.headers, sql_stats.log = False, True
+        sql_stats.warn_queries = 1
+        self.client.get('/api/components')
+        self.assertEqual(self.handler.records[0].levelno, logging.WARNING)
+
+    def test_streamed_responses_are_logged_once_sent(self):
+        # enough components for the stream to load them in several chunks
+        db.session.execute(Component.__table__.insert(), [
+            dict(sku='T%04d' % i, description='streamed')
+            for i in range(1200)])
+        touch_tables(db.session, 'component')
+        db.session.commit()
+        db.session.expunge_all()
+        sql_stats.log = True
+        with QueryCounter() as queries:
+            response = self.client.get('/api/components?stream=1')
+            self.assertEqual(self.handler.records, [])
+            response.get_data()
+            response.close()
+        # the headers went out before the body ran its statements
+        self.assertNotIn('X-SQL-Queries', response.headers)
+        record, = self.handler.records
+        line = json.loads(record.getMessage())
+        self.assertTrue(line['streamed'])
+        self.assertEqual(line['queries'], queries.count)
+
+    def test_request_stats_keep_the_slowest(self):
+        stats = RequestStats(keep=2)
+        for seconds, statement in ((0.1, 'a'), (0.5, 'b'), (0.2, 'c'),
+                                   (0.05, 'd')):
+            stats.record(statement, seconds)
+        self.assertEqual(stats.count, 4)
+        self.assertAlmostEqual(stats.seconds, 0.85)
+        self.assertEqual(stats.slowest, [(0.5, 'b'), (0.2, 'c')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,13 @@
 
 import unittest
 
+from werkzeug.contrib.cache import SimpleCache
+
 from tests.base import BaseTestCase
-from app.models import LineItem, Component
+from tests.helpers import QueryCounter
+from app.cache import response_cache
+from app.models import db, LineItem, Component, Tag, TagCategory, \
+    TagManager, NameCache, tag_names
 from app.mod_inventory.forms import VendorCreateForm, PurchaseOrderForm, \
     ComponentCreateForm
 import json
@@ -82,4 +87,206 @@ class TestTagManagement(BaseTestCase):
             the_cat_with_tag = json.loads(response.data.decode("utf-8"))
             self.assertEqual(
                 the_cat_with_tag[0]['tags'][0]['name'],
-                tag_in_cat.strip().upper())
\ No newline at end of file
+                tag_in_cat.strip().upper())
+
+    def test_bulk_tag_and_untag(self):
+        self.login()
+        for i in range(40):
+            db.session.add(Component(sku='B%04d' % i, description='bulk'))
+        db.session.commit()
+        Component.query.get(1).tag_with('smd')
+        body = {'component_ids': list(range(1, 41)) + [999],
+                'tags': ['smd', {'tag': 'e12', 'category': 'series'}]}
+        with QueryCounter() as queries:
+            response = self.client.post('/api/component-tags/bulk',
+                                        data=json.dumps(body),
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode('utf-8')),
+                         {'tagged': 79})
+        self.assertEqual(len([q for q in queries.statements
+                              if 'components_tags' in q]), 1)
+        self.assertEqual(
+            sorted(t.name for t in Component.query.get(7).tags),
+            ['E12', 'SMD'])
+        self.assertEqual(
+            [c.name for c in Tag.query.filter_by(name='E12').one().categories],
+            ['SERIES'])
+        response = self.client.post('/api/component-tags/bulk',
+                                    data=json.dumps(body),
+                                    content_type='application/json')
+        self.assertEqual(json.loads(response.data.decode('utf-8')),
+                         {'tagged': 0})
+
+        body = {'component_ids': list(range(1, 21)), 'tags': ['smd', 'none']}
+        with QueryCounter() as queries:
+            response = self.client.delete('/api/component-tags/bulk',
+                                          data=json.dumps(body),
+                                          content_type='application/json')
+        self.assertEqual(json.loads(response.data.decode('utf-8')),
+                         {'untagged': 20})
+        self.assertEqual([q for q in queries.statements
+                          if 'components_tags' in q][0].split()[0], 'DELETE')
+        db.session.expire_all()
+        self.assertEqual([t.name for t in Component.query.get(7).tags],
+                         ['E12'])
+        self.assertEqual(len(Component.query.get(30).tags), 2)
+
+    def test_bulk_tag_rejects_bad_bodies(self):
+        self.login()
+        for body in ({'component_ids': [], 'tags': ['a']},
+                     {'component_ids': ['1'], 'tags': ['a']},
+                     {'component_ids': [1], 'tags': []},
+                     {'component_ids': [1], 'tags': ['x' * 26]},
+                     {'component_ids': [1], 'tags': [{'category': 'c'}]}):
+            response = self.client.post('/api/component-tags/bulk',
+                                        data=json.dumps(body),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def tagging_queries(self, category_size):
+        TagManager.bulk_tag([], [('t%s' % i, 'big')
+                                 for i in range(category_size)])
+        component = Component(sku='C%04d' % category_size,
+                              description='sized')
+        db.session.add(component)
+        db.session.commit()
+        component.tag_with('t0', 'big')
+        with QueryCounter() as queries:
+            component.tag_with('t1', 'big')
+            component.tag_with('t1', 'big')
+        return queries.statements
+
+    def test_tagging_cost_ignores_category_size(self):
+        small = self.tagging_queries(3)
+        tag_names.clear()
+        large = self.tagging_queries(300)
+        self.assertEqual(len(small), len(large))
+        # membership is an EXISTS, never a load of the category's tags
+        self.assertFalse(any('tag_categories_tags' in q and 'EXISTS' not in q
+                             for q in large))
+
+    def test_name_cache(self):
+        cache = NameCache(Tag, size=2)
+        for name in ('A', 'B', 'C'):
+            TagManager.new_tag(name)
+            self.assertIsNotNone(cache.get(name))
+        with QueryCounter() as queries:
+            cache.get('C')
+            cache.get('B')
+        self.assertEqual(queries.count, 0)
+        with QueryCounter() as queries:
+            cache.get('A')
+        self.assertEqual(queries.count, 1)
+        self.assertIsNone(cache.get('missing'))
+
+        tag_names.get('B')
+        tag = Tag.query.filter_by(name='B').one()
+        tag.name = 'RENAMED'
+        db.session.commit()
+        self.assertIsNone(tag_names.get('B'))
+        self.assertEqual(tag_names.load('RENAMED').id, tag.id)
+        db.session.delete(tag)
+        db.session.commit()
+        self.assertIsNone(tag_names.load('RENAMED'))
+        # a stale id pointing at another row is looked up again
+        tag_names._ids['A'] = Tag.query.filter_by(name='C').one().id
+        self.assertEqual(tag_names.load('A').name, 'A')
+
+    def test_remove_tag(self):
+        self.login()
+        self.create_component()
+        component = Component.query.get(1)
+        component.tag_with('keep')
+        component.tag_with('drop', 'cat')
+        component = Component.query.get(1).remove_tag('DROP')
+        self.assertEqual([t.name for t in component.tags], ['KEEP'])
+        self.assertEqual([t.name for t in TagCategory.query.one().tags],
+                         ['DROP'])
+
+
+class TestTagResponseCache(BaseTestCase):
+
+    def setUp(self):
+        super(TestTagResponseCache, self).setUp()
+        self.backend = response_cache.backend
+        response_cache.backend = SimpleCache()
+        response_cache.clear()
+        self.client.post('/login', data=dict(email="ad@min.com",
+                                             password="admin_user"))
+
+    def tearDown(self):
+        response_cache.backend = self.backend
+        super(TestTagResponseCache, self).tearDown()
+
+    def get_json(self, url):
+        return json.loads(self.client.get(url).data.decode('utf-8'))
+
+    def test_cached_until_tags_change(self):
+        for i in range(5):
+            TagManager.new_tag('tag %s' % i, 'cat %s' % (i % 2))
+        TagManager.new_tag('loner')
+        db.session.expunge_all()
+        with QueryCounter() as cold:
+            categories = self.get_json('/api/categories')
+        self.assertEqual(len(categories), 2)
+        # one query per relationship level, not one per tag
+        self.assertLessEqual(cold.count, 4)
+        with QueryCounter() as warm:
+            self.assertEqual(self.get_json('/api/categories'), categories)
+        # only the conditional GET validators are read
+        self.assertEqual([q for q in warm.statements if 'tag' in q], [])
+        self.assertEqual([t['name'] for t in
+                          self.get_json('/api/single-tags')], ['LONER'])
+
+        TagManager.new_tag('loner', 'cat 0')
+        self.assertEqual(self.get_json('/api/single-tags'), [])
+        self.assertIn('LONER', [t['name'] for t in
+                                self.get_json('/api/categories')[0]['tags']])
+        self.client.delete('/api/tag/%s' % Tag.query.filter_by(
+            name='LONER').first().id)
+        self.assertNotIn('LONER', [t['name'] for t in
+                                   self.get_json('/api/categories')[0]['tags']])
+        self.assertEqual(self.get_json('/api/cache-stats'),
+                         {'tags': {'hits': 1, 'misses': 5}})
+
+    def test_bulk_tagging_invalidates(self):
+        db.session.add(Component(sku='B0001', description='bulk'))
+        db.session.commit()
+        self.assertEqual(self.get_json('/api/single-tags'), [])
+        TagManager.bulk_tag([1], [('fresh', None)])
+        self.assertEqual([t['name'] for t in
+                          self.get_json('/api/single-tags')], ['FRESH'])
+        TagManager.bulk_tag([1], [('fresh', 'cat')])
+        self.assertEqual(self.get_json('/api/single-tags'), [])
+
+    def test_lost_generation_never_revives_stale_responses(self):
+        TagManager.new_tag('first')
+        self.assertEqual([t['name'] for t in
+                          self.get_json('/api/single-tags')], ['FIRST'])
+        # the generation key expires or is evicted, cached responses live on
+        response_cache.backend.delete('generation:tags')
+        TagManager.new_tag('second')
+        self.assertEqual([t['name'] for t in
+                          self.get_json('/api/single-tags')],
+                         ['FIRST', 'SECOND'])
+
+    def test_generations_do_not_expire(self):
+        response_cache.generation('tags')
+        response_cache.invalidate('tags', 'components')
+        # SimpleCache keeps (expires, value); 0 never expires
+        for group in ('tags', 'components'):
+            expires, value = response_cache.backend._cache[
+                'generation:' + group]
+            self.assertEqual(expires, 0)
+
+    def test_rolled_back_changes_keep_cache(self):
+        TagManager.new_tag('kept')
+        self.get_json('/api/single-tags')
+        db.session.add(Tag('dropped'))
+        db.session.flush()
+        db.session.rollback()
+        self.get_json('/api/single-tags')
+        self.assertEqual(response_cache.stats(),
+                         {'tags': {'hits': 1, 'misses': 1}})
+
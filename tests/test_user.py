@@ -7,8 +7,10 @@ import unittest
 from flask_login import current_user
 from tests.base import BaseTestCase
 from app import bcrypt
-from app.models import User
+from app.models import db, User, Component, Transaction
 from app.mod_user.forms import LoginForm
+from app.mod_user import loader
+from tests.helpers import QueryCounter
 
 
 class TestUserBlueprint(BaseTestCase):
@@ -113,6 +115,44 @@ class TestUserBlueprint(BaseTestCase):
             self.assertTrue(current_user.is_active())
             self.assertEqual(response.status_code, 200)
 
+    def test_loader_selects_identity_columns_only(self):
+        # Ensure the login path doesn't load the user's history.
+        db.session.add(Component(sku='A0001', description='widget'))
+        db.session.commit()
+        for _ in range(20):
+            db.session.add(Transaction(component_id=1, user_id=1, qty=1))
+        db.session.commit()
+        loader.invalidate()
+        with QueryCounter() as queries:
+            user = loader.load_user(u'1')
+        self.assertEqual(queries.count, 1)
+        self.assertNotIn('transaction', queries.statements[0])
+        self.assertEqual(user.email, 'ad@min.com')
+        self.assertEqual(user.load().transactions.count(), 20)
+
+    def test_loader_caches_until_user_changes(self):
+        # Ensure cached identities are reused and dropped on update.
+        loader.invalidate()
+        loader.load_user(1)
+        with QueryCounter() as queries:
+            loader.load_user(1)
+        self.assertEqual(queries.count, 0)
+        User.query.get(1).email = 'new@min.com'
+        db.session.flush()
+        # other requests still see the old row until the commit
+        self.assertEqual(loader.load_user(1).email, 'ad@min.com')
+        db.session.commit()
+        self.assertEqual(loader.load_user(1).email, 'new@min.com')
+
+    def test_loader_keeps_identity_when_change_rolls_back(self):
+        loader.invalidate()
+        loader.load_user(1)
+        User.query.get(1).email = 'new@min.com'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(loader._cache[1][1].email, 'ad@min.com')
+        self.assertNotIn('changed_users', db.session.info)
+
 
 if __name__ == '__main__':
     unittest.main()